@@ -1,10 +1,10 @@
 import os
 import logging
 
-from flask import Flask, render_template, redirect, url_for
+from flask import Flask, render_template, redirect, url_for, request
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, login_required, current_user
-from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.orm import DeclarativeBase, Session, joinedload, make_transient_to_detached
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 # Set up logging
@@ -29,9 +29,53 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
 }
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# Configure the result cache ('memory', 'redis' or 'null')
+app.config["CACHE_TYPE"] = os.environ.get("CACHE_TYPE", "memory")
+app.config["CACHE_REDIS_URL"] = os.environ.get("CACHE_REDIS_URL")
+app.config["CACHE_DEFAULT_TTL"] = int(os.environ.get("CACHE_DEFAULT_TTL", 300))
+app.config["CACHE_MAX_ENTRIES"] = int(os.environ.get("CACHE_MAX_ENTRIES", 1024))
+app.config["USER_CACHE_TTL"] = int(os.environ.get("USER_CACHE_TTL", 60))
+
+# Configure the idempotency keys of the API (a purge interval of 0 disables the purge thread)
+app.config["IDEMPOTENCY_KEY_TTL"] = int(os.environ.get("IDEMPOTENCY_KEY_TTL", 24 * 3600))
+app.config["IDEMPOTENCY_PURGE_INTERVAL"] = int(os.environ.get("IDEMPOTENCY_PURGE_INTERVAL", 600))
+
+# Configure the notification outbox ('log' or 'smtp' transport; 0 workers leaves delivery
+# to a separate `flask deliver-notifications` process)
+app.config["NOTIFICATION_TRANSPORT"] = os.environ.get("NOTIFICATION_TRANSPORT", "log")
+app.config["NOTIFICATION_WORKERS"] = int(os.environ.get("NOTIFICATION_WORKERS", 1))
+app.config["NOTIFICATION_POLL_INTERVAL"] = int(os.environ.get("NOTIFICATION_POLL_INTERVAL", 5))
+app.config["OUTBOX_BATCH_SIZE"] = int(os.environ.get("OUTBOX_BATCH_SIZE", 100))
+app.config["SMTP_HOST"] = os.environ.get("SMTP_HOST", "localhost")
+app.config["SMTP_PORT"] = int(os.environ.get("SMTP_PORT", 25))
+app.config["SMTP_SENDER"] = os.environ.get("SMTP_SENDER", "bibliotheque@localhost")
+app.config["SMTP_USERNAME"] = os.environ.get("SMTP_USERNAME")
+app.config["SMTP_PASSWORD"] = os.environ.get("SMTP_PASSWORD")
+app.config["SMTP_STARTTLS"] = os.environ.get("SMTP_STARTTLS", "").lower() in ("1", "true", "yes")
+app.config["SMTP_POOL_SIZE"] = int(os.environ.get("SMTP_POOL_SIZE", 4))
+app.config["SMTP_MAX_MESSAGES_PER_CONNECTION"] = int(os.environ.get("SMTP_MAX_MESSAGES_PER_CONNECTION", 100))
+app.config["SMTP_RATE_LIMIT"] = float(os.environ.get("SMTP_RATE_LIMIT", 0))
+
+# Configure the scheduled jobs (intervals in seconds; a scheduler interval of 0 leaves the jobs
+# to a separate `flask run-scheduler` process)
+app.config["SCHEDULER_INTERVAL"] = int(os.environ.get("SCHEDULER_INTERVAL", 60))
+app.config["OVERDUE_CHECK_INTERVAL"] = int(os.environ.get("OVERDUE_CHECK_INTERVAL", 3600))
+app.config["DUE_REMINDER_INTERVAL"] = int(os.environ.get("DUE_REMINDER_INTERVAL", 3600))
+# In digest mode each member gets one notice per window listing all their loans, instead of one per loan
+app.config["NOTIFICATION_DIGEST"] = os.environ.get("NOTIFICATION_DIGEST", "").lower() in ("1", "true", "yes")
+app.config["NOTIFICATION_DIGEST_WINDOW"] = int(os.environ.get("NOTIFICATION_DIGEST_WINDOW", 24 * 3600))
+# Days the ledger of queued notices is kept, to avoid sending the same notice twice
+app.config["LEDGER_RETENTION_DAYS"] = int(os.environ.get("LEDGER_RETENTION_DAYS", 90))
+app.config["LEDGER_PRUNE_INTERVAL"] = int(os.environ.get("LEDGER_PRUNE_INTERVAL", 24 * 3600))
+
 # Initialize app with SQLAlchemy
 db.init_app(app)
 
+# Initialize the result cache, invalidated by the commits that write its tables
+from utils.cache import create_cache, register_invalidation
+cache = create_cache(app.config)
+register_invalidation(Session, cache)
+
 # Initialize Flask-Login
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -46,7 +90,33 @@ with app.app_context():
     import models
 
     # Create database tables
+    existing_tables = set(db.inspect(db.engine).get_table_names())
     db.create_all()
+
+    # Add columns, indexes and search structures missing from databases created earlier
+    from utils.schema import upgrade_schema
+    if upgrade_schema(db.engine, db.metadata):
+        # New counter columns start at zero; fill them from the loan table
+        models.repair_loan_counters()
+        db.session.commit()
+    
+    if 'library_stats' not in existing_tables:
+        # Fill the statistics counters from the rows already in the database
+        from utils.statistics import reconcile_statistics
+        reconcile_statistics()
+        db.session.commit()
+    
+    if 'daily_stats' not in existing_tables:
+        # Fill the activity rollups from the rows already in the database
+        from utils.rollups import rebuild_rollups
+        rebuild_rollups()
+        db.session.commit()
+    
+    if 'popularity_daily' not in existing_tables:
+        # Fill the popularity windows from the recent loans
+        from utils.popularity import rebuild_popularity
+        rebuild_popularity()
+        db.session.commit()
     
     # Créer un utilisateur administrateur par défaut si aucun n'existe
     from models import User
@@ -64,12 +134,70 @@ with app.app_context():
         app.logger.info("Utilisateur administrateur par défaut créé")
     
     app.logger.info("Database tables created")
-    
+
+def start_background_workers(app):
+    """
+    Start the background threads of a server process, as configured.
+
+    Called by the server entrypoint (``main.py``) only: importing the
+    application, as the ``flask`` commands, the tests and the benchmarks
+    do, starts nothing. The ``flask`` commands never start them either;
+    ``deliver-notifications`` and ``run-scheduler`` run these loops as
+    processes of their own.
+    """
+    if os.environ.get("FLASK_RUN_FROM_CLI") == "true":
+        return
+
+    # Purge the expired idempotency keys in the background
+    if app.config["IDEMPOTENCY_PURGE_INTERVAL"] > 0:
+        from utils.idempotency import start_purge_thread
+        start_purge_thread(app, app.config["IDEMPOTENCY_PURGE_INTERVAL"])
+
+    # Deliver the queued notifications in the background
+    if app.config["NOTIFICATION_WORKERS"] > 0:
+        from utils.outbox import start_outbox_workers
+        start_outbox_workers(app, app.config["NOTIFICATION_WORKERS"], app.config["NOTIFICATION_POLL_INTERVAL"])
+
+    # Run the overdue notices and due date reminders on their cadence
+    if app.config["SCHEDULER_INTERVAL"] > 0:
+        from utils.scheduler import start_scheduler
+        start_scheduler(app, app.config["SCHEDULER_INTERVAL"])
+
 # User loader callback for Flask-Login
 @login_manager.user_loader
 def load_user(user_id):
-    from models import User
-    return User.query.get(int(user_id))
+    """
+    Load the logged-in user, from the result cache when it is shared between processes.
+    
+    Entries are invalidated when their user is written (see
+    ``models.USER_CACHE_TAG``). An in-process cache would only see the
+    writes of its own process, leaving a deactivated user or a revoked
+    role active in the others until the entry expires, so without a
+    shared backend every request queries the user. The password hash is
+    left out of the cached entries; it is loaded again when accessed.
+    """
+    from models import USER_CACHE_TAG, User
+    user_id = int(user_id)
+    
+    if not cache.shared:
+        return db.session.get(User, user_id)
+    
+    def columns():
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        return {attr.key: getattr(user, attr.key) for attr in User.__mapper__.column_attrs
+                if attr.key != 'password_hash'}
+    
+    data = cache.get_or_set(USER_CACHE_TAG.format(user_id), columns,
+                            tags=(USER_CACHE_TAG.format(user_id),), ttl=app.config["USER_CACHE_TTL"])
+    if data is None:
+        return None
+    
+    # Attach the cached row to the session as a persistent object, without a query
+    user = User(**data)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
 
 # Register blueprints/routes
 from routes.book_routes import book_bp
@@ -86,37 +214,34 @@ app.register_blueprint(api_bp, url_prefix='/api')
 app.register_blueprint(admin, url_prefix='/admin')
 app.register_blueprint(auth_bp, url_prefix='/auth')
 
+# Register command line tools (flask repair-counters, ...)
+import commands  # noqa: E402,F401
+
 # Home route
 @app.route('/')
 @login_required
 def home():
     # Get count data for dashboard
-    book_count = models.Book.query.count()
-    available_books = models.Book.query.filter_by(available=True).count()
-    member_count = models.Member.query.count()
-    active_members = models.Member.query.filter_by(active=True).count()
-    loan_count = models.Loan.query.count()
-    active_loans = models.Loan.query.filter_by(returned=False).count()
-    overdue_loans = models.Loan.query.filter(
-        models.Loan.returned == False,
-        models.Loan.due_date < models.Loan.loan_date
-    ).count()
+    from utils.statistics import library_statistics
+    counters = library_statistics()
     
     # Create stats dictionary
     stats = {
-        'total_books': book_count,
-        'available_books': available_books,
-        'total_members': member_count,
-        'active_members': active_members,
-        'total_loans': loan_count,
-        'active_loans': active_loans,
-        'overdue_loans': overdue_loans
+        'total_books': counters['books']['total'],
+        'available_books': counters['books']['available'],
+        'total_members': counters['members']['total'],
+        'active_members': counters['members']['active'],
+        'total_loans': counters['loans']['total'],
+        'active_loans': counters['loans']['active'],
+        'overdue_loans': counters['loans']['overdue']
     }
     
     # Recent items
     recent_books = models.Book.query.order_by(models.Book.created_at.desc()).limit(5).all()
     recent_members = models.Member.query.order_by(models.Member.created_at.desc()).limit(5).all()
-    recent_loans = models.Loan.query.order_by(models.Loan.created_at.desc()).limit(5).all()
+    recent_loans = models.Loan.query.options(
+        joinedload(models.Loan.book), joinedload(models.Loan.member)
+    ).order_by(models.Loan.created_at.desc()).limit(5).all()
     
     return render_template('index.html',
                           stats=stats,
@@ -124,6 +249,14 @@ def home():
                           recent_members=recent_members,
                           recent_loans=recent_loans)
 
+# Template helpers
+@app.template_global()
+def modify_query(**changes):
+    """Build the URL of the current page with some query arguments replaced."""
+    args = request.args.to_dict()
+    args.update(changes)
+    return url_for(request.endpoint, **(request.view_args or {}), **args)
+
 # Error handlers
 @app.errorhandler(404)
 def page_not_found(e):
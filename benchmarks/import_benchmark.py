@@ -0,0 +1,89 @@
+"""
+Benchmark the bulk catalog import against adding books one at a time.
+
+Generates a synthetic CSV feed, a tenth of it repeating ISBNs seen earlier in
+the feed, and reports the rows per second of the previous per-row path
+(one ISBN lookup and one commit per book, as in ``POST /api/books``) on a
+sample, and of ``utils.imports.import_books`` on the whole feed. The
+database is taken from ``DATABASE_URL``; without it a throw-away SQLite
+file is used.
+
+    python benchmarks/import_benchmark.py --rows 500000
+    DATABASE_URL=postgresql://localhost/library_bench python benchmarks/import_benchmark.py
+"""
+import argparse
+import csv
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+if 'DATABASE_URL' not in os.environ:
+    _bench_dir = tempfile.mkdtemp(prefix='library-bench-')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_bench_dir, 'bench.db')}"
+
+from app import app, db  # noqa: E402
+from models import Book  # noqa: E402
+from utils.imports import IMPORT_CHUNK_SIZE, import_books  # noqa: E402
+
+
+def write_feed(path, rows, offset):
+    """Write a CSV feed of ``rows`` books, one in ten repeating an earlier ISBN."""
+    with open(path, 'w', newline='', encoding='utf-8') as feed:
+        writer = csv.writer(feed)
+        writer.writerow(['title', 'author', 'isbn', 'category', 'publication_year'])
+        for i in range(offset, offset + rows):
+            number = i - 5 if i % 10 == 0 and i - 5 >= offset else i
+            writer.writerow([f'Imported book {i}', f'Author {i % 500}', f'979{number:010d}',
+                             f'Category {i % 40}', 1900 + i % 120])
+
+
+def per_row(path, limit):
+    """Add the first ``limit`` books of a feed the way the single-book endpoint does."""
+    with open(path, newline='', encoding='utf-8') as feed:
+        for n, record in enumerate(csv.DictReader(feed)):
+            if n == limit:
+                break
+            if Book.query.filter_by(isbn=record['isbn']).first():
+                continue
+            db.session.add(Book(title=record['title'], author=record['author'], isbn=record['isbn'],
+                                category=record['category'],
+                                publication_year=int(record['publication_year']), available=True))
+            db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--sample', type=int, default=2000,
+                        help='Rows added one at a time for comparison.')
+    parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    feed_dir = tempfile.mkdtemp(prefix='library-feed-')
+    with app.app_context():
+        print(f"Backend: {db.engine.dialect.name}, feed of {args.rows} rows")
+        print(f"{'approach':<16}{'rows':>10}{'seconds':>10}{'rows/s':>10}")
+
+        sample = os.path.join(feed_dir, 'sample.csv')
+        write_feed(sample, args.sample, 0)
+        started = time.perf_counter()
+        per_row(sample, args.sample)
+        elapsed = time.perf_counter() - started
+        print(f"{'per row':<16}{args.sample:>10}{elapsed:>10.2f}{args.sample / elapsed:>10.0f}")
+
+        feed = os.path.join(feed_dir, 'feed.csv')
+        write_feed(feed, args.rows, 10 ** 8)
+        started = time.perf_counter()
+        with open(feed, newline='', encoding='utf-8') as stream:
+            report = import_books(stream, 'csv', args.chunk_size)
+        elapsed = time.perf_counter() - started
+        print(f"{'bulk import':<16}{report['rows']:>10}{elapsed:>10.2f}{report['rows'] / elapsed:>10.0f}")
+        print(f"Inserted {report['inserted']}, skipped {report['duplicates']} duplicates, "
+              f"{report['error_count']} errors.")
+
+
+if __name__ == '__main__':
+    main()
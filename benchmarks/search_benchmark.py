@@ -0,0 +1,99 @@
+"""
+Benchmark catalog search against a large synthetic catalog.
+
+Compares the previous ``ilike '%term%'`` filtering with the full-text index
+used by ``utils.search.search_books``. The database is taken from
+``DATABASE_URL``; without it a throw-away SQLite file is used.
+
+    python benchmarks/search_benchmark.py --books 300000
+    DATABASE_URL=postgresql://localhost/library_bench python benchmarks/search_benchmark.py
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+if 'DATABASE_URL' not in os.environ:
+    _bench_dir = tempfile.mkdtemp(prefix='library-bench-')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_bench_dir, 'bench.db')}"
+
+from sqlalchemy import insert, or_  # noqa: E402
+
+from app import app, db  # noqa: E402
+from models import Book  # noqa: E402
+from utils.search import search_books  # noqa: E402
+
+WORDS = [
+    'amour', 'guerre', 'nuit', 'mer', 'ville', 'histoire', 'secret', 'jardin',
+    'voyage', 'ombre', 'lumière', 'silence', 'royaume', 'étoile', 'hiver',
+    'python', 'données', 'science', 'cuisine', 'musique', 'enfant', 'rivière',
+    'montagne', 'dragon', 'mémoire', 'empire', 'chemin', 'temps', 'feu', 'océan',
+]
+AUTHORS = [
+    'Hugo', 'Zola', 'Camus', 'Sand', 'Verne', 'Dumas', 'Proust', 'Colette',
+    'Balzac', 'Flaubert', 'Duras', 'Sagan', 'Yourcenar', 'Maupassant', 'Stendhal',
+]
+QUERIES = ['python', 'hugo', 'dragon hiver', 'mém', 'Verne océan', '97812']
+
+
+def seed(count, batch_size=10000):
+    """Fill the book table with ``count`` synthetic titles."""
+    rng = random.Random(42)
+    existing = Book.query.count()
+    for start in range(existing, count, batch_size):
+        rows = []
+        for i in range(start, min(start + batch_size, count)):
+            rows.append({
+                'title': ' '.join(rng.sample(WORDS, 3)).capitalize() + f' {i}',
+                'author': f"{rng.choice(['Jean', 'Marie', 'Paul', 'Anne'])} {rng.choice(AUTHORS)}",
+                'isbn': f'978{i:010d}',
+                'category': rng.choice(['Roman', 'Essai', 'Jeunesse', 'Sciences']),
+                'available': True,
+            })
+        db.session.execute(insert(Book), rows)
+        db.session.commit()
+
+
+def ilike_search(term):
+    return Book.query.filter(
+        or_(
+            Book.title.ilike(f'%{term}%'),
+            Book.author.ilike(f'%{term}%'),
+            Book.isbn.ilike(f'%{term}%')
+        )
+    ).order_by(Book.title)
+
+
+def measure(build_query, term, repeat, limit):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        build_query(term).limit(limit).all()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--books', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--limit', type=int, default=50)
+    args = parser.parse_args()
+
+    with app.app_context():
+        print(f"Backend: {db.engine.dialect.name}, seeding {args.books} books...")
+        seed(args.books)
+        print(f"{'query':<16}{'ilike (ms)':>12}{'full-text (ms)':>16}")
+        for term in QUERIES:
+            baseline = measure(ilike_search, term, args.repeat, args.limit)
+            indexed = measure(lambda t: search_books(Book.query, t), term, args.repeat, args.limit)
+            print(f"{term:<16}{baseline:>12.2f}{indexed:>16.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Benchmark the notification transports, draining the outbox over SMTP.
+
+Queues synthetic notifications and reports the messages per second of the
+outbox delivered with a connection per batch (``NOTIFICATION_TRANSPORT=smtp``)
+and with the pooled, pipelined transport (``smtp-pool``), by one worker
+thread and by several. Messages go to the bundled ``SMTPSink`` unless a
+server is given with ``--host``. The database is taken from
+``DATABASE_URL``; without it a throw-away SQLite file is used.
+
+    python benchmarks/smtp_benchmark.py --messages 20000 --workers 8
+    python benchmarks/smtp_benchmark.py --host mail.example.org --port 2525 --rate-limit 200
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+if 'DATABASE_URL' not in os.environ:
+    _bench_dir = tempfile.mkdtemp(prefix='library-bench-')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_bench_dir, 'bench.db')}"
+
+from app import app, db  # noqa: E402
+from models import OutboxMessage  # noqa: E402
+from utils.outbox import OUTBOX_BATCH_SIZE, SMTPTransport, deliver_outbox, queue_notifications  # noqa: E402
+from utils.smtp_pool import PooledSMTPTransport, SMTPPool  # noqa: E402
+from utils.smtp_sink import SMTPSink  # noqa: E402
+
+
+def queue(messages):
+    """Empty the outbox and queue ``messages`` notifications."""
+    db.session.query(OutboxMessage).delete()
+    queue_notifications([(f'reader{i}@example.com', f'Notice {i}', f'Dear reader {i},\n\nYour book is due soon.')
+                         for i in range(messages)])
+    db.session.commit()
+
+
+def drain(transports, batch_size):
+    """Deliver the outbox with one thread per transport; returns the messages sent."""
+    sent = []
+
+    def worker(transport):
+        with app.app_context():
+            while True:
+                result = deliver_outbox(transport, batch_size)
+                if not sum(result.values()):
+                    break
+                sent.append(result['sent'])
+
+    threads = [threading.Thread(target=worker, args=(transport,)) for transport in transports]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(sent)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=4, help='Threads of the concurrent run.')
+    parser.add_argument('--batch-size', type=int, default=OUTBOX_BATCH_SIZE)
+    parser.add_argument('--rate-limit', type=float, default=0, help='Messages per second, 0 for no limit.')
+    parser.add_argument('--host', help='SMTP server to use instead of the bundled sink.')
+    parser.add_argument('--port', type=int, default=25)
+    args = parser.parse_args()
+
+    sink = None
+    if args.host is None:
+        sink = SMTPSink().start()
+        args.host, args.port = sink.host, sink.port
+
+    def per_batch():
+        return SMTPTransport(args.host, args.port, sender='library@example.com')
+
+    runs = [('per batch', 1, lambda pool: per_batch()),
+            ('pooled', 1, PooledSMTPTransport),
+            (f'pooled x{args.workers}', args.workers, PooledSMTPTransport)]
+
+    with app.app_context():
+        db.create_all()
+        print(f"Backend: {db.engine.dialect.name}, server {args.host}:{args.port}, {args.messages} messages")
+        print(f"{'approach':<16}{'messages':>10}{'seconds':>10}{'msg/s':>10}{'connections':>13}")
+        for name, workers, transport in runs:
+            queue(args.messages)
+            pool = SMTPPool(args.host, args.port, sender='library@example.com', size=workers,
+                            rate_limit=args.rate_limit)
+            started = time.perf_counter()
+            sent = drain([transport(pool) for _ in range(workers)], args.batch_size)
+            elapsed = time.perf_counter() - started
+            connections = pool.stats()['connections_opened'] if name != 'per batch' else -(-sent // args.batch_size)
+            pool.close()
+            print(f"{name:<16}{sent:>10}{elapsed:>10.2f}{sent / elapsed:>10.0f}{connections:>13}")
+
+    if sink is not None:
+        sink.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Benchmark the dashboard counters against a large synthetic library.
+
+Compares the previous one-COUNT-per-figure approach, the conditional
+aggregates of ``utils.statistics.count_statistics`` and the maintained
+counters read by ``utils.statistics.library_statistics``, reporting the
+number of queries and the median latency. The database is taken from
+``DATABASE_URL``; without it a throw-away SQLite file is used.
+
+    python benchmarks/statistics_benchmark.py --books 200000 --loans 500000
+    DATABASE_URL=postgresql://localhost/library_bench python benchmarks/statistics_benchmark.py
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+if 'DATABASE_URL' not in os.environ:
+    _bench_dir = tempfile.mkdtemp(prefix='library-bench-')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_bench_dir, 'bench.db')}"
+
+from sqlalchemy import event, insert  # noqa: E402
+
+from app import app, db  # noqa: E402
+from models import Book, Member, Loan  # noqa: E402
+from utils.statistics import count_statistics, library_statistics, reconcile_statistics  # noqa: E402
+
+
+def seed(books, members, loans, batch_size=10000):
+    """Fill the tables with synthetic rows, keeping existing ones."""
+    rng = random.Random(42)
+    now = datetime.utcnow()
+
+    for start in range(Book.query.count(), books, batch_size):
+        db.session.execute(insert(Book), [
+            {'title': f'Book {i}', 'author': f'Author {i % 500}', 'isbn': f'978{i:010d}',
+             'available': rng.random() > 0.3}
+            for i in range(start, min(start + batch_size, books))
+        ])
+        db.session.commit()
+
+    for start in range(Member.query.count(), members, batch_size):
+        db.session.execute(insert(Member), [
+            {'first_name': 'Member', 'last_name': f'{i}', 'email': f'member{i}@example.com',
+             'active': rng.random() > 0.1}
+            for i in range(start, min(start + batch_size, members))
+        ])
+        db.session.commit()
+
+    for start in range(Loan.query.count(), loans, batch_size):
+        rows = []
+        for _ in range(start, min(start + batch_size, loans)):
+            loan_date = now - timedelta(days=rng.randint(0, 720))
+            rows.append({
+                'book_id': rng.randint(1, books),
+                'member_id': rng.randint(1, members),
+                'loan_date': loan_date,
+                'due_date': loan_date + timedelta(days=14),
+                'returned': rng.random() > 0.1,
+            })
+        db.session.execute(insert(Loan), rows)
+        db.session.commit()
+
+    # Core inserts bypass the mapper events that maintain the counters
+    reconcile_statistics()
+    db.session.commit()
+
+
+def separate_counts():
+    """The counters as previously computed, one COUNT query each."""
+    now = datetime.utcnow()
+    return {
+        'total_books': Book.query.count(),
+        'available_books': Book.query.filter_by(available=True).count(),
+        'total_members': Member.query.count(),
+        'active_members': Member.query.filter_by(active=True).count(),
+        'total_loans': Loan.query.count(),
+        'active_loans': Loan.query.filter_by(returned=False).count(),
+        'overdue_loans': Loan.query.filter(Loan.returned == False, Loan.due_date < now).count(),
+    }
+
+
+def measure(compute, repeat):
+    """Return the median latency in milliseconds and the queries per call."""
+    statements = []
+
+    def count(*args):
+        statements.append(args)
+
+    timings = []
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            compute()
+            timings.append((time.perf_counter() - started) * 1000)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+    return statistics.median(timings), len(statements) // repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--members', type=int, default=20000)
+    parser.add_argument('--loans', type=int, default=300000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with app.app_context():
+        print(f"Backend: {db.engine.dialect.name}, seeding {args.books} books, "
+              f"{args.members} members and {args.loans} loans...")
+        seed(args.books, args.members, args.loans)
+        print(f"{'approach':<24}{'queries':>8}{'median (ms)':>14}")
+        for name, compute in (('separate COUNTs', separate_counts),
+                              ('conditional aggregates', count_statistics),
+                              ('maintained counters', library_statistics)):
+            latency, queries = measure(compute, args.repeat)
+            print(f"{name:<24}{queries:>8}{latency:>14.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+import threading
+
+import click
+
+from app import app, db
+from utils.imports import IMPORT_CHUNK_SIZE, IMPORT_FORMATS
+from utils.scheduler import JOBS, SCHEDULER_POLL
+
+
+@app.cli.command('repair-counters')
+def repair_counters_command():
+    """Recompute the book and member loan counters from the loan table."""
+    from models import repair_loan_counters
+
+    fixed = repair_loan_counters()
+    db.session.commit()
+    click.echo(f"Corrected {fixed['books']} book and {fixed['members']} member counters.")
+
+
+@app.cli.command('reconcile-stats')
+def reconcile_stats_command():
+    """Rebuild the library statistics counters and report any drift."""
+    from utils.statistics import reconcile_statistics
+
+    drift = reconcile_statistics()
+    db.session.commit()
+    if not drift:
+        click.echo("Statistics counters are up to date.")
+    for name, (stored, actual) in drift.items():
+        click.echo(f"{name}: {stored} -> {actual} ({actual - (stored or 0):+d})")
+
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Recompute the daily and monthly activity rollups from the source tables."""
+    from utils.rollups import rebuild_rollups
+
+    totals = rebuild_rollups()
+    db.session.commit()
+    for metric, count in totals.items():
+        click.echo(f"{metric}: {count}")
+
+
+@app.cli.command('expire-popularity')
+def expire_popularity_command():
+    """Slide the popularity windows forward to today."""
+    from utils.popularity import expire_popularity
+
+    moved = expire_popularity()
+    db.session.commit()
+    click.echo(f"Moved {moved} popularity windows.")
+
+
+@app.cli.command('rebuild-popularity')
+def rebuild_popularity_command():
+    """Recompute the popularity windows from the loan table."""
+    from utils.popularity import rebuild_popularity
+
+    loans = rebuild_popularity()
+    db.session.commit()
+    click.echo(f"Counted {loans} recent loans.")
+
+
+@app.cli.command('purge-idempotency-keys')
+def purge_idempotency_keys_command():
+    """Delete the expired idempotency keys of the API."""
+    from utils.idempotency import purge_expired_keys
+
+    purged = purge_expired_keys()
+    click.echo(f"Deleted {purged} expired idempotency keys.")
+
+
+def _run_import(importer, source, fmt, chunk_size, dry_run, errors):
+    """Run a bulk import from the command line and print its report."""
+    from utils.imports import error_report_csv, import_format
+
+    fmt = fmt or import_format(source.name)
+    if fmt is None:
+        raise click.UsageError("Cannot tell the format of the input, use --format.")
+
+    report = importer(source, fmt, chunk_size, dry_run)
+    if errors:
+        errors.write(error_report_csv(report))
+    else:
+        for error in report['errors']:
+            click.echo(f"line {error['line']}: {error['error']}", err=True)
+    return report
+
+
+def _import_options(command):
+    """Add the options shared by the import commands."""
+    for option in reversed((
+        click.argument('source', type=click.File('r', encoding='utf-8-sig')),
+        click.option('--format', 'fmt', type=click.Choice(IMPORT_FORMATS),
+                     help='Input format, guessed from the file extension by default.'),
+        click.option('--chunk-size', default=IMPORT_CHUNK_SIZE, show_default=True,
+                     help='Rows inserted per statement.'),
+        click.option('--dry-run', is_flag=True, help='Only validate the input.'),
+        click.option('--errors', type=click.File('w', encoding='utf-8'),
+                     help='Write the rejected lines to this CSV file.'),
+    )):
+        command = option(command)
+    return command
+
+
+@app.cli.command('import-books')
+@_import_options
+def import_books_command(source, fmt, chunk_size, dry_run, errors):
+    """Add the books of a CSV or NDJSON file (or - for stdin) to the catalog."""
+    from utils.imports import import_books
+
+    report = _run_import(import_books, source, fmt, chunk_size, dry_run, errors)
+    click.echo(f"Read {report['rows']} rows: {report['inserted']} books "
+               f"{'valid' if dry_run else 'added'}, {report['duplicates']} duplicates, "
+               f"{report['error_count']} errors.")
+
+
+@app.cli.command('import-members')
+@_import_options
+def import_members_command(source, fmt, chunk_size, dry_run, errors):
+    """Register the members of a CSV or NDJSON file (or - for stdin)."""
+    from utils.imports import import_members
+
+    report = _run_import(import_members, source, fmt, chunk_size, dry_run, errors)
+    click.echo(f"Read {report['rows']} rows: {report['inserted']} members "
+               f"{'valid' if dry_run else 'added'}, {report['duplicates']} duplicates, "
+               f"{report['error_count']} errors.")
+
+
+@app.cli.command('deliver-notifications')
+@click.option('--once', is_flag=True, help='Deliver the due messages, then exit.')
+@click.option('--interval', type=int, default=None, help='Seconds between polls of an empty outbox.')
+@click.option('--workers', type=int, default=1, show_default=True, help='Delivery threads of the worker process.')
+def deliver_notifications_command(once, interval, workers):
+    """Deliver the queued notifications, as a worker process unless --once is given."""
+    from utils.outbox import create_transport, deliver_outbox, run_outbox_worker
+
+    if not once:
+        interval = interval or app.config["NOTIFICATION_POLL_INTERVAL"]
+        threads = [threading.Thread(target=run_outbox_worker, args=(app, interval), daemon=True)
+                   for _ in range(workers - 1)]
+        for thread in threads:
+            thread.start()
+        run_outbox_worker(app, interval)
+        return
+
+    transport = create_transport(app.config)
+    totals = {'sent': 0, 'retried': 0, 'failed': 0}
+    while True:
+        result = deliver_outbox(transport, app.config["OUTBOX_BATCH_SIZE"])
+        for outcome, count in result.items():
+            totals[outcome] += count
+        if not sum(result.values()):
+            break
+    click.echo(f"Sent {totals['sent']} notifications, {totals['retried']} to retry, {totals['failed']} failed.")
+
+
+@app.cli.command('run-scheduler')
+def run_scheduler_command():
+    """Run the scheduled jobs on their cadence, as a worker process."""
+    from utils.scheduler import run_scheduler
+
+    run_scheduler(app, app.config["SCHEDULER_INTERVAL"] or SCHEDULER_POLL)
+
+
+@app.cli.command('run-job')
+@click.argument('name', type=click.Choice(list(JOBS)))
+def run_job_command(name):
+    """Run one scheduled job now, over the time elapsed since its last run."""
+    from utils.scheduler import run_job
+
+    count = run_job(name)
+    if count is None:
+        click.echo(f"{name} is up to date.")
+    else:
+        click.echo(f"{name}: {count} processed.")
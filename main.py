@@ -1,4 +1,10 @@
-from app import app  # noqa: F401
+import os
+
+from app import app, start_background_workers
+
+# Under the debug reloader, only the child process serving the requests runs them
+if __name__ != "__main__" or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+    start_background_workers(app)
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -1,7 +1,24 @@
+from collections import Counter
 from datetime import datetime, timedelta
 from app import db
 from flask_login import UserMixin
+from sqlalchemy import and_, case, event, func, select, update
+from sqlalchemy.ext.hybrid import hybrid_method, hybrid_property
+from sqlalchemy.orm import Session, attributes, object_session
+from sqlalchemy.orm.util import identity_key
 from werkzeug.security import generate_password_hash, check_password_hash
+from utils.search import register_search_index
+from utils.sql import days_between
+from utils.statistics import STAT_COUNTERS, adjust_statistics
+from utils.rollups import adjust_rollups
+from utils.popularity import adjust_popularity
+from utils.cache import invalidate_on_commit
+
+# Fine charged per day for an overdue loan
+DAILY_FINE_RATE = 0.50
+
+# Cache key and tag of the identity loaded for each logged-in user
+USER_CACHE_TAG = 'user:{}'
 
 
 class User(UserMixin, db.Model):
@@ -54,6 +71,15 @@ class User(UserMixin, db.Model):
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
 
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _user_written(mapper, connection, user):
+    # Role, password and activation changes must reach the next request at once.
+    # Bulk statements on users bypass this and must call invalidate_on_commit.
+    invalidate_on_commit(object_session(user), USER_CACHE_TAG.format(user.id))
+
 class Book(db.Model):
     """Model representing a book in the library."""
     id = db.Column(db.Integer, primary_key=True)
@@ -63,10 +89,20 @@ class Book(db.Model):
     category = db.Column(db.String(50))
     publication_year = db.Column(db.Integer)
     description = db.Column(db.Text)
-    available = db.Column(db.Boolean, default=True)
+    # Previous value is loaded on change to keep the library statistics in step
+    available = db.column_property(db.Column(db.Boolean, default=True), active_history=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    # Loan counters, maintained with each loan change (see _update_loan_counters)
+    active_loan_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    total_loan_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    
+    # Incremented by every edit and checkout; an UPDATE based on a stale read
+    # matches no row and fails with StaleDataError (see utils.circulation)
+    version_id = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    __mapper_args__ = {'version_id_col': version_id}
+    
     # Relationship
     loans = db.relationship('Loan', backref='book', lazy=True, cascade="all, delete-orphan")
     
@@ -89,10 +125,18 @@ class Book(db.Model):
             'description': self.description,
             'available': self.available,
             'created_at': self.created_at.isoformat() if self.created_at else None,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None,
+            'version': self.version_id
         }
 
 
+# Keep the full-text search index in step with the book table
+register_search_index(Book.__table__)
+
+# Stable sort order used by keyset pagination
+db.Index('ix_book_title_id', Book.title, Book.id)
+
+
 class Member(db.Model):
     """Model representing a library member."""
     id = db.Column(db.Integer, primary_key=True)
@@ -101,11 +145,16 @@ class Member(db.Model):
     email = db.Column(db.String(100), unique=True, nullable=False)
     phone = db.Column(db.String(20))
     address = db.Column(db.String(200))
-    registration_date = db.Column(db.DateTime, default=datetime.utcnow)
-    active = db.Column(db.Boolean, default=True)
+    # Previous value is loaded on change to keep the activity rollups in step
+    registration_date = db.column_property(db.Column(db.DateTime, default=datetime.utcnow), active_history=True)
+    # Previous value is loaded on change to keep the library statistics in step
+    active = db.column_property(db.Column(db.Boolean, default=True), active_history=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    # Loan counter, maintained with each loan change (see _update_loan_counters)
+    active_loan_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    
     # Relationships
     loans = db.relationship('Loan', backref='member', lazy=True, cascade="all, delete-orphan")
     user = db.relationship('User', backref='member_profile', uselist=False, lazy=True)
@@ -119,13 +168,50 @@ class Member(db.Model):
     
     def count_active_loans(self):
         """Count how many books the member currently has on loan."""
-        return Loan.query.filter_by(member_id=self.id, returned=False).count()
+        return self.active_loan_count
     
     def has_overdue_loans(self):
         """Check if the member has any overdue loans."""
+        if not self.active_loan_count:
+            return False
         today = datetime.utcnow().date()
         return any(loan.due_date.date() < today for loan in self.loans if not loan.returned)
     
+    @hybrid_property
+    def overdue_loan_count(self):
+        """Number of loans past their due date, usable in queries as a subquery."""
+        return Loan.query.filter(
+            Loan.member_id == self.id,
+            Loan.returned == False,
+            Loan.due_date < datetime.utcnow()
+        ).count()
+    
+    @overdue_loan_count.expression
+    def overdue_loan_count(cls):
+        return select(func.count(Loan.id)).where(
+            Loan.member_id == cls.id,
+            Loan.is_overdue()
+        ).correlate_except(Loan).scalar_subquery()
+    
+    @classmethod
+    def loan_counts_subquery(cls):
+        """
+        Build a subquery with the active and overdue loan counts of every borrowing member.
+        
+        Joining it onto a member query (outer join on ``member_id``) yields the
+        counts of a whole page of members in one grouped query.
+        
+        Returns:
+            Subquery: Columns ``member_id``, ``active_loans`` and ``overdue_loans``
+        """
+        return db.session.query(
+            Loan.member_id.label('member_id'),
+            func.count(Loan.id).label('active_loans'),
+            func.count(case((Loan.is_overdue(), 1))).label('overdue_loans')
+        ).filter(
+            Loan.returned == False
+        ).group_by(Loan.member_id).subquery()
+    
     def to_dict(self):
         """Convert member object to dictionary for API responses."""
         return {
@@ -142,80 +228,103 @@ class Member(db.Model):
         }
 
 
+# Case-insensitive prefix lookups used by the member typeahead
+db.Index('ix_member_last_name_lower', func.lower(Member.last_name))
+db.Index('ix_member_first_name_lower', func.lower(Member.first_name))
+db.Index('ix_member_email_lower', func.lower(Member.email))
+
+# Stable sort order used by keyset pagination
+db.Index('ix_member_name_id', Member.last_name, Member.first_name, Member.id)
+
+
 class Loan(db.Model):
     """Model representing a book loan transaction."""
     id = db.Column(db.Integer, primary_key=True)
-    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False)
-    member_id = db.Column(db.Integer, db.ForeignKey('member.id'), nullable=False)
-    loan_date = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    # Previous values are loaded when these change, so the loan counters can be moved
+    book_id = db.column_property(db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False, index=True),
+                                 active_history=True)
+    member_id = db.column_property(db.Column(db.Integer, db.ForeignKey('member.id'), nullable=False, index=True),
+                                   active_history=True)
+    # Previous values are loaded on change to keep the activity rollups in step
+    loan_date = db.column_property(db.Column(db.DateTime, default=datetime.utcnow, nullable=False),
+                                   active_history=True)
     due_date = db.Column(db.DateTime, nullable=False)
-    return_date = db.Column(db.DateTime, nullable=True)
-    returned = db.Column(db.Boolean, default=False)
+    return_date = db.column_property(db.Column(db.DateTime, nullable=True), active_history=True)
+    returned = db.column_property(db.Column(db.Boolean, default=False), active_history=True)
     notes = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    # Optimistic concurrency: two requests returning the same loan cannot both commit
+    version_id = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    __mapper_args__ = {'version_id_col': version_id}
+    
     def __repr__(self):
         return f'<Loan Book:{self.book_id} Member:{self.member_id}>'
     
-    def is_overdue(self):
+    # The methods below also build SQL expressions when called on the class,
+    # e.g. Loan.query.filter(Loan.is_overdue()) or func.sum(Loan.calculate_fine())
+    
+    @hybrid_method
+    def is_overdue(self, now=None):
         """Check if the loan is overdue."""
         if self.returned:
             return False
-        return datetime.utcnow() > self.due_date
+        return (now or datetime.utcnow()) > self.due_date
+    
+    @is_overdue.expression
+    def is_overdue(cls, now=None):
+        return and_(cls.returned == False, cls.due_date < (now or datetime.utcnow()))
     
-    def days_overdue(self):
+    @hybrid_method
+    def days_overdue(self, now=None):
         """Calculate how many days the loan is overdue."""
-        if not self.is_overdue():
+        now = now or datetime.utcnow()
+        if not self.is_overdue(now):
             return 0
-        delta = datetime.utcnow() - self.due_date
+        delta = now - self.due_date
         return delta.days
     
-    def calculate_fine(self, daily_rate=0.50):
+    @days_overdue.expression
+    def days_overdue(cls, now=None):
+        now = now or datetime.utcnow()
+        return case((cls.is_overdue(now), days_between(cls.due_date, now)), else_=0)
+    
+    @hybrid_method
+    def calculate_fine(self, daily_rate=DAILY_FINE_RATE, now=None):
         """Calculate the fine amount for an overdue loan."""
-        if not self.is_overdue():
+        now = now or datetime.utcnow()
+        if not self.is_overdue(now):
             return 0
-        return self.days_overdue() * daily_rate
+        return self.days_overdue(now) * daily_rate
+    
+    @calculate_fine.expression
+    def calculate_fine(cls, daily_rate=DAILY_FINE_RATE, now=None):
+        now = now or datetime.utcnow()
+        return case((cls.is_overdue(now), days_between(cls.due_date, now) * daily_rate), else_=0)
     
     @classmethod
     def create_loan(cls, book_id, member_id, loan_period_days=14):
         """Create a new loan with a calculated due date."""
-        loan_date = datetime.utcnow()
-        due_date = loan_date + timedelta(days=loan_period_days)
+        from utils.circulation import CirculationError, checkout_book
         
-        # Check if book is available
-        book = Book.query.get(book_id)
-        if not book or not book.available:
+        try:
+            new_loan = checkout_book(book_id, member_id, loan_period_days)
+        except CirculationError:
+            db.session.rollback()
             return None
         
-        # Update book availability
-        book.available = False
-        
-        # Create new loan
-        new_loan = cls(
-            book_id=book_id,
-            member_id=member_id,
-            loan_date=loan_date,
-            due_date=due_date
-        )
-        
-        db.session.add(new_loan)
         db.session.commit()
-        
         return new_loan
     
     def return_book(self):
         """Process a book return."""
-        if self.returned:
-            return False
+        from utils.circulation import CirculationError, return_loan
         
-        self.returned = True
-        self.return_date = datetime.utcnow()
-        
-        # Update book availability
-        book = Book.query.get(self.book_id)
-        if book:
-            book.available = True
+        try:
+            return_loan(self)
+        except CirculationError:
+            return False
         
         db.session.commit()
         return True
@@ -237,3 +346,374 @@ class Loan(db.Model):
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'updated_at': self.updated_at.isoformat() if self.updated_at else None
         }
+
+
+# Stable sort order used by keyset pagination
+db.Index('ix_loan_loan_date_id', Loan.loan_date, Loan.id)
+
+# Overdue loans are counted from a range of this index
+db.Index('ix_loan_returned_due_date', Loan.returned, Loan.due_date)
+
+
+class LibraryStat(db.Model):
+    """A library-wide counter, kept up to date by the mapper events below."""
+    __tablename__ = 'library_stats'
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<LibraryStat {self.name}={self.value}>'
+
+
+class DailyStat(db.Model):
+    """Activity of one day for a metric of utils/rollups.py."""
+    __tablename__ = 'daily_stats'
+    metric = db.Column(db.String(30), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<DailyStat {self.metric} {self.day}={self.value}>'
+
+
+class MonthlyStat(db.Model):
+    """Activity of one month (keyed by its first day) for a metric of utils/rollups.py."""
+    __tablename__ = 'monthly_stats'
+    metric = db.Column(db.String(30), primary_key=True)
+    month = db.Column(db.Date, primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<MonthlyStat {self.metric} {self.month}={self.value}>'
+
+
+class JobState(db.Model):
+    """Progress of an incremental background job, e.g. the last period it processed."""
+    __tablename__ = 'job_state'
+    name = db.Column(db.String(50), primary_key=True)
+    watermark = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Outcome of the last run of a scheduled job (see utils/scheduler.py)
+    last_run_at = db.Column(db.DateTime)
+    last_duration = db.Column(db.Float)  # seconds
+    last_count = db.Column(db.Integer)
+    last_error = db.Column(db.String(255))
+    
+    def __repr__(self):
+        return f'<JobState {self.name} {self.watermark}>'
+
+
+class PopularityDaily(db.Model):
+    """Loans of one book, category or member on one day (see utils/popularity.py)."""
+    __tablename__ = 'popularity_daily'
+    kind = db.Column(db.String(10), primary_key=True)
+    key = db.Column(db.String(50), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    loans = db.Column(db.Integer, nullable=False, default=0)
+
+
+class PopularityWindow(db.Model):
+    """Loans of one book, category or member over a sliding window of days."""
+    __tablename__ = 'popularity_window'
+    window_days = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(10), primary_key=True)
+    key = db.Column(db.String(50), primary_key=True)
+    loans = db.Column(db.Integer, nullable=False, default=0)
+
+
+# Top-K reads walk this index from the highest count
+db.Index('ix_popularity_window_top', PopularityWindow.window_days, PopularityWindow.kind,
+         PopularityWindow.loans)
+
+# Expired days are read and pruned by day
+db.Index('ix_popularity_daily_day', PopularityDaily.day)
+
+
+class IdempotencyKey(db.Model):
+    """Outcome of a mutating API request, replayed to retries with the same Idempotency-Key."""
+    __tablename__ = 'idempotency_keys'
+    key = db.Column(db.String(255), primary_key=True)
+    # Hash of the method, path and body, so that a key cannot be reused for another request
+    fingerprint = db.Column(db.String(40), nullable=False)
+    # Null while the first request is still being processed
+    status_code = db.Column(db.SmallInteger)
+    body = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    
+    def __repr__(self):
+        return f'<IdempotencyKey {self.key} {self.status_code}>'
+
+
+# Expired keys are purged in expiry order
+db.Index('ix_idempotency_keys_expires_at', IdempotencyKey.expires_at)
+
+
+class OutboxMessage(db.Model):
+    """A notification written with the change it reports, delivered later by the outbox worker."""
+    __tablename__ = 'notification_outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    # pending, sending (claimed by a worker), sent or failed (out of attempts)
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    last_error = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    sent_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<OutboxMessage {self.id} {self.status}>'
+
+
+# Workers claim the due messages in the order they became due
+db.Index('ix_notification_outbox_due', OutboxMessage.status, OutboxMessage.next_attempt_at)
+
+
+class NotificationLedger(db.Model):
+    """A notice already queued for a loan, one row per loan, notice type and threshold day (see utils/ledger.py)."""
+    __tablename__ = 'notification_ledger'
+    # No foreign key: entries outlive deleted loans until they are pruned
+    loan_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    kind = db.Column(db.String(10), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    
+    def __repr__(self):
+        return f'<NotificationLedger {self.kind} {self.loan_id} {self.day}>'
+
+
+# Old entries are pruned by day
+db.Index('ix_notification_ledger_day', NotificationLedger.day)
+
+
+@event.listens_for(LibraryStat.__table__, 'after_create')
+def _create_stat_rows(target, connection, **kw):
+    # A new table starts with the other tables, so every counter starts at zero
+    connection.execute(target.insert(), [{'name': name, 'value': 0} for name in STAT_COUNTERS])
+
+
+def _adjust_counter(session, connection, model, id, column, delta):
+    """
+    Add ``delta`` to a counter column of one row, inside the current flush.
+
+    The row is updated in SQL so that concurrent loans do not lose updates;
+    an instance already loaded in the session is kept in step without
+    marking it dirty.
+    """
+    connection.execute(
+        update(model.__table__).where(model.__table__.c.id == id).values({
+            column: model.__table__.c[column] + delta,
+            # A counter change is not an edit of the record itself
+            'updated_at': model.__table__.c.updated_at
+        })
+    )
+    instance = session.identity_map.get(identity_key(model, id)) if session else None
+    if instance is not None and column in instance.__dict__:
+        attributes.set_committed_value(instance, column, instance.__dict__[column] + delta)
+
+
+def _update_loan_counters(connection, before, after, session):
+    """
+    Move the loan counters of books and members from one loan state to another.
+
+    Args:
+        connection (Connection): The connection of the flush in progress
+        before (tuple): ``(book_id, member_id, active)`` before the change, or None
+        after (tuple): ``(book_id, member_id, active)`` after the change, or None
+        session (Session): The session being flushed
+    """
+    if before == after:
+        return
+    for state, sign in ((before, -1), (after, 1)):
+        if state is None:
+            continue
+        book_id, member_id, active = state
+        if active:
+            _adjust_counter(session, connection, Book, book_id, 'active_loan_count', sign)
+            _adjust_counter(session, connection, Member, member_id, 'active_loan_count', sign)
+    if before is None or after is None or before[0] != after[0]:
+        for state, sign in ((before, -1), (after, 1)):
+            if state is not None:
+                _adjust_counter(session, connection, Book, state[0], 'total_loan_count', sign)
+
+
+def _value(instance, key, committed=False):
+    """Return an attribute value, or its value before the pending change if ``committed``."""
+    if committed:
+        history = attributes.get_history(instance, key)
+        if history.deleted:
+            return history.deleted[0]
+    return getattr(instance, key)
+
+
+def _loan_state(loan, committed=False):
+    """Return the counter-relevant ``(book_id, member_id, active)`` of a loan."""
+    return (_value(loan, 'book_id', committed), _value(loan, 'member_id', committed),
+            not _value(loan, 'returned', committed))
+
+
+def _popularity_buckets(connection, loan, committed=False):
+    """Return the ``(kind, key, day)`` popularity buckets a loan is counted in."""
+    book_id = _value(loan, 'book_id', committed)
+    loaned = _value(loan, 'loan_date', committed)
+    if book_id is None or loaned is None:
+        return set()
+    
+    # The book is usually in the session already; otherwise read its category
+    session = object_session(loan)
+    book = session.identity_map.get(identity_key(Book, book_id)) if session else None
+    if book is not None:
+        category = book.category
+    else:
+        category = connection.execute(select(Book.category).where(Book.id == book_id)).scalar()
+    
+    day = loaned.date()
+    return {
+        ('book', str(book_id), day),
+        ('category', category or '', day),
+        ('member', str(_value(loan, 'member_id', committed)), day)
+    }
+
+
+@event.listens_for(Loan, 'after_insert')
+def _loan_inserted(mapper, connection, loan):
+    _update_loan_counters(connection, None, _loan_state(loan), object_session(loan))
+    _record_change(loan, 'popularity_deltas', set(), _popularity_buckets(connection, loan))
+
+
+@event.listens_for(Loan, 'after_update')
+def _loan_updated(mapper, connection, loan):
+    _update_loan_counters(connection, _loan_state(loan, committed=True), _loan_state(loan),
+                          object_session(loan))
+    if any(attributes.get_history(loan, key).has_changes() for key in ('book_id', 'member_id', 'loan_date')):
+        _record_change(loan, 'popularity_deltas', _popularity_buckets(connection, loan, committed=True),
+                       _popularity_buckets(connection, loan))
+
+
+@event.listens_for(Loan, 'after_delete')
+def _loan_deleted(mapper, connection, loan):
+    _update_loan_counters(connection, _loan_state(loan, committed=True), None, object_session(loan))
+    _record_change(loan, 'popularity_deltas', _popularity_buckets(connection, loan, committed=True), set())
+
+
+def repair_loan_counters():
+    """
+    Recompute every book and member loan counter from the loan table.
+
+    Each counter is rewritten with one correlated UPDATE per column, only on
+    the rows that drifted. The caller commits.
+
+    Returns:
+        dict: Number of corrected counters per table ('books', 'members')
+    """
+    def count_loans(fk, active_only):
+        query = select(func.count(Loan.id)).where(fk)
+        if active_only:
+            query = query.where(Loan.returned == False)
+        return query.scalar_subquery()
+
+    fixes = [
+        ('books', Book, 'active_loan_count', count_loans(Loan.book_id == Book.id, True)),
+        ('books', Book, 'total_loan_count', count_loans(Loan.book_id == Book.id, False)),
+        ('members', Member, 'active_loan_count', count_loans(Loan.member_id == Member.id, True)),
+    ]
+
+    fixed = {'books': 0, 'members': 0}
+    for key, model, column, actual in fixes:
+        counter = getattr(model, column)
+        result = db.session.execute(
+            update(model).where(counter != actual).values({
+                column: actual,
+                'updated_at': model.updated_at
+            }).execution_options(synchronize_session=False)
+        )
+        fixed[key] += result.rowcount
+    return fixed
+
+
+def _stat_names(instance, committed=False):
+    """Return the library counters a book, member or loan row is counted in."""
+    if isinstance(instance, Book):
+        table, flag = 'books', 'available' if _value(instance, 'available', committed) else None
+    elif isinstance(instance, Member):
+        table, flag = 'members', 'active' if _value(instance, 'active', committed) else None
+    else:
+        table, flag = 'loans', 'active' if not _value(instance, 'returned', committed) else None
+    names = {f'{table}.total'}
+    if flag:
+        names.add(f'{table}.{flag}')
+    return names
+
+
+def _rollup_buckets(instance, committed=False):
+    """Return the ``(metric, day)`` rollup buckets a member or loan row is counted in."""
+    buckets = set()
+    if isinstance(instance, Member):
+        registered = _value(instance, 'registration_date', committed)
+        if registered:
+            buckets.add(('registrations', registered.date()))
+    elif isinstance(instance, Loan):
+        loaned = _value(instance, 'loan_date', committed)
+        if loaned:
+            buckets.add(('loans', loaned.date()))
+        returned = _value(instance, 'return_date', committed)
+        if returned and _value(instance, 'returned', committed):
+            buckets.add(('returns', returned.date()))
+    return buckets
+
+
+def _record_change(instance, key, before, after):
+    """Queue the counter changes of one row; they are written once per flush."""
+    session = object_session(instance)
+    if session is None or before == after:
+        return
+    deltas = session.info.setdefault(key, Counter())
+    for name in before - after:
+        deltas[name] -= 1
+    for name in after - before:
+        deltas[name] += 1
+
+
+def _stats_inserted(mapper, connection, instance):
+    _record_change(instance, 'library_stat_deltas', set(), _stat_names(instance))
+    _record_change(instance, 'rollup_deltas', set(), _rollup_buckets(instance))
+
+
+def _stats_updated(mapper, connection, instance):
+    _record_change(instance, 'library_stat_deltas',
+                   _stat_names(instance, committed=True), _stat_names(instance))
+    _record_change(instance, 'rollup_deltas',
+                   _rollup_buckets(instance, committed=True), _rollup_buckets(instance))
+
+
+def _stats_deleted(mapper, connection, instance):
+    _record_change(instance, 'library_stat_deltas', _stat_names(instance, committed=True), set())
+    _record_change(instance, 'rollup_deltas', _rollup_buckets(instance, committed=True), set())
+
+
+for _model in (Book, Member, Loan):
+    event.listen(_model, 'after_insert', _stats_inserted)
+    event.listen(_model, 'after_update', _stats_updated)
+    event.listen(_model, 'after_delete', _stats_deleted)
+
+
+@event.listens_for(Session, 'after_flush')
+def _write_stat_changes(session, flush_context):
+    deltas = session.info.pop('library_stat_deltas', None)
+    if deltas:
+        adjust_statistics(session, deltas)
+    deltas = session.info.pop('rollup_deltas', None)
+    if deltas:
+        adjust_rollups(session, deltas)
+    deltas = session.info.pop('popularity_deltas', None)
+    if deltas:
+        adjust_popularity(session, deltas)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_stat_changes(session, previous_transaction):
+    session.info.pop('library_stat_deltas', None)
+    session.info.pop('rollup_deltas', None)
+    session.info.pop('popularity_deltas', None)
@@ -1,9 +1,13 @@
 from flask import Blueprint, render_template, redirect, url_for, flash
-from sqlalchemy import func, desc
-from datetime import datetime, timedelta
+from sqlalchemy import func, desc, or_
+from sqlalchemy.orm import joinedload
+from datetime import datetime
 
 from app import db
 from models import Book, Member, Loan
+from utils.statistics import library_statistics
+from utils.popularity import expire_popularity, top_popular
+from utils.scheduler import job_status
 
 # Créer le blueprint pour les routes d'administration
 admin = Blueprint('admin', __name__)
@@ -11,37 +15,42 @@ admin = Blueprint('admin', __name__)
 @admin.route('/dashboard')
 def dashboard():
     """Affiche le tableau de bord d'administration avec les statistiques globales."""
-    # Récupérer les statistiques de base
-    total_books = Book.query.count()
-    available_books = Book.query.filter_by(available=True).count()
-    total_members = Member.query.count()
-    active_members = Member.query.filter_by(active=True).count()
-    
-    # Récupérer les statistiques des emprunts
-    total_loans = Loan.query.count()
-    total_active_loans = Loan.query.filter_by(returned=False).count()
-    total_overdue_loans = Loan.query.filter(
-        Loan.returned == False,
-        Loan.due_date < datetime.utcnow()
-    ).count()
+    # Récupérer les statistiques des livres, membres et emprunts (une requête par table)
+    stats = library_statistics()
+    total_books = stats['books']['total']
+    available_books = stats['books']['available']
+    total_members = stats['members']['total']
+    active_members = stats['members']['active']
+    total_loans = stats['loans']['total']
+    total_active_loans = stats['loans']['active']
+    total_overdue_loans = stats['loans']['overdue']
     
     # Calculer les taux
     usage_rate = round((total_active_loans / total_books * 100)) if total_books > 0 else 0
     overdue_rate = round((total_overdue_loans / total_active_loans * 100)) if total_active_loans > 0 else 0
     
-    # Récupérer les emprunts récents (15 derniers)
-    recent_loans = Loan.query.order_by(desc(Loan.loan_date)).limit(15).all()
+    # Récupérer les emprunts récents (15 derniers) avec leurs livres et membres
+    recent_loans = Loan.query.options(
+        joinedload(Loan.book), joinedload(Loan.member)
+    ).order_by(desc(Loan.loan_date)).limit(15).all()
+    
+    # Récupérer les catégories les plus empruntées sur un an, depuis les fenêtres maintenues
+    if expire_popularity():
+        db.session.commit()
+    top_categories = top_popular('category', 365, 5)
     
-    # Récupérer les catégories populaires
-    category_stats = db.session.query(
-        Book.category,
-        func.count(Book.id).label('book_count'),
-        func.count(Loan.id).label('loan_count')
-    ).outerjoin(Loan).group_by(Book.category).order_by(desc('loan_count')).limit(5).all()
+    # Nombre de livres des seules catégories affichées
+    names = [category for category, _ in top_categories]
+    in_categories = Book.category.in_([name for name in names if name])
+    if '' in names:
+        in_categories = or_(in_categories, Book.category.is_(None))
+    book_counts = dict(db.session.query(
+        func.coalesce(Book.category, ''), func.count(Book.id)
+    ).filter(in_categories).group_by(Book.category).all())
     
     popular_categories = [
-        (category or "Non catégorisé", book_count, loan_count)
-        for category, book_count, loan_count in category_stats
+        (category or "Non catégorisé", book_counts.get(category, 0), loan_count)
+        for category, loan_count in top_categories
     ]
     
     return render_template(
@@ -71,11 +80,17 @@ def system_status():
     # Heure actuelle pour afficher les informations de timing
     current_time = datetime.utcnow()
     
+    # Dernière exécution, durée et nombre de notifications des tâches planifiées
+    jobs = {job['name']: job for job in job_status()}
+    recent_runs = sorted((job for job in jobs.values() if job['last_run_at']),
+                         key=lambda job: job['last_run_at'], reverse=True)
+    
     return render_template(
         'admin/system_status.html',
         book_count=book_count,
         member_count=member_count,
         loan_count=loan_count,
         current_time=current_time,
-        timedelta=timedelta  # Passer timedelta pour les calculs de temps dans le template
+        jobs=jobs,
+        recent_runs=recent_runs
     )
\ No newline at end of file
@@ -1,29 +1,173 @@
-from flask import Blueprint, jsonify, request
-from app import db
+import io
+
+from flask import Blueprint, Response, jsonify, request
+from app import cache, db
 from models import Book, Member, Loan
-from datetime import datetime, timedelta
-from sqlalchemy import or_
+from datetime import date, datetime, timedelta
+from sqlalchemy import case, func, or_
+from sqlalchemy.orm.exc import StaleDataError
+from utils.search import search_books, search_relevance, search_tokens, prefix_filter
+from utils.pagination import InvalidCursor, keyset_paginate
+from utils.conditional import conditional_json, make_etag
+from utils.cache import request_key
+from utils.idempotency import idempotent
+from utils.imports import IMPORT_FORMATS, error_report_csv, import_books, import_format, import_members
+from utils.statistics import library_statistics
+from utils.rollups import ROLLUP_BUCKETS, ROLLUP_METRICS, refresh_overdue_rollup, rollup_series
+from utils.popularity import POPULARITY_WINDOWS, expire_popularity, top_popular
+from utils.circulation import (MAX_BATCH_ITEMS, CirculationError, checkout_book, checkout_books, refresh_loans,
+                               return_books, return_loan)
+from utils.notifications import queue_batch_loan_confirmation, queue_batch_return_confirmation
+from utils.outbox import delivery_stats
 
 api_bp = Blueprint('api', __name__)
 
+# Typeahead suggestions are small, bounded and briefly cacheable by the browser
+SUGGEST_LIMIT = 10
+SUGGEST_MAX_LIMIT = 25
+SUGGEST_MAX_AGE = 30
+
+# Time series default to the last month of days or the last year of months
+TIMESERIES_DEFAULT_DAYS = {'day': 29, 'month': 334}
+TIMESERIES_MAX_POINTS = 731
+
+# Popularity rankings cover the last 30 days unless another window is asked for
+POPULAR_WINDOW = 30
+POPULAR_LIMIT = 10
+POPULAR_MAX_LIMIT = 50
+
+# Cached statistics are invalidated by writes; this bounds how late the overdue count can be
+STATISTICS_TTL = 60
+
+def _suggest_limit():
+    """Read the requested number of suggestions, clamped to the allowed range."""
+    limit = request.args.get('limit', SUGGEST_LIMIT, type=int)
+    return max(1, min(limit, SUGGEST_MAX_LIMIT))
+
+def _suggest_response(key, items):
+    """Build a cacheable JSON response for a list of suggestions."""
+    response = jsonify({
+        'success': True,
+        'count': len(items),
+        key: items
+    })
+    response.cache_control.private = True
+    response.cache_control.max_age = SUGGEST_MAX_AGE
+    return response
+
+def _paginate(query, sort_keys):
+    """Fetch the page of a list endpoint selected by the cursor and limit arguments."""
+    return keyset_paginate(
+        query,
+        sort_keys,
+        cursor=request.args.get('cursor'),
+        limit=request.args.get('limit', type=int)
+    )
+
+def _collection_etag(query, model, *aggregates):
+    """
+    Build the validator of a list endpoint from aggregates of its filtered query.
+    
+    The row count catches deletions and the latest ``updated_at`` any insert
+    or edit, so a poll that changed nothing costs one aggregate query and
+    no serialization.
+    """
+    values = query.order_by(None).with_entities(
+        func.count(model.id), func.max(model.updated_at), *aggregates
+    ).one()
+    return make_etag(model.__tablename__, request.query_string.decode('utf-8'), *values)
+
+def _import_response(importer, kind):
+    """
+    Run a bulk import on the request body or its ``file`` upload.
+    
+    ``?dry_run=true`` only validates the input. ``?report=csv`` answers
+    with the rejected lines as a downloadable CSV instead of the JSON report.
+    """
+    upload = request.files.get('file')
+    fmt = request.args.get('format') or import_format(upload.filename if upload else None,
+                                                      upload.mimetype if upload else request.mimetype)
+    if fmt not in IMPORT_FORMATS:
+        return jsonify({
+            'success': False,
+            'error': f"Unsupported import format, expected one of: {', '.join(IMPORT_FORMATS)}"
+        }), 400
+    
+    stream = io.TextIOWrapper(upload.stream if upload else request.stream, encoding='utf-8-sig', newline='')
+    report = importer(stream, fmt, dry_run=request.args.get('dry_run', '').lower() == 'true')
+    
+    if request.args.get('report') == 'csv':
+        return Response(error_report_csv(report), mimetype='text/csv', headers={
+            'Content-Disposition': f'attachment; filename={kind}-import-errors.csv'
+        })
+    return jsonify({
+        'success': True,
+        **report
+    })
+
+def _batch_items(data):
+    """Read the member and book ids of a circulation desk batch, returning an error if invalid."""
+    member_id = data.get('member_id')
+    book_ids = data.get('book_ids')
+    if not isinstance(member_id, int):
+        return None, None, 'Missing required field: member_id'
+    if not isinstance(book_ids, list) or not book_ids or not all(isinstance(id, int) for id in book_ids):
+        return None, None, 'book_ids must be a non-empty list of book ids'
+    if len(book_ids) > MAX_BATCH_ITEMS:
+        return None, None, f'A batch is limited to {MAX_BATCH_ITEMS} books'
+    return member_id, book_ids, None
+
+def _batch_results(results):
+    """Serialize the per-item results of a circulation batch."""
+    items = []
+    for result in results:
+        item = {key: value for key, value in result.items() if key not in ('loan', 'book')}
+        if result['success']:
+            item['loan'] = result['loan'].to_dict()
+        items.append(item)
+    return items
+
+def _book_conflict():
+    """Answer an edit based on an outdated version of a book."""
+    return jsonify({
+        'success': False,
+        'error': 'This book was changed by another request, reload it and retry'
+    }), 409
+
+def _loan_validators(loan, now):
+    """Return the ETag and Last-Modified of a loan, whose overdue figures change with time."""
+    days_overdue = loan.days_overdue(now)
+    last_modified = loan.updated_at
+    if loan.is_overdue(now):
+        # The representation last changed when the loan became overdue or its fine last grew
+        became = loan.due_date + timedelta(days=days_overdue)
+        last_modified = max(last_modified, became) if last_modified else became
+    return make_etag('loan', loan.id, loan.updated_at, loan.is_overdue(now), days_overdue), last_modified
+
+@api_bp.errorhandler(InvalidCursor)
+def invalid_cursor(e):
+    """Reject list requests carrying a cursor we did not issue."""
+    return jsonify({
+        'success': False,
+        'error': str(e)
+    }), 400
+
 # Book API endpoints
 @api_bp.route('/books', methods=['GET'])
 def get_books():
-    """Get all books with optional search parameters."""
+    """Get a page of books with optional search parameters."""
     search = request.args.get('search', '')
     category = request.args.get('category', '')
     available_only = request.args.get('available', '').lower() == 'true'
     
     query = Book.query
     
-    if search:
-        query = query.filter(
-            or_(
-                Book.title.ilike(f'%{search}%'),
-                Book.author.ilike(f'%{search}%'),
-                Book.isbn.ilike(f'%{search}%')
-            )
-        )
+    # Search results are paged by relevance, the full catalog by title; a term without words searches nothing
+    if search_tokens(search):
+        query = search_books(query, search, ordered=False)
+        sort_keys = [(search_relevance(search), False), (Book.id, False)]
+    else:
+        sort_keys = [(Book.title, False), (Book.id, False)]
     
     if category:
         query = query.filter(Book.category == category)
@@ -31,23 +175,54 @@ def get_books():
     if available_only:
         query = query.filter(Book.available == True)
     
-    books = query.all()
-    return jsonify({
-        'success': True,
-        'count': len(books),
-        'books': [book.to_dict() for book in books]
-    })
+    def page():
+        books, next_cursor = _paginate(query, sort_keys)
+        return {
+            'etag': _collection_etag(query, Book),
+            'body': {
+                'success': True,
+                'count': len(books),
+                'next_cursor': next_cursor,
+                'books': [book.to_dict() for book in books]
+            }
+        }
+    
+    # Loans also rewrite the availability of their book
+    entry = cache.get_or_set(request_key(), page, tags=('book', 'loan'))
+    return conditional_json(entry['etag'], lambda: entry['body'])
+
+@api_bp.route('/books/suggest', methods=['GET'])
+def suggest_books():
+    """Suggest available books whose title, author or ISBN start with the typed words."""
+    term = request.args.get('q', '')
+    if not search_tokens(term):
+        return _suggest_response('books', [])
+    
+    def suggestions():
+        query = search_books(Book.query.filter(Book.available == True), term)
+        rows = query.with_entities(
+            Book.id, Book.title, Book.author, Book.isbn, Book.category
+        ).limit(_suggest_limit()).all()
+        return [
+            {'id': id, 'title': title, 'author': author, 'isbn': isbn, 'category': category}
+            for id, title, author, isbn, category in rows
+        ]
+    
+    # Loans also rewrite the availability of their book
+    return _suggest_response('books', cache.get_or_set(request_key(), suggestions, tags=('book', 'loan')))
 
 @api_bp.route('/books/<int:id>', methods=['GET'])
 def get_book(id):
     """Get a specific book by ID."""
     book = Book.query.get_or_404(id)
-    return jsonify({
-        'success': True,
-        'book': book.to_dict()
-    })
+    return conditional_json(
+        make_etag('book', book.id, book.updated_at),
+        lambda: {'success': True, 'book': book.to_dict()},
+        book.updated_at
+    )
 
 @api_bp.route('/books', methods=['POST'])
+@idempotent
 def create_book():
     """Create a new book."""
     data = request.get_json()
@@ -89,12 +264,22 @@ def create_book():
         'book': new_book.to_dict()
     }), 201
 
+@api_bp.route('/books/import', methods=['POST'])
+def import_books_api():
+    """Import books in bulk from a CSV or NDJSON body or file upload."""
+    return _import_response(import_books, 'book')
+
 @api_bp.route('/books/<int:id>', methods=['PUT'])
+@idempotent
 def update_book(id):
     """Update an existing book."""
     book = Book.query.get_or_404(id)
     data = request.get_json()
     
+    # Clients sending the version they read get their edit refused if the book changed since
+    if 'version' in data and data['version'] != book.version_id:
+        return _book_conflict()
+    
     # Update fields if provided
     if 'title' in data:
         book.title = data['title']
@@ -119,7 +304,11 @@ def update_book(id):
     if 'available' in data:
         book.available = data['available']
     
-    db.session.commit()
+    try:
+        db.session.commit()
+    except StaleDataError:
+        db.session.rollback()
+        return _book_conflict()
     
     return jsonify({
         'success': True,
@@ -128,13 +317,13 @@ def update_book(id):
     })
 
 @api_bp.route('/books/<int:id>', methods=['DELETE'])
+@idempotent
 def delete_book(id):
     """Delete a book."""
     book = Book.query.get_or_404(id)
     
     # Check if the book has active loans
-    active_loans = Loan.query.filter_by(book_id=id, returned=False).count()
-    if active_loans > 0:
+    if book.active_loan_count > 0:
         return jsonify({
             'success': False,
             'error': 'Cannot delete a book that is currently on loan'
@@ -151,7 +340,7 @@ def delete_book(id):
 # Member API endpoints
 @api_bp.route('/members', methods=['GET'])
 def get_members():
-    """Get all members with optional search parameters."""
+    """Get a page of members with optional search parameters."""
     search = request.args.get('search', '')
     active_only = request.args.get('active', '').lower() == 'true'
     
@@ -169,23 +358,66 @@ def get_members():
     if active_only:
         query = query.filter(Member.active == True)
     
-    members = query.all()
-    return jsonify({
-        'success': True,
-        'count': len(members),
-        'members': [member.to_dict() for member in members]
-    })
+    def page():
+        members, next_cursor = _paginate(query, [
+            (Member.last_name, False), (Member.first_name, False), (Member.id, False)
+        ])
+        return {
+            'success': True,
+            'count': len(members),
+            'next_cursor': next_cursor,
+            'members': [member.to_dict() for member in members]
+        }
+    
+    return conditional_json(_collection_etag(query, Member), page)
+
+@api_bp.route('/members/suggest', methods=['GET'])
+def suggest_members():
+    """Suggest active members whose name or email start with the typed words."""
+    words = request.args.get('q', '').split()
+    if not words:
+        return _suggest_response('members', [])
+    
+    def suggestions():
+        # The first word drives the indexed lookup, the others narrow it down
+        query = Member.query.filter(
+            Member.active == True,
+            or_(
+                prefix_filter(Member.last_name, words[0]),
+                prefix_filter(Member.first_name, words[0]),
+                prefix_filter(Member.email, words[0])
+            )
+        )
+        for word in words[1:]:
+            query = query.filter(
+                or_(
+                    prefix_filter(Member.last_name, word),
+                    prefix_filter(Member.first_name, word)
+                )
+            )
+        
+        rows = query.with_entities(
+            Member.id, Member.first_name, Member.last_name, Member.email
+        ).order_by(Member.last_name, Member.first_name).limit(_suggest_limit()).all()
+        return [
+            {'id': id, 'first_name': first_name, 'last_name': last_name, 'email': email}
+            for id, first_name, last_name, email in rows
+        ]
+    
+    return _suggest_response('members', cache.get_or_set(request_key(), suggestions, tags=('member',)))
 
 @api_bp.route('/members/<int:id>', methods=['GET'])
 def get_member(id):
     """Get a specific member by ID."""
     member = Member.query.get_or_404(id)
-    return jsonify({
-        'success': True,
-        'member': member.to_dict()
-    })
+    return conditional_json(
+        make_etag('member', member.id, member.updated_at),
+        lambda: {'success': True, 'member': member.to_dict()},
+        member.updated_at
+    )
 
 @api_bp.route('/members', methods=['POST'])
+@idempotent
 def create_member():
     """Create a new member."""
     data = request.get_json()
@@ -198,8 +430,8 @@ def create_member():
                 'error': f'Missing required field: {field}'
             }), 400
     
-    # Check if email exists
-    if Member.query.filter_by(email=data['email']).first():
+    # Check if email exists, whatever its case
+    if Member.query.filter(func.lower(Member.email) == data['email'].strip().lower()).first():
         return jsonify({
             'success': False,
             'error': 'A member with this email already exists'
@@ -224,7 +456,13 @@ def create_member():
         'member': new_member.to_dict()
     }), 201
 
+@api_bp.route('/members/import', methods=['POST'])
+def import_members_api():
+    """Import members in bulk from a CSV or NDJSON body or file upload."""
+    return _import_response(import_members, 'member')
+
 @api_bp.route('/members/<int:id>', methods=['PUT'])
+@idempotent
 def update_member(id):
     """Update an existing member."""
     member = Member.query.get_or_404(id)
@@ -236,14 +474,13 @@ def update_member(id):
     if 'last_name' in data:
         member.last_name = data['last_name']
     if 'email' in data:
-        # Check if email exists and belongs to another member
-        if data['email']:
-            existing_member = Member.query.filter_by(email=data['email']).first()
-            if existing_member and existing_member.id != member.id:
-                return jsonify({
-                    'success': False,
-                    'error': 'A member with this email already exists'
-                }), 400
+        # Check if email belongs to another member, whatever its case
+        if data['email'] and Member.query.filter(func.lower(Member.email) == data['email'].strip().lower(),
+                                                 Member.id != member.id).first():
+            return jsonify({
+                'success': False,
+                'error': 'A member with this email already exists'
+            }), 400
         member.email = data['email']
     if 'phone' in data:
         member.phone = data['phone']
@@ -261,13 +498,13 @@ def update_member(id):
     })
 
 @api_bp.route('/members/<int:id>', methods=['DELETE'])
+@idempotent
 def delete_member(id):
     """Delete a member."""
     member = Member.query.get_or_404(id)
     
     # Check if the member has active loans
-    active_loans = Loan.query.filter_by(member_id=id, returned=False).count()
-    if active_loans > 0:
+    if member.active_loan_count > 0:
         return jsonify({
             'success': False,
             'error': 'Cannot delete a member who has active loans'
@@ -284,7 +521,7 @@ def delete_member(id):
 # Loan API endpoints
 @api_bp.route('/loans', methods=['GET'])
 def get_loans():
-    """Get all loans with optional filters."""
+    """Get a page of loans with optional filters, most recent first."""
     status = request.args.get('status', 'all')
     member_id = request.args.get('member_id')
     book_id = request.args.get('book_id')
@@ -296,8 +533,7 @@ def get_loans():
     elif status == 'returned':
         query = query.filter_by(returned=True)
     elif status == 'overdue':
-        now = datetime.utcnow()
-        query = query.filter(Loan.returned==False, Loan.due_date < now)
+        query = query.filter(Loan.is_overdue())
     
     if member_id:
         query = query.filter_by(member_id=member_id)
@@ -305,23 +541,37 @@ def get_loans():
     if book_id:
         query = query.filter_by(book_id=book_id)
     
-    loans = query.all()
-    return jsonify({
-        'success': True,
-        'count': len(loans),
-        'loans': [loan.to_dict() for loan in loans]
-    })
+    def page():
+        loans, next_cursor = _paginate(query, [(Loan.loan_date, True), (Loan.id, True)])
+        return {
+            'success': True,
+            'count': len(loans),
+            'next_cursor': next_cursor,
+            'loans': [loan.to_dict() for loan in loans]
+        }
+    
+    # Overdue figures grow with time without any row being updated
+    now = datetime.utcnow()
+    etag = _collection_etag(
+        query, Loan,
+        func.count(case((Loan.is_overdue(now), 1))),
+        func.sum(Loan.days_overdue(now))
+    )
+    return conditional_json(etag, page)
 
 @api_bp.route('/loans/<int:id>', methods=['GET'])
 def get_loan(id):
     """Get a specific loan by ID."""
     loan = Loan.query.get_or_404(id)
-    return jsonify({
-        'success': True,
-        'loan': loan.to_dict()
-    })
+    etag, last_modified = _loan_validators(loan, datetime.utcnow())
+    return conditional_json(
+        etag,
+        lambda: {'success': True, 'loan': loan.to_dict()},
+        last_modified
+    )
 
 @api_bp.route('/loans', methods=['POST'])
+@idempotent
 def create_loan():
     """Create a new loan."""
     data = request.get_json()
@@ -334,55 +584,21 @@ def create_loan():
                 'error': f'Missing required field: {field}'
             }), 400
     
-    book_id = data['book_id']
-    member_id = data['member_id']
     loan_days = data.get('loan_days', 14)
-    
-    # Check if book exists and is available
-    book = Book.query.get(book_id)
-    if not book:
+    if not isinstance(loan_days, int) or loan_days < 1:
         return jsonify({
             'success': False,
-            'error': 'Book not found'
-        }), 404
-    
-    if not book.available:
-        return jsonify({
-            'success': False,
-            'error': 'This book is not available for loan'
+            'error': 'loan_days must be a positive number'
         }), 400
     
-    # Check if member exists and is active
-    member = Member.query.get(member_id)
-    if not member:
+    try:
+        new_loan = checkout_book(data['book_id'], data['member_id'], loan_days, data.get('notes'))
+    except CirculationError as e:
+        db.session.rollback()
         return jsonify({
             'success': False,
-            'error': 'Member not found'
-        }), 404
-    
-    if not member.active:
-        return jsonify({
-            'success': False,
-            'error': 'This member is not active'
-        }), 400
-    
-    # Create new loan
-    loan_date = datetime.utcnow()
-    due_date = loan_date + timedelta(days=loan_days)
-    
-    new_loan = Loan(
-        book_id=book_id,
-        member_id=member_id,
-        loan_date=loan_date,
-        due_date=due_date,
-        returned=False,
-        notes=data.get('notes')
-    )
-    
-    # Update book availability
-    book.available = False
-    
-    db.session.add(new_loan)
+            'error': str(e)
+        }), e.status
     db.session.commit()
     
     return jsonify({
@@ -392,67 +608,265 @@ def create_loan():
     }), 201
 
 @api_bp.route('/loans/<int:id>/return', methods=['POST'])
+@idempotent
 def api_return_book(id):
     """Process a book return via API."""
     loan = Loan.query.get_or_404(id)
     
-    if loan.returned:
+    try:
+        fine = return_loan(loan)
+        db.session.commit()
+    except CirculationError as e:
         return jsonify({
             'success': False,
-            'error': 'This book has already been returned'
-        }), 400
+            'error': str(e)
+        }), e.status
+    except StaleDataError:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'error': 'This loan was changed by another request, please retry'
+        }), 409
     
-    # Process the return
-    loan.returned = True
-    loan.return_date = datetime.utcnow()
+    return jsonify({
+        'success': True,
+        'message': 'Book returned successfully',
+        'loan': loan.to_dict(),
+        'fine': fine
+    })
+
+@api_bp.route('/loans/batch', methods=['POST'])
+@idempotent
+def create_loans_batch():
+    """Lend several books to one member in a single transaction, with per-book results."""
+    data = request.get_json(silent=True) or {}
+    member_id, book_ids, error = _batch_items(data)
+    loan_days = data.get('loan_days', 14)
+    if not error and (not isinstance(loan_days, int) or loan_days < 1):
+        error = 'loan_days must be a positive number'
+    if error:
+        return jsonify({
+            'success': False,
+            'error': error
+        }), 400
     
-    # Update book availability
-    book = Book.query.get(loan.book_id)
-    if book:
-        book.available = True
+    try:
+        member, results = checkout_books(member_id, book_ids, loan_days, data.get('notes'))
+    except CirculationError as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), e.status
     
+    lent = [(result['loan'], result['book']) for result in results if result['success']]
+    if lent:
+        queue_batch_loan_confirmation(member, lent)
     db.session.commit()
+    refresh_loans([loan for loan, _ in lent])
     
     return jsonify({
         'success': True,
-        'message': 'Book returned successfully',
-        'loan': loan.to_dict(),
-        'fine': loan.calculate_fine() if loan.is_overdue() else 0
+        'lent': len(lent),
+        'failed': len(results) - len(lent),
+        'results': _batch_results(results)
+    }), 201 if lent else 200
+
+@api_bp.route('/returns/batch', methods=['POST'])
+@idempotent
+def create_returns_batch():
+    """Return several books of one member in a single transaction, with per-book results and fines."""
+    data = request.get_json(silent=True) or {}
+    member_id, book_ids, error = _batch_items(data)
+    if error:
+        return jsonify({
+            'success': False,
+            'error': error
+        }), 400
+    
+    try:
+        member, results, fine = return_books(member_id, book_ids)
+        returned = [(result['loan'], result['book']) for result in results if result['success']]
+        if returned:
+            queue_batch_return_confirmation(member, returned, fine)
+        db.session.commit()
+    except CirculationError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), e.status
+    except StaleDataError:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'error': 'These loans were changed by another request, please retry'
+        }), 409
+    
+    refresh_loans([loan for loan, _ in returned])
+    
+    return jsonify({
+        'success': True,
+        'returned': len(returned),
+        'failed': len(results) - len(returned),
+        'fine': round(fine, 2),
+        'results': _batch_results(results)
+    })
+
+# Fine API endpoints
+@api_bp.route('/fines/summary', methods=['GET'])
+def get_fines_summary():
+    """Get the outstanding fines of every member with overdue loans, highest first."""
+    now = datetime.utcnow()
+    fine = func.sum(Loan.calculate_fine(now=now))
+    
+    rows = db.session.query(
+        Member.id,
+        Member.first_name,
+        Member.last_name,
+        Member.email,
+        func.count(Loan.id),
+        func.sum(Loan.days_overdue(now)),
+        fine
+    ).join(Loan, Loan.member_id == Member.id).filter(
+        Loan.is_overdue(now)
+    ).group_by(Member.id).order_by(fine.desc(), Member.id).all()
+    
+    members = [{
+        'member_id': member_id,
+        'name': f"{first_name} {last_name}",
+        'email': email,
+        'overdue_loans': overdue_loans,
+        'days_overdue': days,
+        'fine': round(float(total), 2)
+    } for member_id, first_name, last_name, email, overdue_loans, days, total in rows]
+    
+    return jsonify({
+        'success': True,
+        'count': len(members),
+        'total': round(sum(member['fine'] for member in members), 2),
+        'members': members
     })
 
 @api_bp.route('/statistics', methods=['GET'])
 def get_statistics():
     """Get library statistics."""
-    total_books = Book.query.count()
-    available_books = Book.query.filter_by(available=True).count()
-    total_members = Member.query.count()
-    active_members = Member.query.filter_by(active=True).count()
-    
-    total_loans = Loan.query.count()
-    active_loans = Loan.query.filter_by(returned=False).count()
-    overdue_loans = Loan.query.filter(
-        Loan.returned == False,
-        Loan.due_date < datetime.utcnow()
-    ).count()
+    # The overdue count also grows with time, so it may lag by up to the TTL
+    statistics = cache.get_or_set(request_key(), library_statistics,
+                                  tags=('book', 'member', 'loan'), ttl=STATISTICS_TTL)
+    return jsonify({
+        'success': True,
+        'statistics': statistics
+    })
+
+@api_bp.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """Get the hit, miss and invalidation counters of the result cache."""
+    return jsonify({
+        'success': True,
+        'cache': cache.stats()
+    })
+
+@api_bp.route('/notifications/stats', methods=['GET'])
+def get_notification_stats():
+    """Get the outbox counts per status and the SMTP delivery metrics of this process."""
+    return jsonify({
+        'success': True,
+        'notifications': delivery_stats()
+    })
+
+@api_bp.route('/stats/timeseries', methods=['GET'])
+def get_stats_timeseries():
+    """Get the daily or monthly values of an activity metric, read from the rollups."""
+    metric = request.args.get('metric', 'loans')
+    bucket = request.args.get('bucket', 'day')
+    
+    if metric not in ROLLUP_METRICS:
+        return jsonify({
+            'success': False,
+            'error': f"Unknown metric, expected one of: {', '.join(ROLLUP_METRICS)}"
+        }), 400
+    
+    if bucket not in ROLLUP_BUCKETS:
+        return jsonify({
+            'success': False,
+            'error': f"Unknown bucket, expected one of: {', '.join(ROLLUP_BUCKETS)}"
+        }), 400
+    
+    try:
+        end = date.fromisoformat(request.args['to']) if request.args.get('to') else datetime.utcnow().date()
+        if request.args.get('from'):
+            start = date.fromisoformat(request.args['from'])
+        else:
+            start = end - timedelta(days=TIMESERIES_DEFAULT_DAYS[bucket])
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'error': 'Dates must use the YYYY-MM-DD format'
+        }), 400
     
+    if bucket == 'month':
+        points = (end.year - start.year) * 12 + end.month - start.month + 1
+    else:
+        points = (end - start).days + 1
+    if not 1 <= points <= TIMESERIES_MAX_POINTS:
+        return jsonify({
+            'success': False,
+            'error': f'The period must cover between 1 and {TIMESERIES_MAX_POINTS} {bucket}s'
+        }), 400
+    
+    if metric == 'overdues':
+        # Roll up the days that ended since the last request
+        if refresh_overdue_rollup():
+            db.session.commit()
+    
+    series = rollup_series(metric, start, end, bucket)
     return jsonify({
         'success': True,
-        'statistics': {
-            'books': {
-                'total': total_books,
-                'available': available_books,
-                'on_loan': total_books - available_books
-            },
-            'members': {
-                'total': total_members,
-                'active': active_members,
-                'inactive': total_members - active_members
-            },
-            'loans': {
-                'total': total_loans,
-                'active': active_loans,
-                'overdue': overdue_loans,
-                'returned': total_loans - active_loans
-            }
-        }
+        'metric': metric,
+        'bucket': bucket,
+        'from': series[0][0].isoformat(),
+        'to': end.isoformat(),
+        'series': [{'date': point.isoformat(), 'value': value} for point, value in series]
+    })
+
+@api_bp.route('/popular', methods=['GET'])
+def get_popular():
+    """Get the most borrowed books, categories and members over a sliding window."""
+    window = request.args.get('window', POPULAR_WINDOW, type=int)
+    if window not in POPULARITY_WINDOWS:
+        return jsonify({
+            'success': False,
+            'error': f"Unknown window, expected one of: {', '.join(map(str, POPULARITY_WINDOWS))}"
+        }), 400
+    limit = max(1, min(request.args.get('limit', POPULAR_LIMIT, type=int), POPULAR_MAX_LIMIT))
+    
+    # Slide the windows to today before reading them
+    if expire_popularity():
+        db.session.commit()
+    
+    top_books = top_popular('book', window, limit)
+    top_categories = top_popular('category', window, limit)
+    top_members = top_popular('member', window, limit)
+    
+    books = {book.id: book for book in Book.query.filter(Book.id.in_([int(key) for key, _ in top_books]))}
+    members = {member.id: member for member in Member.query.filter(Member.id.in_([int(key) for key, _ in top_members]))}
+    
+    return jsonify({
+        'success': True,
+        'window': window,
+        'books': [{
+            'id': book.id,
+            'title': book.title,
+            'author': book.author,
+            'loans': loans
+        } for book, loans in ((books.get(int(key)), loans) for key, loans in top_books) if book],
+        'categories': [{
+            'category': category or None,
+            'loans': loans
+        } for category, loans in top_categories],
+        'members': [{
+            'id': member.id,
+            'name': member.full_name(),
+            'loans': loans
+        } for member, loans in ((members.get(int(key)), loans) for key, loans in top_members) if member]
     })
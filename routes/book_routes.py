@@ -1,39 +1,56 @@
 from flask import Blueprint, render_template, redirect, url_for, request, flash
-from app import db
-from models import Book
-from sqlalchemy import or_
+from app import cache, db
+from models import Book, Loan
+from utils.search import search_books, search_relevance, search_tokens
+from utils.pagination import paginate_index
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm.exc import StaleDataError
 
 book_bp = Blueprint('books', __name__, url_prefix='/books')
 
+def _categories():
+    """List the distinct book categories, for the filter dropdown."""
+    categories = db.session.query(Book.category).distinct().order_by(Book.category).all()
+    return [cat[0] for cat in categories if cat[0]]  # Remove None values
+
 @book_bp.route('/')
 def index():
-    """Display all books with optional search functionality."""
+    """Display a page of books with optional search functionality."""
     search_term = request.args.get('search', '')
     category = request.args.get('category', '')
     
     # Query books based on search parameters
     query = Book.query
     
-    if search_term:
-        query = query.filter(
-            or_(
-                Book.title.ilike(f'%{search_term}%'),
-                Book.author.ilike(f'%{search_term}%'),
-                Book.isbn.ilike(f'%{search_term}%')
-            )
-        )
-    
     if category:
         query = query.filter(Book.category == category)
     
-    books = query.order_by(Book.title).all()
+    sortable = {
+        'title': Book.title,
+        'author': Book.author,
+        'category': Book.category,
+        'year': Book.publication_year
+    }
+    
+    # Search results are ranked by relevance unless another sort is chosen; a term without words searches nothing
+    default_sort = 'title'
+    if search_tokens(search_term):
+        query = search_books(query, search_term, ordered=False)
+        sortable['relevance'] = search_relevance(search_term)
+        default_sort = 'relevance'
+    
+    pagination, sort, direction = paginate_index(
+        query, request.args, sortable, default_sort, tiebreaker=Book.id
+    )
     
     # Get unique categories for filter dropdown
-    categories = db.session.query(Book.category).distinct().order_by(Book.category).all()
-    categories = [cat[0] for cat in categories if cat[0]]  # Remove None values
+    categories = cache.get_or_set('books.categories', _categories, tags=('book',))
     
     return render_template('books/index.html', 
-                          books=books, 
+                          books=pagination.items, 
+                          pagination=pagination,
+                          sort=sort,
+                          direction=direction,
                           search_term=search_term, 
                           selected_category=category,
                           categories=categories)
@@ -90,7 +107,9 @@ def create():
 @book_bp.route('/<int:id>')
 def show(id):
     """Show details of a specific book."""
-    book = Book.query.get_or_404(id)
+    book = Book.query.options(
+        selectinload(Book.loans).joinedload(Loan.member)
+    ).filter_by(id=id).first_or_404()
     return render_template('books/show.html', book=book)
 
 @book_bp.route('/<int:id>/edit', methods=['GET', 'POST'])
@@ -99,6 +118,12 @@ def edit(id):
     book = Book.query.get_or_404(id)
     
     if request.method == 'POST':
+        # Refuse edits made on a page loaded before another change to the book
+        version = request.form.get('version', type=int)
+        if version is not None and version != book.version_id:
+            flash('This book was changed by someone else meanwhile, please review and save again!', 'warning')
+            return redirect(url_for('books.edit', id=book.id))
+        
         # Extract form data
         book.title = request.form.get('title')
         book.author = request.form.get('author')
@@ -124,7 +149,12 @@ def edit(id):
                 flash('A book with this ISBN already exists!', 'danger')
                 return render_template('books/edit.html', book=book)
         
-        db.session.commit()
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            flash('This book was changed by someone else meanwhile, please review and save again!', 'warning')
+            return redirect(url_for('books.edit', id=book.id))
         flash('Book updated successfully!', 'success')
         return redirect(url_for('books.show', id=book.id))
     
@@ -136,7 +166,7 @@ def delete(id):
     book = Book.query.get_or_404(id)
     
     # Check if the book has active loans
-    if any(not loan.returned for loan in book.loans):
+    if book.active_loan_count > 0:
         flash('Cannot delete a book that is currently on loan!', 'danger')
         return redirect(url_for('books.show', id=book.id))
     
@@ -1,32 +1,39 @@
 from flask import Blueprint, render_template, redirect, url_for, request, flash
 from app import db
 from models import Loan, Book, Member
-from utils.notifications import send_notification
-from datetime import datetime, timedelta
-from sqlalchemy import or_
+from utils.outbox import queue_notification
+from utils.pagination import paginate_index
+from utils.circulation import CirculationError, checkout_book, return_loan
+from utils.scheduler import run_job
+from datetime import datetime
+from sqlalchemy import or_, case, func
+from sqlalchemy.orm import contains_eager
+from sqlalchemy.orm.exc import StaleDataError
 
 loan_bp = Blueprint('loans', __name__, url_prefix='/loans')
 
 @loan_bp.route('/')
 def index():
-    """Display all loans with optional filters."""
+    """Display a page of loans with optional filters."""
     status = request.args.get('status', 'all')
     search_term = request.args.get('search', '')
     
-    # Query loans based on filters
-    query = Loan.query
+    # Query loans based on filters; book and member are joined for search and sorting
+    # and loaded from the same rows, so rendering a page issues no extra queries
+    query = Loan.query.join(Book).join(Member).options(
+        contains_eager(Loan.book), contains_eager(Loan.member)
+    )
     
     if status == 'active':
         query = query.filter_by(returned=False)
     elif status == 'returned':
         query = query.filter_by(returned=True)
     elif status == 'overdue':
-        now = datetime.utcnow()
-        query = query.filter(Loan.returned==False, Loan.due_date < now)
+        query = query.filter(Loan.is_overdue())
     
     # Search by book title or member name
     if search_term:
-        query = query.join(Book).join(Member).filter(
+        query = query.filter(
             or_(
                 Book.title.ilike(f'%{search_term}%'),
                 Member.first_name.ilike(f'%{search_term}%'),
@@ -34,28 +41,71 @@ def index():
             )
         )
     
-    loans = query.order_by(Loan.loan_date.desc()).all()
+    summary = _loan_summary(query)
+    
+    pagination, sort, direction = paginate_index(
+        query,
+        request.args,
+        {
+            'loan_date': Loan.loan_date,
+            'due_date': Loan.due_date,
+            'book': Book.title,
+            'member': (Member.last_name, Member.first_name)
+        },
+        'loan_date',
+        default_direction='desc',
+        tiebreaker=Loan.id
+    )
     
     return render_template('loans/index.html', 
-                          loans=loans, 
+                          loans=pagination.items, 
+                          pagination=pagination,
+                          sort=sort,
+                          direction=direction,
+                          summary=summary,
                           status=status,
                           search_term=search_term)
 
+def _loan_summary(query):
+    """
+    Compute the summary figures of a filtered loan list with aggregate queries.
+    
+    Args:
+        query (Query): The filtered loan query, without ordering
+        
+    Returns:
+        dict: Total, active and overdue loan counts and the outstanding fines
+    """
+    now = datetime.utcnow()
+    
+    total, active, overdue_count, total_fines = query.with_entities(
+        func.count(Loan.id),
+        func.count(case((Loan.returned == False, 1))),
+        func.count(case((Loan.is_overdue(now), 1))),
+        func.coalesce(func.sum(Loan.calculate_fine(now=now)), 0)
+    ).one()
+    
+    return {
+        'total': total,
+        'active': active,
+        'overdue': overdue_count,
+        'fines': total_fines
+    }
+
 @loan_bp.route('/create', methods=['GET', 'POST'])
 def create():
     """Create a new loan."""
     if request.method == 'POST':
         # Extract form data
-        book_id = request.form.get('book_id')
-        member_id = request.form.get('member_id')
+        book_id = request.form.get('book_id', type=int)
+        member_id = request.form.get('member_id', type=int)
         loan_days = request.form.get('loan_days', '14')
         
         # Validate required fields
         if not book_id or not member_id:
             flash('Book and member are required!', 'danger')
-            books = Book.query.filter_by(available=True).order_by(Book.title).all()
-            members = Member.query.filter_by(active=True).order_by(Member.last_name).all()
-            return render_template('loans/create.html', books=books, members=members)
+            return _render_create_form(request.form.get('book_id', type=int),
+                                       request.form.get('member_id', type=int))
         
         # Validate loan days
         try:
@@ -64,50 +114,22 @@ def create():
                 raise ValueError("Loan days must be positive")
         except ValueError:
             flash('Loan period must be a positive number!', 'danger')
-            books = Book.query.filter_by(available=True).order_by(Book.title).all()
-            members = Member.query.filter_by(active=True).order_by(Member.last_name).all()
-            return render_template('loans/create.html', books=books, members=members)
-        
-        # Check if book exists and is available
-        book = Book.query.get(book_id)
-        if not book:
-            flash('Book not found!', 'danger')
-            return redirect(url_for('loans.create'))
+            return _render_create_form(request.form.get('book_id', type=int),
+                                       request.form.get('member_id', type=int))
         
-        if not book.available:
-            flash('This book is not available for loan!', 'danger')
-            return redirect(url_for('loans.create'))
-        
-        # Check if member exists and is active
-        member = Member.query.get(member_id)
-        if not member:
-            flash('Member not found!', 'danger')
-            return redirect(url_for('loans.create'))
-        
-        if not member.active:
-            flash('This member is not active!', 'danger')
+        try:
+            new_loan = checkout_book(book_id, member_id, loan_days)
+        except CirculationError as e:
+            db.session.rollback()
+            flash(f'{e}!', 'danger')
             return redirect(url_for('loans.create'))
         
-        # Create new loan
-        loan_date = datetime.utcnow()
-        due_date = loan_date + timedelta(days=loan_days)
-        
-        new_loan = Loan(
-            book_id=book_id,
-            member_id=member_id,
-            loan_date=loan_date,
-            due_date=due_date,
-            returned=False
-        )
-        
-        # Update book availability
-        book.available = False
-        
-        db.session.add(new_loan)
-        db.session.commit()
+        member = db.session.get(Member, member_id)
+        book = db.session.get(Book, book_id)
+        due_date = new_loan.due_date
         
-        # Send notification to member about the loan
-        send_notification(
+        # Notify the member about the loan, in the same transaction
+        queue_notification(
             member.email,
             'Book Loan Confirmation',
             f'Dear {member.full_name()},\n\n'
@@ -115,15 +137,25 @@ def create():
             f'Due date: {due_date.strftime("%Y-%m-%d")}.\n\n'
             f'Thank you for using our library services.'
         )
+        db.session.commit()
         
         flash('Loan created successfully!', 'success')
         return redirect(url_for('loans.show', id=new_loan.id))
     
     # GET request - display form
-    books = Book.query.filter_by(available=True).order_by(Book.title).all()
-    members = Member.query.filter_by(active=True).order_by(Member.last_name).all()
-    
-    return render_template('loans/create.html', books=books, members=members)
+    return _render_create_form(request.args.get('book_id', type=int),
+                               request.args.get('member_id', type=int))
+
+def _render_create_form(book_id=None, member_id=None):
+    """
+    Render the loan form with only the preselected book and member loaded.
+    
+    Other choices are fetched by the form from the suggestion API as the
+    librarian types, so the page size no longer depends on the catalog size.
+    """
+    book = Book.query.filter_by(id=book_id, available=True).first() if book_id else None
+    member = Member.query.filter_by(id=member_id, active=True).first() if member_id else None
+    return render_template('loans/create.html', book=book, member=member)
 
 @loan_bp.route('/<int:id>')
 def show(id):
@@ -136,35 +168,33 @@ def return_book(id):
     """Process a book return."""
     loan = Loan.query.get_or_404(id)
     
-    if loan.returned:
+    try:
+        fine = return_loan(loan)
+        # The fine was computed before the return
+        if fine > 0:
+            days_late = (loan.return_date - loan.due_date).days
+            # Notify the member about the fine, in the same transaction
+            member = loan.member
+            book = loan.book
+            queue_notification(
+                member.email,
+                'Overdue Book Return - Fine Notice',
+                f'Dear {member.full_name()},\n\n'
+                f'You have returned "{book.title}" by {book.author} {days_late} days late.\n'
+                f'A fine of ${fine:.2f} has been applied to your account.\n\n'
+                f'Thank you for using our library services.'
+            )
+        db.session.commit()
+    except CirculationError:
         flash('This book has already been returned!', 'warning')
         return redirect(url_for('loans.show', id=loan.id))
+    except StaleDataError:
+        db.session.rollback()
+        flash('This loan was changed by another request, please retry!', 'warning')
+        return redirect(url_for('loans.show', id=loan.id))
     
-    # Process the return
-    loan.returned = True
-    loan.return_date = datetime.utcnow()
-    
-    # Update book availability
-    book = Book.query.get(loan.book_id)
-    if book:
-        book.available = True
-    
-    db.session.commit()
-    
-    # Calculate fine if overdue
-    fine = loan.calculate_fine()
     if fine > 0:
-        # Send notification about the fine
-        member = Member.query.get(loan.member_id)
-        send_notification(
-            member.email,
-            'Overdue Book Return - Fine Notice',
-            f'Dear {member.full_name()},\n\n'
-            f'You have returned "{book.title}" by {book.author} {loan.days_overdue()} days late.\n'
-            f'A fine of ${fine:.2f} has been applied to your account.\n\n'
-            f'Thank you for using our library services.'
-        )
-        flash(f'Book returned successfully! A fine of ${fine:.2f} has been applied for {loan.days_overdue()} days overdue.', 'warning')
+        flash(f'Book returned successfully! A fine of ${fine:.2f} has been applied for {days_late} days overdue.', 'warning')
     else:
         flash('Book returned successfully!', 'success')
     
@@ -172,65 +202,22 @@ def return_book(id):
 
 @loan_bp.route('/overdue-check')
 def overdue_check():
-    """Check for overdue loans and send notifications."""
-    now = datetime.utcnow()
-    overdue_loans = Loan.query.filter(
-        Loan.returned == False,
-        Loan.due_date < now
-    ).all()
+    """Run the overdue notices job now, for the loans that became overdue since its last run."""
+    notification_count = run_job('overdue-notices')
     
-    notification_count = 0
-    
-    for loan in overdue_loans:
-        book = Book.query.get(loan.book_id)
-        member = Member.query.get(loan.member_id)
-        
-        days_overdue = loan.days_overdue()
-        fine = loan.calculate_fine()
-        
-        if days_overdue > 0:
-            send_notification(
-                member.email,
-                'Overdue Book Notice',
-                f'Dear {member.full_name()},\n\n'
-                f'The book "{book.title}" by {book.author} is overdue by {days_overdue} days.\n'
-                f'Current fine: ${fine:.2f}\n\n'
-                f'Please return the book as soon as possible to avoid additional fines.'
-            )
-            notification_count += 1
-    
-    flash(f'Sent {notification_count} overdue notifications.', 'info')
+    if notification_count is None:
+        flash('Overdue notices are already up to date.', 'info')
+    else:
+        flash(f'Queued {notification_count} overdue notifications.', 'info')
     return redirect(url_for('loans.index'))
 
 @loan_bp.route('/upcoming-due')
 def upcoming_due():
-    """Check for loans due soon and send reminders."""
-    now = datetime.utcnow()
-    soon = now + timedelta(days=3)  # Books due in the next 3 days
-    
-    upcoming_loans = Loan.query.filter(
-        Loan.returned == False,
-        Loan.due_date > now,
-        Loan.due_date <= soon
-    ).all()
-    
-    notification_count = 0
-    
-    for loan in upcoming_loans:
-        book = Book.query.get(loan.book_id)
-        member = Member.query.get(loan.member_id)
-        
-        days_remaining = (loan.due_date - now).days
-        
-        send_notification(
-            member.email,
-            'Book Due Date Reminder',
-            f'Dear {member.full_name()},\n\n'
-            f'This is a reminder that the book "{book.title}" by {book.author} is due in {days_remaining} days.\n'
-            f'Due date: {loan.due_date.strftime("%Y-%m-%d")}\n\n'
-            f'Please return the book on time to avoid fines.'
-        )
-        notification_count += 1
+    """Run the due date reminders job now, for the loans that came due soon since its last run."""
+    notification_count = run_job('due-reminders')
     
-    flash(f'Sent {notification_count} due date reminders.', 'info')
+    if notification_count is None:
+        flash('Due date reminders are already up to date.', 'info')
+    else:
+        flash(f'Queued {notification_count} due date reminders.', 'info')
     return redirect(url_for('loans.index'))
@@ -1,18 +1,28 @@
 from flask import Blueprint, render_template, redirect, url_for, request, flash
 from app import db
-from models import Member, Loan, Book
+from models import Member, Loan
 from sqlalchemy import or_, func, desc
+from sqlalchemy.orm import joinedload
 from datetime import datetime, timedelta
+from utils.pagination import paginate_index
+from utils.rollups import rollup_series
+from utils.statistics import library_statistics
+from utils.popularity import expire_popularity, top_popular
 
 member_bp = Blueprint('members', __name__, url_prefix='/members')
 
 @member_bp.route('/')
 def index():
-    """Display all members with optional search functionality."""
+    """Display a page of members with optional search functionality."""
     search_term = request.args.get('search', '')
     
-    # Query members based on search parameters
-    query = Member.query
+    # Active loans are counted on the member row; overdue ones come from one grouped subquery
+    counts = Member.loan_counts_subquery()
+    active_loans = Member.active_loan_count
+    overdue_loans = func.coalesce(counts.c.overdue_loans, 0)
+    query = db.session.query(Member, active_loans, overdue_loans).outerjoin(
+        counts, counts.c.member_id == Member.id
+    )
     
     if search_term:
         query = query.filter(
@@ -23,10 +33,25 @@ def index():
             )
         )
     
-    members = query.order_by(Member.last_name, Member.first_name).all()
+    pagination, sort, direction = paginate_index(
+        query,
+        request.args,
+        {
+            'name': (Member.last_name, Member.first_name),
+            'email': Member.email,
+            'registered': Member.registration_date,
+            'status': Member.active,
+            'loans': active_loans
+        },
+        'name',
+        tiebreaker=Member.id
+    )
     
     return render_template('members/index.html', 
-                          members=members, 
+                          members=pagination.items, 
+                          pagination=pagination,
+                          sort=sort,
+                          direction=direction,
                           search_term=search_term)
 
 @member_bp.route('/create', methods=['GET', 'POST'])
@@ -45,8 +70,8 @@ def create():
             flash('First name, last name, and email are required!', 'danger')
             return render_template('members/create.html')
         
-        # Check if email already exists
-        if Member.query.filter_by(email=email).first():
+        # Check if email already exists, whatever its case
+        if Member.query.filter(func.lower(Member.email) == email.strip().lower()).first():
             flash('A member with this email already exists!', 'danger')
             return render_template('members/create.html')
         
@@ -74,7 +99,9 @@ def show(id):
     member = Member.query.get_or_404(id)
     
     # Get loan history for this member
-    loans = Loan.query.filter_by(member_id=member.id).order_by(Loan.loan_date.desc()).all()
+    loans = Loan.query.options(joinedload(Loan.book)).filter_by(
+        member_id=member.id
+    ).order_by(Loan.loan_date.desc()).all()
     
     # Count active loans and overdue loans
     active_loans = sum(1 for loan in loans if not loan.returned)
@@ -105,9 +132,11 @@ def edit(id):
             flash('First name, last name, and email are required!', 'danger')
             return render_template('members/edit.html', member=member)
         
-        # Check if email already exists and belongs to another member
-        existing_member = Member.query.filter_by(email=member.email).first()
-        if existing_member and existing_member.id != member.id:
+        # Check if email belongs to another member, whatever its case; the edit is not flushed yet
+        with db.session.no_autoflush:
+            existing_member = Member.query.filter(func.lower(Member.email) == member.email.strip().lower(),
+                                                  Member.id != member.id).first()
+        if existing_member:
             flash('A member with this email already exists!', 'danger')
             return render_template('members/edit.html', member=member)
         
@@ -120,19 +149,18 @@ def edit(id):
 @member_bp.route('/dashboard')
 def dashboard():
     """Display a dashboard with member statistics."""
-    # Get basic member stats
-    total_members = Member.query.count()
-    active_members = Member.query.filter_by(active=True).count()
+    # Get basic member stats from the maintained counters
+    stats = library_statistics()['members']
+    total_members = stats['total']
+    active_members = stats['active']
     
     # Members with most active loans
     top_borrowers = db.session.query(
-        Member, func.count(Loan.id).label('loan_count')
-    ).join(Loan).filter(
-        Loan.returned == False
-    ).group_by(
-        Member
+        Member, Member.active_loan_count
+    ).filter(
+        Member.active_loan_count > 0
     ).order_by(
-        desc('loan_count')
+        Member.active_loan_count.desc(), Member.id
     ).limit(5).all()
     
     # Members with overdue books
@@ -150,38 +178,24 @@ def dashboard():
     # Recent registrations
     recent_members = Member.query.order_by(Member.registration_date.desc()).limit(10).all()
     
-    # Popular book categories among members (based on loans)
-    popular_categories = db.session.query(
-        Book.category, func.count(Loan.id).label('loan_count')
-    ).join(Loan, Loan.book_id == Book.id).group_by(
-        Book.category
-    ).filter(
-        Book.category.isnot(None)
-    ).order_by(
-        desc('loan_count')
-    ).limit(5).all()
+    # Popular book categories among members (loans of the last year, from the maintained windows)
+    if expire_popularity():
+        db.session.commit()
+    popular_categories = [
+        (category, loan_count)
+        for category, loan_count in top_popular('category', 365, 6) if category
+    ][:5]
     
-    # Member activity over time (last 6 months)
-    today = datetime.utcnow()
-    six_months_ago = today - timedelta(days=180)
-    monthly_registrations = db.session.query(
-        func.date_trunc('month', Member.registration_date).label('month'),
-        func.count(Member.id).label('count')
-    ).filter(
-        Member.registration_date >= six_months_ago
-    ).group_by(
-        'month'
-    ).order_by(
-        'month'
-    ).all()
+    # Member activity over time (last 6 months), from the monthly rollup
+    today = datetime.utcnow().date()
+    monthly_registrations = rollup_series('registrations', today - timedelta(days=180), today, 'month')
     
     # Format dates for chart
     months = []
     registration_counts = []
     for month, count in monthly_registrations:
-        if month:
-            months.append(month.strftime('%b %Y'))
-            registration_counts.append(count)
+        months.append(month.strftime('%b %Y'))
+        registration_counts.append(count)
     
     return render_template(
         'members/dashboard.html',
@@ -202,7 +216,7 @@ def delete(id):
     member = Member.query.get_or_404(id)
     
     # Check if the member has active loans
-    if any(not loan.returned for loan in member.loans):
+    if member.active_loan_count > 0:
         flash('Cannot delete a member who has active loans!', 'danger')
         return redirect(url_for('members.show', id=member.id))
     
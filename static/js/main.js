@@ -102,9 +102,78 @@ function setupLoanForm() {
     const memberSelect = document.getElementById('member_id');
     
     if (bookSelect && memberSelect) {
-        // We could add AJAX book search functionality here in the future
-        // For now, we're using the select dropdown populated from the server
+        // Options are fetched from the suggestion API as the user types
+        setupTypeahead(document.getElementById('book_search'), bookSelect, 'books', function(book) {
+            let label = `${book.title} by ${book.author}`;
+            if (book.category) {
+                label += ` (${book.category})`;
+            }
+            if (book.isbn) {
+                label += ` - ISBN: ${book.isbn}`;
+            }
+            return label;
+        });
+        setupTypeahead(document.getElementById('member_search'), memberSelect, 'members', function(member) {
+            return `${member.first_name} ${member.last_name} (${member.email})`;
+        });
+    }
+}
+
+/**
+ * Fill a select element with suggestions fetched while the user types
+ * @param {HTMLInputElement} input - The search input, with a data-suggest-url attribute
+ * @param {HTMLSelectElement} select - The select element to fill
+ * @param {string} key - The key holding the results in the API response
+ * @param {Function} formatLabel - Builds the option label from a result
+ */
+function setupTypeahead(input, select, key, formatLabel) {
+    if (!input) {
+        return;
     }
+    
+    let timer = null;
+    let controller = null;
+    
+    input.addEventListener('input', function() {
+        clearTimeout(timer);
+        const term = input.value.trim();
+        if (!term) {
+            return;
+        }
+        
+        // Wait for a pause in typing and drop any response still in flight
+        timer = setTimeout(function() {
+            if (controller) {
+                controller.abort();
+            }
+            controller = new AbortController();
+            
+            const url = `${input.dataset.suggestUrl}?q=${encodeURIComponent(term)}`;
+            fetch(url, { signal: controller.signal })
+                .then(response => response.json())
+                .then(data => {
+                    const placeholder = select.options[0];
+                    select.innerHTML = '';
+                    select.appendChild(placeholder);
+                    
+                    data[key].forEach(item => {
+                        const option = document.createElement('option');
+                        option.value = item.id;
+                        option.textContent = formatLabel(item);
+                        select.appendChild(option);
+                    });
+                    
+                    if (data[key].length === 1) {
+                        select.value = data[key][0].id;
+                    }
+                })
+                .catch(error => {
+                    if (error.name !== 'AbortError') {
+                        showNotification('Unable to load suggestions.', 'warning');
+                    }
+                });
+        }, 250);
+    });
 }
 
 /**
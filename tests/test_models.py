@@ -1,7 +1,8 @@
 import unittest
 from datetime import datetime, timedelta
+from sqlalchemy import func, update
 from app import app, db
-from models import Book, Member, Loan
+from models import Book, Member, Loan, repair_loan_counters
 
 class TestBookModel(unittest.TestCase):
     def setUp(self):
@@ -146,6 +147,85 @@ class TestMemberModel(unittest.TestCase):
         
         self.assertEqual(member.count_active_loans(), 2)
     
+    def test_loan_count_properties(self):
+        """Test active and overdue loan counts in Python and in SQL"""
+        busy = Member(first_name="Busy", last_name="Reader", email="busy@example.com")
+        idle = Member(first_name="Idle", last_name="Reader", email="idle@example.com")
+        book = Book(title="Book", author="Author")
+        db.session.add_all([busy, idle, book])
+        db.session.commit()
+        
+        now = datetime.utcnow()
+        db.session.add_all([
+            Loan(book_id=book.id, member_id=busy.id, loan_date=now, due_date=now + timedelta(days=14), returned=False),
+            Loan(book_id=book.id, member_id=busy.id, loan_date=now, due_date=now - timedelta(days=2), returned=False),
+            Loan(book_id=book.id, member_id=busy.id, loan_date=now, due_date=now - timedelta(days=2), returned=True)
+        ])
+        db.session.commit()
+        
+        self.assertEqual(busy.active_loan_count, 2)
+        self.assertEqual(busy.overdue_loan_count, 1)
+        self.assertEqual(idle.active_loan_count, 0)
+        
+        borrowers = Member.query.filter(Member.active_loan_count > 0).all()
+        self.assertEqual(borrowers, [busy])
+        late = Member.query.filter(Member.overdue_loan_count > 0).all()
+        self.assertEqual(late, [busy])
+        
+        counts = Member.loan_counts_subquery()
+        rows = db.session.query(counts.c.member_id, counts.c.active_loans, counts.c.overdue_loans).all()
+        self.assertEqual(rows, [(busy.id, 2, 1)])
+    
+    def test_loan_counters_follow_changes(self):
+        """Test book and member counters on checkout, return, transfer and delete"""
+        member = Member(first_name="Count", last_name="Reader", email="count@example.com")
+        first = Book(title="First", author="Author")
+        second = Book(title="Second", author="Author")
+        db.session.add_all([member, first, second])
+        db.session.commit()
+        
+        now = datetime.utcnow()
+        loan = Loan(book_id=first.id, member_id=member.id, loan_date=now, due_date=now + timedelta(days=14))
+        db.session.add(loan)
+        db.session.commit()
+        self.assertEqual((first.active_loan_count, first.total_loan_count), (1, 1))
+        self.assertEqual(member.active_loan_count, 1)
+        
+        loan.book_id = second.id
+        db.session.commit()
+        self.assertEqual((first.active_loan_count, first.total_loan_count), (0, 0))
+        self.assertEqual((second.active_loan_count, second.total_loan_count), (1, 1))
+        
+        loan.return_book()
+        db.session.commit()
+        self.assertEqual((second.active_loan_count, second.total_loan_count), (0, 1))
+        self.assertEqual(member.active_loan_count, 0)
+        
+        db.session.delete(loan)
+        db.session.commit()
+        self.assertEqual(second.total_loan_count, 0)
+    
+    def test_repair_loan_counters(self):
+        """Test that drifted counters are recomputed from the loan table"""
+        member = Member(first_name="Drift", last_name="Reader", email="drift@example.com")
+        book = Book(title="Drift", author="Author")
+        db.session.add_all([member, book])
+        db.session.commit()
+        now = datetime.utcnow()
+        db.session.add(Loan(book_id=book.id, member_id=member.id, loan_date=now, due_date=now + timedelta(days=14)))
+        db.session.commit()
+        
+        # Simulate a write that bypassed the ORM
+        db.session.execute(update(Member).values(active_loan_count=5))
+        db.session.execute(update(Book).values(total_loan_count=0))
+        db.session.commit()
+        
+        self.assertEqual(repair_loan_counters(), {'books': 1, 'members': 1})
+        db.session.commit()
+        self.assertEqual(member.active_loan_count, 1)
+        self.assertEqual(book.total_loan_count, 1)
+        self.assertEqual(repair_loan_counters(), {'books': 0, 'members': 0})
+    
     def test_member_to_dict(self):
         """Test member to_dict method"""
         member = Member(
@@ -281,6 +361,35 @@ class TestLoanModel(unittest.TestCase):
         # Fine should be $0.00
         self.assertEqual(active_loan.calculate_fine(), 0.00)
     
+    def test_overdue_expressions(self):
+        """Test that the SQL overdue and fine expressions match the Python methods"""
+        now = datetime.utcnow()
+        loans = [
+            Loan(book_id=self.book.id, member_id=self.member.id, loan_date=now - timedelta(days=20),
+                 due_date=now - timedelta(days=6, hours=5), returned=False),
+            Loan(book_id=self.book.id, member_id=self.member.id, loan_date=now - timedelta(days=20),
+                 due_date=now - timedelta(hours=3), returned=False),
+            Loan(book_id=self.book.id, member_id=self.member.id, loan_date=now - timedelta(days=20),
+                 due_date=now - timedelta(days=6), returned=True),
+            Loan(book_id=self.book.id, member_id=self.member.id, loan_date=now,
+                 due_date=now + timedelta(days=7), returned=False)
+        ]
+        db.session.add_all(loans)
+        db.session.commit()
+        
+        rows = db.session.query(
+            Loan.id, Loan.is_overdue(now), Loan.days_overdue(now), Loan.calculate_fine(now=now)
+        ).order_by(Loan.id).all()
+        expected = [(loan.id, loan.is_overdue(now), loan.days_overdue(now), loan.calculate_fine(now=now))
+                    for loan in loans]
+        self.assertEqual([tuple(row) for row in rows], expected)
+        self.assertEqual(expected[0][1:], (True, 6, 3.0))
+        
+        overdue = Loan.query.filter(Loan.is_overdue(now)).order_by(Loan.days_overdue(now).desc()).all()
+        self.assertEqual(overdue, loans[:2])
+        total = db.session.query(func.sum(Loan.calculate_fine(now=now))).scalar()
+        self.assertEqual(total, 3.0)
+    
     def test_return_book(self):
         """Test book return functionality"""
         # Create an active loan
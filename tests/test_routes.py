@@ -1,8 +1,32 @@
+import pickle
+import threading
 import unittest
+from unittest.mock import patch
 from datetime import datetime, timedelta
-from app import app, db
-from models import Book, Member, Loan
+from app import app, cache, db, load_user
+from models import Book, Member, Loan, IdempotencyKey, OutboxMessage, User
+from utils.statistics import library_statistics
+from utils.scheduler import OVERDUE_DELAY
+from utils.cache import RedisCache
+from tests.test_utils import FakeRedis
 from flask import url_for
+from sqlalchemy import event, update
+
+
+class QueryCounter:
+    """Count the SQL statements executed while the context is active."""
+    def __init__(self):
+        self.count = 0
+    
+    def _count(self, *args):
+        self.count += 1
+    
+    def __enter__(self):
+        event.listen(db.engine, 'before_cursor_execute', self._count)
+        return self
+    
+    def __exit__(self, *exc_info):
+        event.remove(db.engine, 'before_cursor_execute', self._count)
 
 class TestBookRoutes(unittest.TestCase):
     def setUp(self):
@@ -53,6 +77,34 @@ class TestBookRoutes(unittest.TestCase):
         self.assertIn(b'Test Book 1', response.data)
         self.assertIn(b'Test Book 2', response.data)
     
+    def test_index_route_search(self):
+        """Test book index route with a full-text search"""
+        response = self.client.get('/books/?search=author 1')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Test Book 1', response.data)
+        self.assertNotIn(b'Test Book 2', response.data)
+        
+        # A search without any word lists the whole catalog
+        response = self.client.get('/books/?search=!!')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Test Book 1', response.data)
+        self.assertIn(b'Test Book 2', response.data)
+    
+    def test_index_route_pagination(self):
+        """Test book index paging and sorting"""
+        response = self.client.get('/books/?per_page=1&sort=title&direction=desc')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Test Book 2', response.data)
+        self.assertNotIn(b'Test Book 1', response.data)
+        
+        response = self.client.get('/books/?per_page=1&sort=title&direction=desc&page=2')
+        self.assertIn(b'Test Book 1', response.data)
+        self.assertNotIn(b'Test Book 2', response.data)
+        
+        # Unknown sort columns fall back to the default order
+        response = self.client.get('/books/?sort=description;drop')
+        self.assertEqual(response.status_code, 200)
+    
     def test_show_route(self):
         """Test book show route"""
         response = self.client.get(f'/books/{self.book1.id}')
@@ -183,6 +235,24 @@ class TestMemberRoutes(unittest.TestCase):
         self.assertIn(b'John Doe', response.data)
         self.assertIn(b'Jane Smith', response.data)
     
+    def test_index_route_loan_counts(self):
+        """Test member index loan counts"""
+        book = Book(title="Counted Book", author="Author", available=False)
+        db.session.add(book)
+        db.session.commit()
+        db.session.add_all([
+            Loan(book_id=book.id, member_id=self.member1.id, loan_date=datetime.utcnow(),
+                 due_date=datetime.utcnow() - timedelta(days=1), returned=False),
+            Loan(book_id=book.id, member_id=self.member1.id, loan_date=datetime.utcnow(),
+                 due_date=datetime.utcnow() + timedelta(days=1), returned=False)
+        ])
+        db.session.commit()
+        
+        response = self.client.get('/members/?sort=loans&direction=desc')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'2 (overdue)', response.data)
+        self.assertLess(response.data.index(b'John Doe'), response.data.index(b'Jane Smith'))
+    
     def test_show_route(self):
         """Test member show route"""
         response = self.client.get(f'/members/{self.member1.id}')
@@ -247,6 +317,21 @@ class TestMemberRoutes(unittest.TestCase):
         self.assertEqual(updated_member.phone, '999-888-7777')
         self.assertEqual(updated_member.address, 'Updated Address')
         self.assertTrue(updated_member.active)
+    
+    def test_edit_duplicate_email(self):
+        """Test that edits cannot take another member's email, whatever its case"""
+        data = {'first_name': 'John', 'last_name': 'Doe', 'email': 'Jane.Smith@Example.com'}
+        response = self.client.post(f'/members/{self.member1.id}/edit', data=data, follow_redirects=True)
+        self.assertIn(b'A member with this email already exists', response.data)
+        
+        response = self.client.put(f'/api/members/{self.member1.id}', json={'email': ' JANE.SMITH@example.com'})
+        self.assertEqual(response.status_code, 400)
+        
+        # Members keep their own email under another case
+        response = self.client.put(f'/api/members/{self.member1.id}', json={'email': 'John.Doe@example.com'})
+        self.assertEqual(response.status_code, 200)
+        db.session.expire_all()
+        self.assertEqual(db.session.get(Member, self.member1.id).email, 'John.Doe@example.com')
 
 
 class TestLoanRoutes(unittest.TestCase):
@@ -296,6 +381,26 @@ class TestLoanRoutes(unittest.TestCase):
         self.assertIn(b'Test Book', response.data)
         self.assertIn(b'Test User', response.data)
     
+    def test_index_route_summary(self):
+        """Test that loan summary figures cover every page"""
+        other_book = Book(title="Late Book", author="Late Author", available=False)
+        db.session.add(other_book)
+        db.session.commit()
+        db.session.add(Loan(
+            book_id=other_book.id,
+            member_id=self.member.id,
+            loan_date=datetime.utcnow() - timedelta(days=20),
+            due_date=datetime.utcnow() - timedelta(days=6, hours=1),
+            returned=False
+        ))
+        db.session.commit()
+        
+        response = self.client.get('/loans/?per_page=1&sort=due_date&direction=desc')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(b'Late Book', response.data)
+        self.assertIn(b'$3.00', response.data)
+        self.assertIn(b'2 loans', response.data)
+    
     def test_show_route(self):
         """Test loan show route"""
         response = self.client.get(f'/loans/{self.loan.id}')
@@ -309,6 +414,12 @@ class TestLoanRoutes(unittest.TestCase):
         response = self.client.get('/loans/create')
         self.assertEqual(response.status_code, 200)
         self.assertIn(b'Create New Loan', response.data)
+        # Choices come from the suggestion API, not from the page itself
+        self.assertNotIn(b'Test Book', response.data)
+        self.assertNotIn(b'Test User', response.data)
+        
+        response = self.client.get(f'/loans/create?book_id={self.book.id}&member_id={self.member.id}')
+        self.assertEqual(response.status_code, 200)
         self.assertIn(b'Test Book', response.data)
         self.assertIn(b'Test User', response.data)
     
@@ -336,6 +447,15 @@ class TestLoanRoutes(unittest.TestCase):
         # Check that the book is now unavailable
         updated_book = Book.query.get(new_book.id)
         self.assertFalse(updated_book.available)
+        
+        # Check that the confirmation was queued with the loan
+        message = OutboxMessage.query.one()
+        self.assertEqual((message.recipient, message.status), (self.member.email, 'pending'))
+        self.assertIn('"Another Book"', message.body)
+        
+        # A refused loan queues nothing
+        self.client.post('/loans/create', data=data, follow_redirects=True)
+        self.assertEqual(OutboxMessage.query.count(), 1)
     
     def test_return_book_route(self):
         """Test book return route"""
@@ -356,6 +476,230 @@ class TestLoanRoutes(unittest.TestCase):
         self.assertTrue(updated_book.available)
 
 
+class TestLoanListQueries(unittest.TestCase):
+    def setUp(self):
+        """Set up test client and database"""
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['TESTING'] = True
+        app.config['LOGIN_DISABLED'] = True
+        self.client = app.test_client()
+        
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        
+    def tearDown(self):
+        """Tear down test database"""
+        app.config['LOGIN_DISABLED'] = False
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+    
+    def add_loans(self, count):
+        """Create loans, each with its own book and member"""
+        for i in range(count):
+            book = Book(title=f"Book {i}", author="Author", available=False)
+            member = Member(first_name="Member", last_name=str(i), email=f"member{i}-{count}@example.com")
+            db.session.add_all([book, member])
+            db.session.flush()
+            db.session.add(Loan(book_id=book.id, member_id=member.id, loan_date=datetime.utcnow(),
+                                due_date=datetime.utcnow() + timedelta(days=14), returned=False))
+        db.session.commit()
+        # Start each request from an empty identity map, as in production
+        db.session.expunge_all()
+    
+    def count_queries(self, url):
+        with QueryCounter() as counter:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return counter.count
+    
+    def test_query_count_independent_of_rows(self):
+        """Test that loan lists load books and members in bulk"""
+        urls = ['/loans/?per_page=100', '/admin/dashboard', '/']
+        
+        self.add_loans(3)
+        few = [self.count_queries(url) for url in urls]
+        
+        self.add_loans(9)
+        many = [self.count_queries(url) for url in urls]
+        
+        self.assertEqual(few, many)
+
+    
+    def test_overdue_check_route(self):
+        """Test that the overdue check queues, in bulk, only the loans that became overdue since its last run"""
+        def add_overdue(count):
+            for i in range(count):
+                book = Book(title=f"Late {i}", author="Author", available=False)
+                member = Member(first_name="Late", last_name=str(i), email=f"late{i}-{count}@example.com")
+                db.session.add_all([book, member])
+                db.session.flush()
+                db.session.add(Loan(book_id=book.id, member_id=member.id, loan_date=datetime.utcnow() - timedelta(days=15),
+                                    due_date=datetime.utcnow() - OVERDUE_DELAY, returned=False))
+            db.session.commit()
+            db.session.expunge_all()
+        
+        self.client.get('/loans/overdue-check')
+        add_overdue(2)
+        with QueryCounter() as few:
+            self.client.get('/loans/overdue-check')
+        add_overdue(6)
+        with QueryCounter() as many:
+            self.client.get('/loans/overdue-check')
+        self.assertEqual(few.count, many.count)
+        self.assertEqual(OutboxMessage.query.filter_by(subject='Overdue Book Notice').count(), 8)
+        
+        # Running it again notifies nobody twice
+        self.client.get('/loans/overdue-check')
+        self.assertEqual(OutboxMessage.query.count(), 8)
+        
+        response = self.client.get('/admin/system-status')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Vérification des retards', response.get_data(as_text=True))
+
+class TestUserLoader(unittest.TestCase):
+    def setUp(self):
+        """Set up test database with one user"""
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['TESTING'] = True
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        
+        user = User(username='reader', email='reader@example.com', role='member')
+        user.set_password('secret')
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+        db.session.expunge_all()
+        cache.clear()
+        
+    def tearDown(self):
+        """Tear down test database"""
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+    
+    def load(self):
+        """Load the user as at the start of a request"""
+        db.session.expunge_all()
+        with QueryCounter() as counter:
+            user = load_user(str(self.user_id))
+        return user, counter.count
+    
+    def test_user_loader(self):
+        """Test that an in-process cache does not keep users, whose writes other processes would miss"""
+        self.assertEqual(self.load()[1], 1)
+        user, queries = self.load()
+        self.assertEqual(queries, 1)
+        self.assertEqual(user.username, 'reader')
+    
+    def test_cached_user_loader(self):
+        """Test that the user is loaded without a query from the Redis cache until it is written"""
+        with patch.object(cache, 'backend', RedisCache(client=FakeRedis())):
+            self.check_cached_user_loader()
+    
+    def check_cached_user_loader(self):
+        self.assertEqual(self.load()[1], 1)
+        user, queries = self.load()
+        self.assertEqual(queries, 0)
+        self.assertEqual((user.username, user.role), ('reader', 'member'))
+        
+        # The entry holds the columns without the password hash, loaded when needed
+        cached = [pickle.loads(value) for key, value in cache.backend.client.data.items() if 'user:' in key
+                  and not key.startswith('library:tag:')]
+        self.assertEqual([entry['username'] for entry in cached], ['reader'])
+        self.assertNotIn('password_hash', cached[0])
+        with QueryCounter() as counter:
+            self.assertTrue(user.check_password('secret'))
+        self.assertEqual(counter.count, 1)
+        
+        # The cached user is persistent and can be written normally
+        user.role = 'librarian'
+        db.session.commit()
+        user, queries = self.load()
+        self.assertEqual((user.role, queries), ('librarian', 1))
+        
+        user.is_active = False
+        db.session.commit()
+        self.assertFalse(self.load()[0].is_active)
+        
+        db.session.delete(db.session.get(User, self.user_id))
+        db.session.commit()
+        self.assertIsNone(self.load()[0])
+
+
+class TestConcurrentCheckout(unittest.TestCase):
+    def setUp(self):
+        """Set up test database with a few books and members"""
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['TESTING'] = True
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        
+        self.books = [Book(title=f"Contested {i}", author="Author") for i in range(4)]
+        self.members = [Member(first_name="Desk", last_name=str(i), email=f"desk{i}@example.com")
+                        for i in range(8)]
+        db.session.add_all(self.books + self.members)
+        db.session.commit()
+        self.book_ids = [book.id for book in self.books]
+        self.member_ids = [member.id for member in self.members]
+        # Hold no read transaction while the threads write
+        db.session.close()
+        
+    def tearDown(self):
+        """Tear down test database"""
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+    
+    def test_no_double_loans(self):
+        """Test that concurrent checkouts of the same books lend each copy once"""
+        statuses = []
+        barrier = threading.Barrier(len(self.member_ids))
+        
+        def desk(member_id):
+            client = app.test_client()
+            barrier.wait()
+            for book_id in self.book_ids:
+                response = client.post('/api/loans', json={'book_id': book_id, 'member_id': member_id})
+                statuses.append((book_id, response.status_code))
+        
+        threads = [threading.Thread(target=desk, args=(member_id,)) for member_id in self.member_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(len(statuses), len(self.book_ids) * len(self.member_ids))
+        for book_id in self.book_ids:
+            codes = sorted(code for id, code in statuses if id == book_id)
+            self.assertEqual(codes, [201] + [400] * (len(self.member_ids) - 1))
+            self.assertEqual(Loan.query.filter_by(book_id=book_id).count(), 1)
+            self.assertEqual(db.session.get(Book, book_id).active_loan_count, 1)
+        
+        statistics = library_statistics()
+        self.assertEqual((statistics['books']['available'], statistics['loans']['active']), (0, 4))
+    
+    def test_stale_book_edit(self):
+        """Test that an edit based on an outdated version of a book is refused"""
+        client = app.test_client()
+        book = client.get(f'/api/books/{self.book_ids[0]}').get_json()['book']
+        
+        client.post('/api/loans', json={'book_id': self.book_ids[0], 'member_id': self.member_ids[0]})
+        response = client.put(f'/api/books/{self.book_ids[0]}',
+                              json={'title': 'Renamed', 'version': book['version']})
+        self.assertEqual(response.status_code, 409)
+        
+        current = client.get(f'/api/books/{self.book_ids[0]}').get_json()['book']
+        response = client.put(f'/api/books/{self.book_ids[0]}',
+                              json={'title': 'Renamed', 'version': current['version']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['book']['version'], current['version'] + 1)
+
+
 class TestAPIRoutes(unittest.TestCase):
     def setUp(self):
         """Set up test client and database"""
@@ -401,6 +745,69 @@ class TestAPIRoutes(unittest.TestCase):
         self.assertEqual(data['count'], 1)
         self.assertEqual(data['books'][0]['title'], "API Test Book")
     
+    def test_get_books_api_search(self):
+        """Test GET /api/books endpoint with a search term"""
+        response = self.client.get('/api/books?search=api auth')
+        data = response.get_json()
+        self.assertEqual(data['count'], 1)
+        
+        response = self.client.get('/api/books?search=unknown')
+        data = response.get_json()
+        self.assertEqual(data['count'], 0)
+        
+        # A search without any word pages through the whole catalog
+        db.session.add_all([Book(title=f"Unsearched {i}", author="Author") for i in range(5)])
+        db.session.commit()
+        data = self.client.get('/api/books?search=!!&limit=4').get_json()
+        self.assertEqual(data['count'], 4)
+        data = self.client.get(f"/api/books?search=!!&limit=4&cursor={data['next_cursor']}").get_json()
+        self.assertEqual(data['count'], Book.query.count() - 4)
+        self.assertIsNone(data['next_cursor'])
+    
+    def test_get_books_api_pagination(self):
+        """Test walking GET /api/books page by page with cursors"""
+        db.session.add_all([Book(title=f"Paged Book {i}", author="Pager") for i in range(6)])
+        db.session.commit()
+        
+        titles = []
+        url = '/api/books?limit=3'
+        while url:
+            data = self.client.get(url).get_json()
+            self.assertLessEqual(data['count'], 3)
+            titles.extend(book['title'] for book in data['books'])
+            url = f"/api/books?limit=3&cursor={data['next_cursor']}" if data['next_cursor'] else None
+        
+        self.assertEqual(titles, sorted(titles))
+        self.assertEqual(len(titles), 7)
+        self.assertEqual(len(set(titles)), 7)
+        
+        # Search results are paged by relevance
+        first = self.client.get('/api/books?search=pager&limit=4').get_json()
+        second = self.client.get(f"/api/books?search=pager&limit=4&cursor={first['next_cursor']}").get_json()
+        self.assertEqual(first['count'] + second['count'], 6)
+        self.assertIsNone(second['next_cursor'])
+    
+    def test_search_pagination_ties(self):
+        """Test that search results of equal relevance are paged without gaps or duplicates"""
+        db.session.add_all([Book(title="Tied Volume", author="Same Author") for _ in range(7)])
+        db.session.commit()
+        
+        ids = []
+        url = '/api/books?search=tied&limit=2'
+        while url:
+            data = self.client.get(url).get_json()
+            ids.extend(book['id'] for book in data['books'])
+            url = f"/api/books?search=tied&limit=2&cursor={data['next_cursor']}" if data['next_cursor'] else None
+        
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(ids, [book.id for book in Book.query.filter_by(title="Tied Volume").order_by(Book.id)])
+    
+    def test_list_api_invalid_cursor(self):
+        """Test that a forged cursor is rejected"""
+        response = self.client.get('/api/loans?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.get_json()['success'])
+    
     def test_get_book_api(self):
         """Test GET /api/books/<id> endpoint"""
         response = self.client.get(f'/api/books/{self.book.id}')
@@ -409,6 +816,75 @@ class TestAPIRoutes(unittest.TestCase):
         self.assertTrue(data['success'])
         self.assertEqual(data['book']['title'], "API Test Book")
     
+    def test_import_books_api(self):
+        """Test POST /api/books/import endpoint"""
+        body = "title,author,isbn\nImported,Author,9781111111111\nMissing author,,\n"
+        response = self.client.post('/api/books/import', data=body, content_type='text/csv')
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual((data['inserted'], data['error_count']), (1, 1))
+        self.assertEqual(self.client.get('/api/books').get_json()['count'], 2)
+        
+        response = self.client.post('/api/books/import', data=body, content_type='text/plain')
+        self.assertEqual(response.status_code, 400)
+    
+    def test_import_members_api(self):
+        """Test POST /api/members/import endpoint with a dry run and a CSV error report"""
+        body = "first_name,last_name,email\nNew,Member,new@example.com\nSame,Email,API@example.com\n"
+        response = self.client.post('/api/members/import?dry_run=true', data=body, content_type='text/csv')
+        data = response.get_json()
+        self.assertEqual((data['dry_run'], data['inserted'], data['duplicates']), (True, 1, 1))
+        self.assertEqual(Member.query.count(), 1)
+        
+        response = self.client.post('/api/members/import?report=csv', data=body, content_type='text/csv')
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertIn('attachment', response.headers['Content-Disposition'])
+        self.assertEqual(response.get_data(as_text=True).splitlines(),
+                         ['line,error', '3,A member with this email already exists'])
+        self.assertEqual(Member.query.count(), 2)
+    
+    def test_suggest_books_api(self):
+        """Test GET /api/books/suggest endpoint"""
+        response = self.client.get('/api/books/suggest?q=api te')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('max-age', response.headers['Cache-Control'])
+        data = response.get_json()
+        self.assertEqual([book['id'] for book in data['books']], [self.book.id])
+        
+        # Repeated lookups are served from the result cache until a book is written
+        with QueryCounter() as counter:
+            data = self.client.get('/api/books/suggest?q=api te').get_json()
+        self.assertEqual((counter.count, data['count']), (0, 1))
+        
+        # Books on loan are not offered for checkout
+        self.book.available = False
+        db.session.commit()
+        data = self.client.get('/api/books/suggest?q=api te').get_json()
+        self.assertEqual(data['books'], [])
+    
+    def test_suggest_members_api(self):
+        """Test GET /api/members/suggest endpoint"""
+        other = Member(first_name="Apolline", last_name="Martin", email="a.martin@example.com", active=True)
+        db.session.add(other)
+        db.session.commit()
+        
+        data = self.client.get('/api/members/suggest?q=AP').get_json()
+        self.assertEqual({member['id'] for member in data['members']}, {self.member.id, other.id})
+        
+        data = self.client.get('/api/members/suggest?q=ap mar').get_json()
+        self.assertEqual([member['id'] for member in data['members']], [other.id])
+        
+        data = self.client.get('/api/members/suggest?q=a%25').get_json()
+        self.assertEqual(data['members'], [])
+        
+        data = self.client.get('/api/members/suggest?q=a&limit=1').get_json()
+        self.assertEqual(data['count'], 1)
+        
+        other.active = False
+        db.session.commit()
+        data = self.client.get('/api/members/suggest?q=ap mar').get_json()
+        self.assertEqual(data['members'], [])
+    
     def test_get_members_api(self):
         """Test GET /api/members endpoint"""
         response = self.client.get('/api/members')
@@ -427,6 +903,182 @@ class TestAPIRoutes(unittest.TestCase):
         self.assertEqual(data['count'], 1)
         self.assertEqual(data['loans'][0]['book_id'], self.book.id)
     
+    def test_create_loan_api_loan_days(self):
+        """Test that POST /api/loans refuses a loan period that is not a positive number of days"""
+        book = Book(title="Loanable", author="Author", available=True)
+        db.session.add(book)
+        db.session.commit()
+        
+        for loan_days in ("two weeks", -3, 0, 7.5):
+            response = self.client.post('/api/loans', json={'book_id': book.id, 'member_id': self.member.id,
+                                                            'loan_days': loan_days})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('loan_days', response.get_json()['error'])
+        
+        response = self.client.post('/api/loans', json={'book_id': book.id, 'member_id': self.member.id,
+                                                        'loan_days': 7})
+        self.assertEqual(response.status_code, 201)
+    
+    def test_loans_batch_api(self):
+        """Test POST /api/loans/batch endpoint"""
+        books = [Book(title=f"Batch {i}", author="Author") for i in range(2)]
+        db.session.add_all(books)
+        self.book.available = False
+        db.session.commit()
+        book_ids = [books[0].id, self.book.id, 999, books[1].id, books[0].id]
+        
+        response = self.client.post('/api/loans/batch', json={'member_id': self.member.id, 'book_ids': book_ids})
+        self.assertEqual(response.status_code, 201)
+        data = response.get_json()
+        self.assertEqual((data['lent'], data['failed']), (2, 3))
+        self.assertEqual([item['success'] for item in data['results']], [True, False, False, True, False])
+        self.assertEqual(data['results'][1]['error'], 'This book is not available for loan')
+        self.assertEqual(data['results'][3]['loan']['book_id'], books[1].id)
+        self.assertEqual(OutboxMessage.query.filter_by(recipient=self.member.email).count(), 1)
+        
+        self.assertFalse(db.session.get(Book, books[0].id).available)
+        self.assertEqual(db.session.get(Member, self.member.id).active_loan_count, 3)
+        
+        response = self.client.post('/api/loans/batch', json={'member_id': 999, 'book_ids': [books[0].id]})
+        self.assertEqual(response.status_code, 404)
+        response = self.client.post('/api/loans/batch', json={'member_id': self.member.id, 'book_ids': []})
+        self.assertEqual(response.status_code, 400)
+    
+    def test_returns_batch_api(self):
+        """Test POST /api/returns/batch endpoint, fines being taken before the return"""
+        self.loan.due_date = datetime.utcnow() - timedelta(days=4, hours=1)
+        db.session.commit()
+        
+        response = self.client.post('/api/returns/batch',
+                                    json={'member_id': self.member.id, 'book_ids': [self.book.id, 999]})
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual((data['returned'], data['failed'], data['fine']), (1, 1, 2.0))
+        self.assertEqual(data['results'][0]['fine'], 2.0)
+        self.assertTrue(data['results'][0]['loan']['returned'])
+        self.assertIn('$2.00', OutboxMessage.query.one().body)
+        
+        self.assertTrue(db.session.get(Book, self.book.id).available)
+        self.assertEqual(self.client.get('/api/statistics').get_json()['statistics']['loans']['active'], 0)
+    
+    def test_fines_summary_api(self):
+        """Test GET /api/fines/summary endpoint"""
+        response = self.client.get('/api/fines/summary')
+        self.assertEqual(response.get_json()['count'], 0)
+        
+        self.loan.due_date = datetime.utcnow() - timedelta(days=4, hours=1)
+        db.session.commit()
+        
+        response = self.client.get('/api/fines/summary')
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertTrue(data['success'])
+        self.assertEqual(data['total'], 2.0)
+        self.assertEqual(data['members'], [{
+            'member_id': self.member.id,
+            'name': 'API User',
+            'email': 'api@example.com',
+            'overdue_loans': 1,
+            'days_overdue': 4,
+            'fine': 2.0
+        }])
+    
+    def test_stats_timeseries_api(self):
+        """Test GET /api/stats/timeseries endpoint"""
+        today = datetime.utcnow().date()
+        response = self.client.get(f'/api/stats/timeseries?metric=loans&from={today - timedelta(days=2)}&to={today}')
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertTrue(data['success'])
+        self.assertEqual([point['value'] for point in data['series']], [0, 0, 1])
+        
+        response = self.client.get('/api/stats/timeseries?metric=registrations&bucket=month')
+        data = response.get_json()
+        self.assertEqual(len(data['series']), 12)
+        self.assertEqual(data['series'][-1], {'date': today.replace(day=1).isoformat(), 'value': 1})
+        
+        self.assertEqual(self.client.get('/api/stats/timeseries?metric=overdues').status_code, 200)
+        for query in ('metric=fines', 'bucket=week', 'from=yesterday', 'from=2020-01-01&to=2019-01-01',
+                      'from=2000-01-01'):
+            response = self.client.get(f'/api/stats/timeseries?{query}')
+            self.assertEqual(response.status_code, 400, query)
+            self.assertFalse(response.get_json()['success'])
+    
+    def test_popular_api(self):
+        """Test GET /api/popular endpoint"""
+        response = self.client.get('/api/popular?window=7')
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertTrue(data['success'])
+        self.assertEqual(data['books'], [{'id': self.book.id, 'title': "API Test Book", 'author': "API Author", 'loans': 1}])
+        self.assertEqual(data['categories'], [{'category': None, 'loans': 1}])
+        self.assertEqual(data['members'], [{'id': self.member.id, 'name': "API User", 'loans': 1}])
+        
+        response = self.client.get('/api/popular?window=14')
+        self.assertEqual(response.status_code, 400)
+    
+    def test_conditional_get_api(self):
+        """Test ETag and Last-Modified revalidation of single resources"""
+        response = self.client.get(f'/api/books/{self.book.id}')
+        etag = response.headers['ETag']
+        self.assertIn('Last-Modified', response.headers)
+        self.assertIn('no-cache', response.headers['Cache-Control'])
+        
+        response = self.client.get(f'/api/books/{self.book.id}', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.headers['ETag'], etag)
+        
+        response = self.client.get(f'/api/members/{self.member.id}')
+        response = self.client.get(f'/api/members/{self.member.id}',
+                                   headers={'If-Modified-Since': response.headers['Last-Modified']})
+        self.assertEqual(response.status_code, 304)
+        
+        self.book.title = "Renamed"
+        db.session.commit()
+        response = self.client.get(f'/api/books/{self.book.id}', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['book']['title'], "Renamed")
+    
+    def test_conditional_loan_api(self):
+        """Test that loan validators change as the loan becomes more overdue"""
+        # Move the due date without touching updated_at, as time passing would
+        db.session.execute(update(Loan).values(
+            due_date=datetime.utcnow() - timedelta(days=2, hours=1), updated_at=Loan.updated_at
+        ))
+        db.session.commit()
+        
+        response = self.client.get(f'/api/loans/{self.loan.id}')
+        loan_etag = response.headers['ETag']
+        list_etag = self.client.get('/api/loans').headers['ETag']
+        self.assertEqual(self.client.get('/api/loans', headers={'If-None-Match': list_etag}).status_code, 304)
+        
+        db.session.execute(update(Loan).values(
+            due_date=datetime.utcnow() - timedelta(days=3, hours=1), updated_at=Loan.updated_at
+        ))
+        db.session.commit()
+        response = self.client.get(f'/api/loans/{self.loan.id}', headers={'If-None-Match': loan_etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['loan']['days_overdue'], 3)
+        response = self.client.get('/api/loans', headers={'If-None-Match': list_etag})
+        self.assertEqual(response.status_code, 200)
+    
+    def test_conditional_list_api(self):
+        """Test that the list validator changes on insert and delete"""
+        etag = self.client.get('/api/books').headers['ETag']
+        self.assertEqual(self.client.get('/api/books', headers={'If-None-Match': etag}).status_code, 304)
+        
+        extra = Book(title="Extra", author="Author")
+        db.session.add(extra)
+        db.session.commit()
+        response = self.client.get('/api/books', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        
+        db.session.delete(extra)
+        db.session.commit()
+        self.assertEqual(self.client.get('/api/books', headers={'If-None-Match': etag}).status_code, 200)
+    
     def test_statistics_api(self):
         """Test GET /api/statistics endpoint"""
         response = self.client.get('/api/statistics')
@@ -436,7 +1088,67 @@ class TestAPIRoutes(unittest.TestCase):
         self.assertEqual(data['statistics']['books']['total'], 1)
         self.assertEqual(data['statistics']['members']['total'], 1)
         self.assertEqual(data['statistics']['loans']['total'], 1)
+    
+    def test_cached_api(self):
+        """Test that cached responses are reused until a commit changes their tables"""
+        cache.clear()
+        self.client.get('/api/books?category=&search=')
+        self.client.get('/api/books')
+        self.assertEqual(self.client.get('/api/statistics').get_json()['statistics']['books']['total'], 1)
+        
+        stats = self.client.get('/api/cache/stats').get_json()['cache']
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+        
+        self.loan.returned = True
+        db.session.commit()
+        data = self.client.get('/api/books').get_json()
+        self.assertTrue(data['books'][0]['available'])
+        self.assertEqual(self.client.get('/api/statistics').get_json()['statistics']['loans']['active'], 0)
+        
+        stats = self.client.get('/api/cache/stats').get_json()['cache']
+        self.assertEqual((stats['hits'], stats['misses']), (1, 4))
 
+    
+    def test_idempotent_api(self):
+        """Test that retries with the same Idempotency-Key replay the first response"""
+        book = Book(title="Retried Book", author="API Author", available=True)
+        db.session.add(book)
+        db.session.commit()
+        
+        payload = {'book_id': book.id, 'member_id': self.member.id}
+        headers = {'Idempotency-Key': 'loan-retry-1'}
+        first = self.client.post('/api/loans', json=payload, headers=headers)
+        self.assertEqual(first.status_code, 201)
+        self.assertNotIn('Idempotent-Replayed', first.headers)
+        
+        retry = self.client.post('/api/loans', json=payload, headers=headers)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.get_json(), first.get_json())
+        self.assertEqual(Loan.query.filter_by(book_id=book.id).count(), 1)
+        
+        # The same key cannot be reused for another request
+        other = self.client.post('/api/loans', json={'book_id': self.book.id, 'member_id': self.member.id},
+                                 headers=headers)
+        self.assertEqual(other.status_code, 422)
+        
+        # Refusals are replayed too; requests without a key are not affected
+        headers = {'Idempotency-Key': 'loan-retry-2'}
+        self.assertEqual(self.client.post('/api/loans', json=payload, headers=headers).status_code, 400)
+        self.assertEqual(self.client.post('/api/loans', json=payload, headers=headers).headers['Idempotent-Replayed'],
+                         'true')
+        self.assertEqual(self.client.post('/api/loans', json=payload).status_code, 400)
+        
+        # Conflicts ask for a retry, so they are not stored
+        headers = {'Idempotency-Key': 'book-edit-1'}
+        stale = {'title': "Renamed", 'version': book.version_id - 1}
+        conflict = self.client.put(f'/api/books/{book.id}', json=stale, headers=headers)
+        self.assertEqual(conflict.status_code, 409)
+        self.assertIsNone(db.session.get(IdempotencyKey, 'book-edit-1'))
+        retry = self.client.put(f'/api/books/{book.id}', json={'title': "Renamed", 'version': book.version_id},
+                                headers=headers)
+        self.assertEqual(retry.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', retry.headers)
 
 if __name__ == '__main__':
     unittest.main()
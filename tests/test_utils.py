@@ -1,10 +1,51 @@
+import io
+import socket
+from fnmatch import fnmatch
 import unittest
 from unittest.mock import patch, MagicMock
 import logging
-from datetime import datetime, timedelta
-from app import app, db
-from models import Book, Member, Loan
-from utils.notifications import send_notification, send_overdue_notification, send_upcoming_due_reminder, send_return_confirmation
+from sqlalchemy import event, update
+from datetime import date, datetime, timedelta
+from app import app, cache, db
+from models import Book, Member, Loan, LibraryStat, DailyStat, MonthlyStat, JobState, PopularityWindow, IdempotencyKey, OutboxMessage, NotificationLedger
+from utils.notifications import due_reminder, overdue_notice, send_notification
+from utils.search import search_books, search_relevance, search_tokens
+from utils.pagination import InvalidCursor, encode_cursor, decode_cursor, keyset_paginate, MAX_PAGE_SIZE
+from utils.statistics import library_statistics, count_statistics, reconcile_statistics
+from utils.rollups import rebuild_rollups, refresh_overdue_rollup, rollup_series
+from utils.popularity import expire_popularity, rebuild_popularity, top_popular
+from utils.cache import MemoryCache, RedisCache, ResultCache, _MISSING
+from utils.imports import import_books, import_members
+from utils.idempotency import purge_expired_keys
+from utils.outbox import MAX_ATTEMPTS, SMTPTransport, create_transport, deliver_outbox, delivery_stats, queue_notification
+from utils.smtp_pool import PooledSMTPTransport, RateLimiter, SMTPPool
+from utils.smtp_sink import SMTPSink
+from utils.scheduler import job_status, run_due_jobs, run_job
+from utils.ledger import prune_ledger
+
+class FakeRedis:
+    """Stand-in for a Redis client, storing bytes and counters as Redis does."""
+    
+    def __init__(self):
+        self.data = {}
+    
+    def get(self, key):
+        return self.data.get(key)
+    
+    def set(self, key, value, ex=None):
+        self.data[key] = value if isinstance(value, bytes) else str(value).encode()
+    
+    def incr(self, key):
+        value = int(self.data.get(key, b'0')) + 1
+        self.data[key] = str(value).encode()
+        return value
+    
+    def delete(self, key):
+        self.data.pop(key, None)
+    
+    def scan_iter(self, match='*'):
+        return [key for key in list(self.data) if fnmatch(key, match)]
+
 
 class TestNotifications(unittest.TestCase):
     def setUp(self):
@@ -84,58 +125,829 @@ class TestNotifications(unittest.TestCase):
         mock_log.assert_any_call(f"Subject: {subject}")
         mock_log.assert_any_call(f"Message: {message}")
     
-    @patch('utils.notifications.send_notification')
-    def test_send_overdue_notification(self, mock_send):
-        """Test send_overdue_notification function"""
-        mock_send.return_value = True
+    def test_overdue_notice(self):
+        """Test the notice written for an overdue loan"""
+        recipient, subject, message = overdue_notice(self.overdue_loan, self.book, self.member)
         
-        result = send_overdue_notification(self.overdue_loan)
+        self.assertEqual(recipient, self.member.email)
+        self.assertEqual(subject, 'Overdue Book Notice')
+        self.assertIn(self.book.title, message)
+        self.assertIn(f"overdue by {self.overdue_loan.days_overdue()} days", message)
+        self.assertIn(f"${self.overdue_loan.calculate_fine():.2f}", message)
+    
+    def test_due_reminder(self):
+        """Test the reminder written for a loan due soon"""
+        recipient, subject, message = due_reminder(self.active_loan, self.book, self.member)
         
-        self.assertTrue(result)
-        mock_send.assert_called_once()
+        self.assertEqual(recipient, self.member.email)
+        self.assertEqual(subject, 'Book Due Date Reminder')
+        self.assertIn(self.book.title, message)
+        self.assertIn(self.active_loan.due_date.strftime('%Y-%m-%d'), message)
+
+
+class TestSearch(unittest.TestCase):
+    def setUp(self):
+        """Set up test database with a small catalog"""
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['TESTING'] = True
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
         
-        # Check that the correct arguments were passed
-        args = mock_send.call_args[0]
-        self.assertEqual(args[0], self.member.email)
-        self.assertIn("OVERDUE", args[1])
-        self.assertIn(self.book.title, args[2])
-        self.assertIn(str(self.overdue_loan.days_overdue()), args[2])
-        self.assertIn(str(self.overdue_loan.calculate_fine()), args[2])
+        self.title_match = Book(title="Python Cookbook", author="David Beazley", isbn="9781449340377")
+        self.author_match = Book(title="Fluent Code", author="Luciano Python", isbn="9781491946008")
+        self.no_match = Book(title="Les Misérables", author="Victor Hugo", isbn="9782070409228")
+        db.session.add_all([self.title_match, self.author_match, self.no_match])
+        db.session.commit()
+        
+    def tearDown(self):
+        """Tear down test database"""
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
     
-    @patch('utils.notifications.send_notification')
-    def test_send_upcoming_due_reminder(self, mock_send):
-        """Test send_upcoming_due_reminder function"""
-        mock_send.return_value = True
+    def test_search_tokens(self):
+        """Test splitting search input into words"""
+        self.assertEqual(search_tokens('  harry "pot"* '), ['harry', 'pot'])
+        self.assertEqual(search_tokens(''), [])
         
-        result = send_upcoming_due_reminder(self.active_loan)
+        # Without words there is no index to rank on
+        with self.assertRaises(ValueError):
+            search_relevance('!!')
+    
+    def test_search_prefix_and_accents(self):
+        """Test prefix matching and accent folding"""
+        results = search_books(Book.query, 'pyth').all()
+        self.assertEqual({book.id for book in results}, {self.title_match.id, self.author_match.id})
         
-        self.assertTrue(result)
-        mock_send.assert_called_once()
+        results = search_books(Book.query, 'miserables hugo').all()
+        self.assertEqual([book.id for book in results], [self.no_match.id])
+        
+        results = search_books(Book.query, '978207').all()
+        self.assertEqual([book.id for book in results], [self.no_match.id])
+    
+    def test_search_index_follows_updates(self):
+        """Test that edits and deletions are reflected in search results"""
+        self.no_match.title = "Python for Poets"
+        db.session.commit()
+        self.assertEqual(len(search_books(Book.query, 'python').all()), 3)
+        
+        db.session.delete(self.title_match)
+        db.session.commit()
+        results = search_books(Book.query, 'cookbook').all()
+        self.assertEqual(results, [])
+
+
+class TestPagination(unittest.TestCase):
+    def setUp(self):
+        """Set up test database"""
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['TESTING'] = True
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
         
-        # Check that the correct arguments were passed
-        args = mock_send.call_args[0]
-        self.assertEqual(args[0], self.member.email)
-        self.assertIn("Reminder", args[1])
-        self.assertIn(self.book.title, args[2])
-        self.assertIn(self.active_loan.due_date.strftime('%Y-%m-%d'), args[2])
+    def tearDown(self):
+        """Tear down test database"""
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
     
-    @patch('utils.notifications.send_notification')
-    def test_send_return_confirmation(self, mock_send):
-        """Test send_return_confirmation function"""
-        mock_send.return_value = True
+    def test_cursor_round_trip(self):
+        """Test that cursors preserve strings, numbers and dates"""
+        values = ['Dupont', 42, datetime(2024, 3, 1, 12, 30, 5, 123)]
+        self.assertEqual(decode_cursor(encode_cursor(values)), values)
+    
+    def test_invalid_cursor(self):
+        """Test that malformed cursors raise InvalidCursor"""
+        for cursor in ['%%%', encode_cursor([1])[:-2] + '!!', 'eyJhIjoxfQ']:
+            with self.assertRaises(InvalidCursor):
+                decode_cursor(cursor)
+    
+    def test_keyset_paginate_with_ties(self):
+        """Test descending pages over duplicate sort values"""
+        day = datetime(2024, 1, 1)
+        book = Book(title="Book", author="Author")
+        member = Member(first_name="Test", last_name="User", email="pages@example.com")
+        db.session.add_all([book, member])
+        db.session.commit()
+        db.session.add_all([
+            Loan(book_id=book.id, member_id=member.id, loan_date=day + timedelta(days=i // 2),
+                 due_date=day + timedelta(days=14), returned=True)
+            for i in range(7)
+        ])
+        db.session.commit()
         
-        result = send_return_confirmation(self.returned_loan)
+        sort_keys = [(Loan.loan_date, True), (Loan.id, True)]
+        seen = []
+        cursor = None
+        while True:
+            loans, cursor = keyset_paginate(Loan.query, sort_keys, cursor, limit=2)
+            seen.extend(loans)
+            if not cursor:
+                break
         
-        self.assertTrue(result)
-        mock_send.assert_called_once()
+        self.assertEqual(len(seen), 7)
+        self.assertEqual(seen, sorted(seen, key=lambda loan: (loan.loan_date, loan.id), reverse=True))
+        
+        loans, _ = keyset_paginate(Loan.query, sort_keys, limit=MAX_PAGE_SIZE * 10)
+        self.assertEqual(len(loans), 7)
+
+
+class TestStatistics(unittest.TestCase):
+    def setUp(self):
+        """Set up test database"""
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['TESTING'] = True
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        
+    def tearDown(self):
+        """Tear down test database"""
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+    
+    def _create_library(self):
+        books = [Book(title=f"Book {i}", author="Author", available=i > 0) for i in range(3)]
+        members = [Member(first_name="Stat", last_name=f"Member {i}", email=f"stat{i}@example.com",
+                          active=i > 0) for i in range(2)]
+        db.session.add_all(books + members)
+        db.session.commit()
+        
+        now = datetime.utcnow()
+        loans = [
+            Loan(book_id=books[0].id, member_id=members[0].id, loan_date=now - timedelta(days=20),
+                 due_date=now - timedelta(days=6), returned=False),
+            Loan(book_id=books[1].id, member_id=members[1].id, loan_date=now,
+                 due_date=now + timedelta(days=14), returned=False),
+            Loan(book_id=books[2].id, member_id=members[1].id, loan_date=now - timedelta(days=30),
+                 due_date=now - timedelta(days=16), returned=True)
+        ]
+        db.session.add_all(loans)
+        db.session.commit()
+        return books, members, loans
+    
+    def test_library_statistics(self):
+        """Test the counters read from the statistics table"""
+        self._create_library()
+        
+        statements = []
+        def count(*args):
+            statements.append(args)
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            stats = library_statistics()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(stats['books'], {'total': 3, 'available': 2, 'on_loan': 1})
+        self.assertEqual(stats['members'], {'total': 2, 'active': 1, 'inactive': 1})
+        self.assertEqual(stats['loans'], {'total': 3, 'active': 2, 'overdue': 1, 'returned': 1})
+        self.assertEqual(count_statistics(), stats)
+    
+    def test_statistics_follow_changes(self):
+        """Test that inserts, updates and deletes adjust the counters"""
+        books, members, loans = self._create_library()
+        
+        loans[0].return_book()
+        members[0].active = True
+        db.session.delete(books[2])
+        db.session.commit()
+        
+        stats = library_statistics()
+        self.assertEqual(stats['books'], {'total': 2, 'available': 2, 'on_loan': 0})
+        self.assertEqual(stats['members'], {'total': 2, 'active': 2, 'inactive': 0})
+        self.assertEqual(stats['loans'], {'total': 2, 'active': 1, 'overdue': 0, 'returned': 1})
+        self.assertEqual(count_statistics(), stats)
+        
+        # A failed transaction leaves the counters untouched
+        db.session.add(Book(title="Rolled back", author="Author"))
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(library_statistics(), stats)
+    
+    def test_reconcile_statistics(self):
+        """Test that drifted counters are rebuilt and reported"""
+        self._create_library()
+        db.session.execute(update(LibraryStat).where(LibraryStat.name == 'loans.active').values(value=7))
+        db.session.commit()
+        
+        self.assertEqual(reconcile_statistics(), {'loans.active': (7, 2)})
+        db.session.commit()
+        self.assertEqual(library_statistics()['loans']['active'], 2)
+        self.assertEqual(reconcile_statistics(), {})
+
+
+class TestRollups(unittest.TestCase):
+    def setUp(self):
+        """Set up test database"""
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['TESTING'] = True
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        
+    def tearDown(self):
+        """Tear down test database"""
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+    
+    def _rollups(self):
+        daily = {(row.metric, row.day): row.value for row in DailyStat.query if row.value}
+        monthly = {(row.metric, row.month): row.value for row in MonthlyStat.query if row.value}
+        return daily, monthly
+    
+    def test_rollups_follow_changes(self):
+        """Test that registrations, loans and returns are rolled up on flush"""
+        march, april = datetime(2024, 3, 30, 10), datetime(2024, 4, 2, 16)
+        book = Book(title="Rollup", author="Author")
+        member = Member(first_name="Roll", last_name="Up", email="rollup@example.com", registration_date=march)
+        db.session.add_all([book, member])
+        db.session.commit()
+        loan = Loan(book_id=book.id, member_id=member.id, loan_date=march, due_date=april)
+        db.session.add(loan)
+        db.session.commit()
+        
+        loan.returned = True
+        loan.return_date = april
+        db.session.commit()
+        
+        daily, monthly = self._rollups()
+        self.assertEqual(daily, {
+            ('registrations', march.date()): 1,
+            ('loans', march.date()): 1,
+            ('returns', april.date()): 1
+        })
+        self.assertEqual(monthly, {
+            ('registrations', date(2024, 3, 1)): 1,
+            ('loans', date(2024, 3, 1)): 1,
+            ('returns', date(2024, 4, 1)): 1
+        })
+        
+        db.session.delete(loan)
+        db.session.commit()
+        daily, monthly = self._rollups()
+        self.assertEqual(daily, {('registrations', march.date()): 1})
+        
+        series = rollup_series('registrations', date(2024, 2, 10), date(2024, 4, 30), 'month')
+        self.assertEqual(series, [(date(2024, 2, 1), 0), (date(2024, 3, 1), 1), (date(2024, 4, 1), 0)])
+    
+    def test_overdue_rollup(self):
+        """Test that each past day is rolled up once and matches a rebuild"""
+        # Start from a database where the overdue job never ran
+        JobState.query.delete()
+        book = Book(title="Late", author="Author")
+        member = Member(first_name="Late", last_name="Reader", email="late@example.com")
+        db.session.add_all([book, member])
+        db.session.commit()
+        db.session.add_all([
+            Loan(book_id=book.id, member_id=member.id, loan_date=datetime(2024, 5, 1),
+                 due_date=datetime(2024, 5, 15, 12)),
+            Loan(book_id=book.id, member_id=member.id, loan_date=datetime(2024, 5, 1),
+                 due_date=datetime(2024, 5, 15, 9), returned=True, return_date=datetime(2024, 5, 14)),
+            Loan(book_id=book.id, member_id=member.id, loan_date=datetime(2024, 5, 2),
+                 due_date=datetime(2024, 5, 16), returned=True, return_date=datetime(2024, 5, 20))
+        ])
+        db.session.commit()
         
-        # Check that the correct arguments were passed
-        args = mock_send.call_args[0]
-        self.assertEqual(args[0], self.member.email)
-        self.assertIn("Return Confirmation", args[1])
-        self.assertIn(self.book.title, args[2])
-        self.assertIn(self.returned_loan.return_date.strftime('%Y-%m-%d'), args[2])
+        self.assertEqual(refresh_overdue_rollup(today=date(2024, 5, 16)), 1)
+        self.assertEqual(refresh_overdue_rollup(today=date(2024, 5, 16)), 0)
+        self.assertEqual(refresh_overdue_rollup(today=date(2024, 5, 18)), 2)
+        db.session.commit()
+        
+        series = rollup_series('overdues', date(2024, 5, 14), date(2024, 5, 17))
+        self.assertEqual([value for _, value in series], [0, 1, 1, 0])
+        
+        incremental = self._rollups()
+        totals = rebuild_rollups(today=date(2024, 5, 18))
+        db.session.commit()
+        self.assertEqual(totals, {'registrations': 1, 'loans': 3, 'returns': 2, 'overdues': 2})
+        self.assertEqual(self._rollups(), incremental)
+
+
+class TestPopularity(unittest.TestCase):
+    def setUp(self):
+        """Set up test database"""
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['TESTING'] = True
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        
+    def tearDown(self):
+        """Tear down test database"""
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+    
+    def _windows(self):
+        return {(row.window_days, row.kind, row.key): row.loans for row in PopularityWindow.query}
+    
+    def test_popularity_windows(self):
+        """Test that loans enter the windows on flush and leave them as days pass"""
+        today = datetime.utcnow().date()
+        novel = Book(title="Novel", author="Author", category="Roman")
+        essay = Book(title="Essay", author="Author", category="Essai")
+        reader = Member(first_name="Avid", last_name="Reader", email="avid@example.com")
+        db.session.add_all([novel, essay, reader])
+        db.session.commit()
+        
+        def lend(book, days_ago):
+            loan_date = datetime.utcnow() - timedelta(days=days_ago)
+            return Loan(book_id=book.id, member_id=reader.id, loan_date=loan_date,
+                        due_date=loan_date + timedelta(days=14), returned=True, return_date=loan_date)
+        loans = [lend(novel, 1), lend(novel, 2), lend(novel, 20), lend(essay, 3), lend(essay, 100)]
+        db.session.add_all(loans)
+        db.session.commit()
+        
+        self.assertEqual(top_popular('book', 7), [(str(novel.id), 2), (str(essay.id), 1)])
+        self.assertEqual(top_popular('category', 30), [('Roman', 3), ('Essai', 1)])
+        self.assertEqual(top_popular('member', 365), [(str(reader.id), 5)])
+        
+        db.session.delete(loans[0])
+        db.session.commit()
+        self.assertEqual(top_popular('book', 7, limit=1), [(str(novel.id), 1)])
+        
+        # Five days later the loans of 2 and 3 days ago have left the 7-day window
+        self.assertEqual(expire_popularity(today + timedelta(days=5)), 3)
+        self.assertEqual(expire_popularity(today + timedelta(days=5)), 0)
+        db.session.commit()
+        self.assertEqual(top_popular('book', 7), [])
+        self.assertEqual(top_popular('category', 30), [('Roman', 2), ('Essai', 1)])
+        
+        incremental = self._windows()
+        self.assertEqual(rebuild_popularity(today + timedelta(days=5)), 4)
+        db.session.commit()
+        self.assertEqual(self._windows(), incremental)
+
+
 
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        """Set up test database"""
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['TESTING'] = True
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        
+    def tearDown(self):
+        """Tear down test database"""
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+    
+    def test_memory_cache_eviction(self):
+        """Test that the memory backend drops the least recently used and expired entries"""
+        backend = MemoryCache(max_entries=2)
+        backend.set('a', 1)
+        backend.set('b', 2)
+        backend.get('a')
+        backend.set('c', 3)
+        self.assertIs(backend.get('b'), _MISSING)
+        self.assertEqual((backend.get('a'), backend.get('c')), (1, 3))
+        
+        with patch('utils.cache.time.monotonic', return_value=0):
+            backend.set('short', 'value', ttl=10)
+        with patch('utils.cache.time.monotonic', return_value=11):
+            self.assertIs(backend.get('short'), _MISSING)
+    
+    def test_empty_backend_kept(self):
+        """Test that a result cache keeps its backend while the backend is still empty"""
+        memory = MemoryCache(max_entries=5)
+        self.assertIs(ResultCache(memory).backend, memory)
+        redis_backend = RedisCache(client=FakeRedis())
+        result_cache = ResultCache(redis_backend)
+        self.assertIs(result_cache.backend, redis_backend)
+        self.assertTrue(result_cache.shared)
+    
+    def test_redis_backend(self):
+        """Test results cached in Redis, whose tag versions are plain integer counters"""
+        result_cache = ResultCache(RedisCache(client=FakeRedis()))
+        computed = []
+        compute = lambda: computed.append(1) or {'count': len(computed)}
+        
+        self.assertEqual(result_cache.get_or_set('count', compute, tags=('book',)), {'count': 1})
+        self.assertEqual(result_cache.get_or_set('count', compute, tags=('book',)), {'count': 1})
+        result_cache.invalidate('book')
+        self.assertEqual(result_cache.get_or_set('count', compute, tags=('book',)), {'count': 2})
+        self.assertEqual(result_cache.get_or_set('count', compute, tags=('book',)), {'count': 2})
+        self.assertEqual(result_cache.backend.client.get('library:tag:book'), b'1')
+        
+        result_cache.clear()
+        self.assertEqual(len(result_cache.backend), 0)
+    
+    def test_results_follow_commits(self):
+        """Test that committed writes invalidate the results of their tables, rollbacks do not"""
+        cache.clear()
+        count = lambda: cache.get_or_set('count', Book.query.count, tags=('book',))
+        members = lambda: cache.get_or_set('members', Member.query.count, tags=('member',))
+        self.assertEqual(count(), 0)
+        self.assertEqual(members(), 0)
+        
+        db.session.add(Book(title="Cached", author="Author"))
+        db.session.commit()
+        self.assertEqual(count(), 1)
+        self.assertEqual(members(), 0)
+        self.assertEqual(cache.stats()['hits'], 1)
+        
+        db.session.add(Book(title="Rolled back", author="Author"))
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(count(), 1)
+        self.assertEqual(cache.stats()['hits'], 2)
+        
+        # Bulk statements invalidate their table too
+        db.session.execute(update(Book).values(title="Renamed"))
+        db.session.commit()
+        self.assertEqual(count(), 1)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['invalidations']), (2, 4, 2))
+
+
+
+class TestImports(unittest.TestCase):
+    def setUp(self):
+        """Set up test database with one book"""
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['TESTING'] = True
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        
+        db.session.add(Book(title="Existing", author="Author", isbn="9780000000001"))
+        db.session.commit()
+        
+    def tearDown(self):
+        """Tear down test database"""
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+    
+    def test_import_books_csv(self):
+        """Test that valid rows are added in chunks and the others reported"""
+        feed = io.StringIO(
+            "Title,Author,ISBN,Category,Publication_Year\n"
+            "Dune,Frank Herbert,9780000000002,Roman,1965\n"
+            "No author,,9780000000003,,\n"
+            "Again,Author,9780000000001,,\n"
+            "Bad year,Author,9780000000004,,soon\n"
+            "Foundation,Isaac Asimov,,Roman,\n"
+            "Dune again,Frank Herbert,9780000000002,,\n"
+        )
+        report = import_books(feed, 'csv', chunk_size=2)
+        
+        self.assertEqual((report['rows'], report['inserted'], report['duplicates']), (6, 2, 2))
+        self.assertEqual([(error['line'], error['error']) for error in report['errors']], [
+            (3, 'Missing required field: author'),
+            (5, 'Invalid publication_year: soon'),
+        ])
+        self.assertEqual(report['error_count'], 2)
+        self.assertEqual([(error['line'], error['error']) for error in report['skipped']], [
+            (4, 'A book with this ISBN already exists'),
+            (7, 'A book with this ISBN already exists'),
+        ])
+        self.assertEqual(Book.query.filter_by(isbn='9780000000002').one().publication_year, 1965)
+        
+        # Counters and the search index follow the bulk inserts
+        self.assertEqual(library_statistics()['books'], count_statistics()['books'])
+        self.assertEqual(search_books(Book.query, 'asimov').count(), 1)
+    
+    def test_import_books_ndjson(self):
+        """Test reading NDJSON records"""
+        feed = io.StringIO('{"title": "Emma", "author": "Jane Austen", "publication_year": 1815}\n'
+                           '\n'
+                           '["not", "an", "object"]\n'
+                           '{"title": broken\n')
+        report = import_books(feed, 'ndjson')
+        self.assertEqual(report['inserted'], 1)
+        self.assertEqual([error['line'] for error in report['errors']], [3, 4])
+        self.assertEqual(Book.query.filter_by(title='Emma').one().available, True)
+    
+    def test_import_members(self):
+        """Test that emails are deduplicated whatever their case, and that dry runs add nothing"""
+        db.session.add(Member(first_name="Known", last_name="Member", email="Known@School.org"))
+        db.session.commit()
+        
+        feed = ("first_name,last_name,email\n"
+                "Ann,Lee,ann@school.org\n"
+                "Again,Known,known@school.ORG\n"
+                "Twin,Lee,ANN@school.org\n"
+                "Bad,Email,not-an-email\n"
+                "Di,Lu,di@school.org\n")
+        
+        dry_run = import_members(io.StringIO(feed), 'csv', chunk_size=2, dry_run=True)
+        self.assertEqual(Member.query.count(), 1)
+        
+        report = import_members(io.StringIO(feed), 'csv', chunk_size=2)
+        for result in (dry_run, report):
+            self.assertEqual((result['inserted'], result['duplicates'], result['error_count']), (2, 2, 1))
+            self.assertEqual([error['line'] for error in result['errors']], [5])
+            self.assertEqual([error['line'] for error in result['skipped']], [3, 4])
+        self.assertEqual(Member.query.count(), 3)
+        
+        # Importing the list again only skips duplicates, which are not errors
+        again = import_members(io.StringIO(feed), 'csv', chunk_size=2)
+        self.assertEqual((again['inserted'], again['duplicates'], again['error_count']), (0, 4, 1))
+        
+        # Counters and rollups follow the bulk inserts
+        self.assertEqual(library_statistics()['members'], count_statistics()['members'])
+        today = datetime.utcnow().date()
+        self.assertEqual(rollup_series('registrations', today, today), [(today, 3)])
+
+
+class TestIdempotency(unittest.TestCase):
+    def setUp(self):
+        """Set up test database"""
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['TESTING'] = True
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        
+    def tearDown(self):
+        """Tear down test database"""
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+    
+    def test_purge_expired_keys(self):
+        """Test that only the expired keys are purged, batch by batch"""
+        now = datetime.utcnow()
+        db.session.add_all([IdempotencyKey(key=f'old-{i}', fingerprint='f', status_code=201, body='{}',
+                                           expires_at=now - timedelta(minutes=i + 1)) for i in range(5)])
+        db.session.add(IdempotencyKey(key='live', fingerprint='f', expires_at=now + timedelta(hours=1)))
+        db.session.commit()
+        
+        self.assertEqual(purge_expired_keys(now, batch_size=2), 5)
+        self.assertEqual([key.key for key in IdempotencyKey.query], ['live'])
+        self.assertEqual(purge_expired_keys(now), 0)
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        """Set up test database and a local SMTP server"""
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['TESTING'] = True
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.sink = SMTPSink(reject=['bounce@example.com']).start()
+        self.transport = SMTPTransport(self.sink.host, self.sink.port, sender='library@example.com')
+        
+    def tearDown(self):
+        """Tear down test database and SMTP server"""
+        self.sink.stop()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+    
+    def test_queued_with_transaction(self):
+        """Test that messages are only queued by the transactions that commit"""
+        queue_notification("kept@example.com", "Kept", "Body")
+        db.session.commit()
+        queue_notification("dropped@example.com", "Dropped", "Body")
+        db.session.rollback()
+        
+        self.assertEqual([message.recipient for message in OutboxMessage.query], ["kept@example.com"])
+    
+    def test_deliver_outbox(self):
+        """Test delivery in batches over SMTP, with retries and backoff for failures"""
+        for i in range(3):
+            queue_notification(f"reader{i}@example.com", f"Notice {i}", f"Dear reader {i}")
+        queue_notification("bounce@example.com", "Notice", "Never delivered")
+        db.session.commit()
+        
+        self.assertEqual(deliver_outbox(self.transport, batch_size=2), {'sent': 2, 'retried': 0, 'failed': 0})
+        self.assertEqual(deliver_outbox(self.transport), {'sent': 1, 'retried': 1, 'failed': 0})
+        self.assertEqual(deliver_outbox(self.transport), {'sent': 0, 'retried': 0, 'failed': 0})
+        
+        self.assertEqual([message['To'] for message in self.sink.messages],
+                         [f"reader{i}@example.com" for i in range(3)])
+        self.assertEqual(self.sink.messages[0]['Subject'], "Notice 0")
+        self.assertEqual(self.sink.messages[0].get_content().strip(), "Dear reader 0")
+        
+        bounced = OutboxMessage.query.filter_by(recipient="bounce@example.com").one()
+        self.assertEqual((bounced.status, bounced.attempts), ('pending', 1))
+        self.assertGreater(bounced.next_attempt_at, datetime.utcnow())
+        self.assertEqual(OutboxMessage.query.filter_by(status='sent').count(), 3)
+        
+        # Retries stop after the last attempt
+        later = datetime.utcnow()
+        for attempt in range(MAX_ATTEMPTS - 1):
+            later += timedelta(days=1)
+            deliver_outbox(self.transport, now=later)
+        db.session.refresh(bounced)
+        self.assertEqual((bounced.status, bounced.attempts), ('failed', MAX_ATTEMPTS))
+        self.assertIn('bounce@example.com', bounced.last_error)
+    
+    def test_unreachable_server(self):
+        """Test that messages are retried when the server cannot be reached"""
+        queue_notification("reader@example.com", "Notice", "Body")
+        db.session.commit()
+        self.sink.stop()
+        self.sink = SMTPSink().start()
+        
+        self.assertEqual(deliver_outbox(self.transport)['retried'], 1)
+        self.assertEqual(OutboxMessage.query.one().status, 'pending')
+    
+    def test_pooled_delivery(self):
+        """Test that the pooled transport keeps its connections open across batches"""
+        pool = SMTPPool(self.sink.host, self.sink.port, sender='library@example.com', size=2, max_messages=4)
+        transport = PooledSMTPTransport(pool)
+        for i in range(5):
+            queue_notification(f"reader{i}@example.com", f"Notice {i}", f"Dear reader {i}\n.signed")
+        queue_notification("bounce@example.com", "Notice", "Never delivered")
+        db.session.commit()
+        
+        # Refused recipients leave the session usable; a connection is replaced after 4 messages
+        self.assertEqual(deliver_outbox(transport), {'sent': 5, 'retried': 1, 'failed': 0})
+        queue_notification("late@example.com", "Notice", "Body")
+        db.session.commit()
+        self.assertEqual(deliver_outbox(transport)['sent'], 1)
+        
+        self.assertEqual([message['To'] for message in self.sink.messages],
+                         [f"reader{i}@example.com" for i in range(5)] + ["late@example.com"])
+        self.assertEqual(self.sink.messages[0].get_content().splitlines(), ["Dear reader 0", ".signed"])
+        stats = pool.stats()
+        self.assertEqual((stats['sent'], stats['failed']), (6, 1))
+        self.assertEqual((stats['connections_opened'], stats['reconnects'], stats['idle']), (2, 0, 1))
+        pool.close()
+    
+    def test_pooled_reconnect(self):
+        """Test that a connection closed by the server is replaced without losing the message"""
+        pool = SMTPPool(self.sink.host, self.sink.port, size=1)
+        with PooledSMTPTransport(pool) as transport:
+            transport.send("first@example.com", "Notice", "Body")
+        pool._idle[0].smtp.sock.shutdown(socket.SHUT_RDWR)
+        with PooledSMTPTransport(pool) as transport:
+            transport.send("second@example.com", "Notice", "Body")
+        
+        self.assertEqual(len(self.sink.messages), 2)
+        self.assertEqual(pool.stats()['reconnects'], 1)
+        pool.close()
+    
+    def test_delivery_stats(self):
+        """Test the outbox counts and the metrics of the shared pool"""
+        queue_notification("reader@example.com", "Notice", "Body")
+        queue_notification("bounce@example.com", "Notice", "Body")
+        db.session.commit()
+        
+        with patch('utils.outbox._pool', None), patch.dict(app.config, NOTIFICATION_TRANSPORT='smtp-pool',
+                                                           SMTP_HOST=self.sink.host, SMTP_PORT=self.sink.port):
+            transport = create_transport(app.config)
+            self.assertIs(create_transport(app.config).pool, transport.pool)
+            deliver_outbox(transport)
+            stats = delivery_stats()
+            transport.pool.close()
+        
+        self.assertEqual(stats['outbox'], {'pending': 1, 'sending': 0, 'sent': 1, 'failed': 0})
+        self.assertEqual((stats['smtp']['sent'], stats['smtp']['failed']), (1, 1))
+        self.assertIsNone(delivery_stats()['smtp'])
+    
+    def test_rate_limiter(self):
+        """Test that the rate limiter lets a burst through, then spaces the operations"""
+        limiter = RateLimiter(50, burst=2)
+        
+        self.assertEqual([limiter.acquire() for _ in range(2)], [0, 0])
+        waited = limiter.acquire()
+        self.assertGreater(waited, 0.01)
+        self.assertLessEqual(waited, 0.02)
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        """Set up test database"""
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['TESTING'] = True
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        
+        self.member = Member(first_name="Test", last_name="User", email="test@example.com")
+        db.session.add(self.member)
+        db.session.commit()
+        
+    def tearDown(self):
+        """Tear down test database"""
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+    
+    def add_loan(self, due_date, returned=False):
+        book = Book(title=f"Due {due_date}", author="Author", available=returned)
+        db.session.add(book)
+        db.session.flush()
+        db.session.add(Loan(book_id=book.id, member_id=self.member.id, loan_date=due_date - timedelta(days=14),
+                            due_date=due_date, returned=returned))
+        db.session.commit()
+    
+    def test_due_reminders_job(self):
+        """Test that each run only reminds the loans that came due soon since the previous run"""
+        now = datetime(2026, 3, 2, 12, 0)
+        self.add_loan(now + timedelta(days=3, minutes=-30))
+        self.add_loan(now + timedelta(days=3, minutes=30))
+        self.add_loan(now + timedelta(days=1))
+        self.add_loan(now + timedelta(days=3, minutes=-10), returned=True)
+        
+        self.assertEqual(run_job('due-reminders', now), 1)
+        self.assertIsNone(run_job('due-reminders', now))
+        
+        # Jobs run once their interval has elapsed, the overdue job for the first time
+        later = now + timedelta(hours=1)
+        self.assertEqual(run_due_jobs(later), {'overdue-notices': 0, 'due-reminders': 1, 'prune-ledger': 0})
+        self.assertEqual(run_due_jobs(later + timedelta(minutes=10)), {})
+        
+        status = {job['name']: job for job in job_status()}
+        self.assertEqual(status['due-reminders']['last_count'], 1)
+        self.assertEqual(status['due-reminders']['last_run_at'], later)
+        self.assertEqual(status['due-reminders']['next_run_at'], later + timedelta(hours=1))
+        self.assertIsNone(status['due-reminders']['last_error'])
+        
+        reminders = OutboxMessage.query.filter_by(subject='Book Due Date Reminder').all()
+        self.assertEqual(len(reminders), 2)
+        self.assertIn('is due in 2 days', reminders[0].body)
+    
+    def test_short_loan_reminder(self):
+        """Test that a loan lent for less than the reminder lead is reminded in the period it was lent"""
+        now = datetime(2026, 3, 2, 12, 0)
+        book = Book(title="Short Loan", author="Author", available=False)
+        db.session.add(book)
+        db.session.flush()
+        db.session.add(Loan(book_id=book.id, member_id=self.member.id, loan_date=now - timedelta(minutes=30),
+                            due_date=now + timedelta(days=2, minutes=-30), returned=False))
+        db.session.commit()
+        
+        self.assertEqual(run_job('due-reminders', now), 1)
+        self.assertEqual(run_job('due-reminders', now + timedelta(hours=1)), 0)
+        self.assertIn('Short Loan', OutboxMessage.query.one().body)
+    
+    def test_first_run_race(self):
+        """Test that a first run losing the race to create the job state runs nothing"""
+        now = datetime(2026, 3, 2, 12, 0)
+        self.assertEqual(run_job('due-reminders', now), 0)
+        
+        # As another process would, having created the state after this one looked for it
+        with patch.object(db.session, 'get', return_value=None):
+            self.assertIsNone(run_job('due-reminders', now + timedelta(hours=1)))
+        self.assertEqual(db.session.get(JobState, 'due-reminders').watermark, now)
+    
+    def test_digest_mode(self):
+        """Test that digests group the notices of each member of a window into one message"""
+        other = Member(first_name="Other", last_name="Reader", email="other@example.com")
+        db.session.add(other)
+        db.session.commit()
+        
+        now = datetime(2026, 3, 2, 12, 0)
+        for hours in (2, 5, 20):
+            self.add_loan(now - timedelta(days=1, hours=hours))
+        self.add_loan(now - timedelta(days=1, hours=40))
+        self.add_loan(now - timedelta(days=1, hours=3))
+        loan = Loan.query.order_by(Loan.id.desc()).first()
+        loan.member_id = other.id
+        db.session.commit()
+        
+        app.config['NOTIFICATION_DIGEST'] = True
+        try:
+            self.assertEqual(run_job('overdue-notices', now), 2)
+            self.assertEqual(job_status()[0]['next_run_at'], now + timedelta(days=1))
+        finally:
+            app.config['NOTIFICATION_DIGEST'] = False
+        
+        digest = OutboxMessage.query.filter_by(recipient="test@example.com").one()
+        self.assertEqual(digest.subject, 'Overdue Book Notice (3 books)')
+        self.assertEqual(digest.body.count('\n- '), 3)
+        self.assertIn('Current fine: $1.50', digest.body)
+        single = OutboxMessage.query.filter_by(recipient="other@example.com").one()
+        self.assertEqual(single.subject, 'Overdue Book Notice')
+    
+    def test_notification_ledger(self):
+        """Test that a period processed again notifies nobody twice, and that old entries are pruned"""
+        now = datetime(2026, 3, 2, 12, 0)
+        self.add_loan(now - timedelta(days=1, minutes=30))
+        self.assertEqual(run_job('overdue-notices', now), 1)
+        
+        # Replay the same period, as a second scheduler with a stale watermark would
+        db.session.execute(update(JobState).where(JobState.name == 'overdue-notices')
+                           .values(watermark=now - timedelta(hours=1)))
+        db.session.commit()
+        self.assertEqual(run_job('overdue-notices', now + timedelta(minutes=5)), 0)
+        self.assertEqual(OutboxMessage.query.count(), 1)
+        
+        # Replay it again the next day, as a catch-up after a watermark reset would
+        db.session.execute(update(JobState).where(JobState.name == 'overdue-notices')
+                           .values(watermark=now - timedelta(hours=1)))
+        db.session.commit()
+        self.assertEqual(run_job('overdue-notices', now + timedelta(days=1)), 0)
+        self.assertEqual(OutboxMessage.query.count(), 1)
+        
+        db.session.add(NotificationLedger(loan_id=99, kind='overdue', day=date(2025, 11, 1)))
+        db.session.commit()
+        self.assertEqual(prune_ledger(now.date(), retention_days=90), 1)
+        self.assertEqual([(entry.kind, entry.day) for entry in NotificationLedger.query],
+                         [('overdue', now.date())])
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,263 @@
+import logging
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from flask import request
+from sqlalchemy import event
+
+DEFAULT_TTL = 300
+DEFAULT_MAX_ENTRIES = 1024
+
+# Sentinel telling a cached None apart from a miss
+_MISSING = object()
+
+
+class MemoryCache:
+    """
+    In-process cache evicting the least recently used entry beyond ``max_entries``.
+
+    Entries also expire after their time to live. Safe to share between
+    the threads of one process.
+    """
+
+    # Invalidations in other processes never reach it
+    shared = False
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return _MISSING
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                return _MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def version(self, key):
+        value = self.get(key)
+        return 0 if value is _MISSING else value
+
+    def incr(self, key):
+        with self._lock:
+            value, expires = self._entries.get(key, (0, None))
+            self._entries[key] = (value + 1, expires)
+            self._entries.move_to_end(key)
+            return value + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCache:
+    """
+    Cache shared by every process through Redis.
+
+    Requires the ``redis`` package unless a compatible ``client`` is given.
+    """
+
+    shared = True
+
+    def __init__(self, url=None, client=None, prefix='library:'):
+        if client is None:
+            try:
+                import redis
+            except ImportError as e:
+                raise RuntimeError("The redis package is required for CACHE_TYPE='redis'") from e
+            client = redis.Redis.from_url(url or 'redis://localhost:6379/0')
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return _MISSING if raw is None else pickle.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=ttl or None)
+
+    def version(self, key):
+        # Counters written by INCR are stored as plain integers, not pickles
+        raw = self.client.get(self.prefix + key)
+        return 0 if raw is None else int(raw)
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix + '*'):
+            self.client.delete(key)
+
+    def __len__(self):
+        return sum(1 for _ in self.client.scan_iter(match=self.prefix + '*'))
+
+
+class ResultCache:
+    """
+    Cache of computed results, invalidated by tag.
+
+    Each entry is stored under its tags' current version numbers;
+    invalidating a tag bumps its version, so stale entries are never read
+    again and age out of the backend. This works the same in process and
+    in a shared backend.
+    """
+
+    def __init__(self, backend=None, default_ttl=DEFAULT_TTL):
+        # Backends define __len__: an empty one must not be taken for a missing one
+        self.backend = backend if backend is not None else MemoryCache()
+        self.default_ttl = default_ttl
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    @property
+    def shared(self):
+        """Tell whether the entries and their invalidations are seen by every process."""
+        return self.enabled and self.backend.shared
+
+    def get_or_set(self, key, compute, tags=(), ttl=None):
+        """
+        Return the cached result for ``key``, computing and storing it on a miss.
+
+        Args:
+            key (str): Identifies the result, see ``request_key``
+            compute (callable): Produces the result on a miss
+            tags (tuple): Table names the result depends on
+            ttl (int): Seconds to keep the result, defaults to ``default_ttl``
+
+        Returns:
+            The cached or freshly computed result
+        """
+        if not self.enabled:
+            return compute()
+
+        versioned = self._versioned_key(key, tags)
+        value = self.backend.get(versioned)
+        if value is not _MISSING:
+            self._count('hits')
+            return value
+
+        self._count('misses')
+        value = compute()
+        self.backend.set(versioned, value, ttl or self.default_ttl)
+        return value
+
+    def invalidate(self, *tags):
+        """Make every result depending on one of ``tags`` stale."""
+        for tag in tags:
+            self.backend.incr(f'tag:{tag}')
+        if tags:
+            self._count('invalidations')
+            logging.debug(f"Invalidated cached results for {', '.join(sorted(tags))}")
+
+    def clear(self):
+        """Drop every entry and reset the counters."""
+        self.backend.clear()
+        with self._lock:
+            self._stats = dict.fromkeys(self._stats, 0)
+
+    def stats(self):
+        """Return the hit, miss and invalidation counters and the hit rate."""
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else None
+        stats['entries'] = len(self.backend)
+        stats['backend'] = type(self.backend).__name__
+        return stats
+
+    def _versioned_key(self, key, tags):
+        versions = []
+        for tag in sorted(tags):
+            versions.append(f"{tag}={self.backend.version(f'tag:{tag}')}")
+        return f"{key}|{','.join(versions)}"
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+
+def request_key(prefix=None):
+    """
+    Build a cache key from the current endpoint and its normalized query arguments.
+
+    Arguments are sorted and empty values dropped, so ``?b=2&a=1&c=`` and
+    ``?a=1&b=2`` share an entry.
+    """
+    args = sorted((name, value) for name, values in request.args.lists()
+                  for value in values if value != '')
+    query = '&'.join(f'{name}={value}' for name, value in args)
+    return f"{prefix or request.endpoint}?{query}"
+
+
+def invalidate_on_commit(session, *tags):
+    """Invalidate ``tags`` once the current transaction of ``session`` commits."""
+    session.info.setdefault('cache_tags', set()).update(tags)
+
+
+def register_invalidation(session_class, result_cache):
+    """
+    Invalidate the cached results of the tables written by each committed transaction.
+
+    Flushed objects and DML statements run through the session are
+    collected per session; their tables are invalidated only once the
+    transaction commits, and forgotten if it rolls back.
+    """
+    @event.listens_for(session_class, 'after_flush')
+    def collect_flushed(session, flush_context):
+        written = list(session.new) + list(session.deleted)
+        written += [instance for instance in session.dirty if session.is_modified(instance)]
+        invalidate_on_commit(session, *{instance.__table__.name for instance in written})
+
+    @event.listens_for(session_class, 'do_orm_execute')
+    def collect_statement(orm_execute_state):
+        if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+            table = getattr(orm_execute_state.statement, 'table', None)
+            if table is not None:
+                invalidate_on_commit(orm_execute_state.session, table.name)
+
+    @event.listens_for(session_class, 'after_commit')
+    def invalidate_committed(session):
+        tags = session.info.pop('cache_tags', None)
+        if tags:
+            result_cache.invalidate(*tags)
+
+    @event.listens_for(session_class, 'after_soft_rollback')
+    def discard_rolled_back(session, previous_transaction):
+        session.info.pop('cache_tags', None)
+
+
+def create_cache(config):
+    """
+    Build the result cache described by the application configuration.
+
+    ``CACHE_TYPE`` is ``'memory'`` (default), ``'redis'`` (with
+    ``CACHE_REDIS_URL``) or ``'null'`` to disable caching.
+    """
+    cache_type = config.get('CACHE_TYPE', 'memory')
+    if cache_type == 'redis':
+        backend = RedisCache(config.get('CACHE_REDIS_URL'))
+    else:
+        backend = MemoryCache(config.get('CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES))
+    result_cache = ResultCache(backend, config.get('CACHE_DEFAULT_TTL', DEFAULT_TTL))
+    result_cache.enabled = cache_type != 'null'
+    return result_cache
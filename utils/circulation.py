@@ -0,0 +1,273 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+
+from utils.statistics import adjust_statistics
+
+# Largest number of items accepted in one desk batch
+MAX_BATCH_ITEMS = 100
+
+
+class CirculationError(ValueError):
+    """Raised when a whole circulation batch is refused."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def checkout_book(book_id, member_id, loan_days=14, notes=None, now=None):
+    """
+    Lend a book to a member.
+
+    The book is claimed with a single conditional UPDATE that only matches
+    while it is available, so two concurrent checkouts of the same copy
+    cannot both succeed, without any lock held across queries. The claim
+    is made first, so that SQLite takes its write lock before any read.
+    On error the caller rolls back, which releases the claim; otherwise
+    the caller commits.
+
+    Args:
+        book_id (int): The book lent
+        member_id (int): The borrowing member
+        loan_days (int): Loan period, in days
+        notes (str): Notes stored on the loan
+        now (datetime): Loan time, defaults to now
+
+    Returns:
+        Loan: The new loan, added to the session
+
+    Raises:
+        CirculationError: If the book or the member cannot be lent to
+    """
+    from app import db
+    from models import Book, Loan
+
+    now = now or datetime.utcnow()
+    if not claim_books([book_id], now):
+        if db.session.get(Book, book_id) is None:
+            raise CirculationError('Book not found', 404)
+        raise CirculationError('This book is not available for loan')
+
+    member = _active_member(member_id)
+    loan = Loan(book_id=book_id, member_id=member.id, loan_date=now,
+                due_date=now + timedelta(days=loan_days), returned=False, notes=notes)
+    db.session.add(loan)
+    return loan
+
+
+def checkout_books(member_id, book_ids, loan_days=14, notes=None, now=None):
+    """
+    Lend several books to one member in a single transaction.
+
+    The available books are claimed together like in ``checkout_book``,
+    then the member and the books are loaded with one query each. Books
+    that are unknown, unavailable or listed twice are reported and
+    skipped; the others are lent together. On error the caller rolls
+    back; otherwise the caller commits.
+
+    Args:
+        member_id (int): The borrowing member
+        book_ids (list): Ids of the books scanned at the desk
+        loan_days (int): Loan period, in days
+        notes (str): Notes stored on every loan
+        now (datetime): Loan time, defaults to now
+
+    Returns:
+        tuple: The member and the per-item results, in the order of
+        ``book_ids``; successful items hold their ``loan`` and ``book``
+
+    Raises:
+        CirculationError: If the member cannot borrow at all
+    """
+    from app import db
+    from models import Book, Loan
+
+    now = now or datetime.utcnow()
+    due_date = now + timedelta(days=loan_days)
+    claimed = claim_books(set(book_ids), now)
+    member = _active_member(member_id)
+    books = {book.id: book for book in Book.query.filter(Book.id.in_(set(book_ids)))}
+
+    loans, results, seen = [], [], set()
+    for book_id in book_ids:
+        book = books.get(book_id)
+        if book_id in seen:
+            error = 'This book is listed more than once'
+        elif book is None:
+            error = 'Book not found'
+        elif book_id not in claimed:
+            error = 'This book is not available for loan'
+        else:
+            error = None
+        seen.add(book_id)
+
+        if error:
+            results.append({'book_id': book_id, 'success': False, 'error': error})
+            continue
+
+        loan = Loan(book_id=book.id, member_id=member.id, loan_date=now, due_date=due_date,
+                    returned=False, notes=notes)
+        loans.append(loan)
+        results.append({'book_id': book_id, 'success': True, 'loan': loan, 'book': book})
+
+    db.session.add_all(loans)
+    return member, results
+
+
+def claim_books(book_ids, now=None):
+    """
+    Mark the available books among ``book_ids`` as lent, atomically.
+
+    Uses one ``UPDATE ... WHERE available`` (with ``RETURNING`` where the
+    database supports it, one statement per book elsewhere). The version
+    of each claimed book is incremented, so that edits based on an
+    earlier read fail instead of overwriting the change.
+
+    Args:
+        book_ids (iterable): Ids of the books to claim
+        now (datetime): Time of the change, defaults to now
+
+    Returns:
+        set: Ids of the books claimed by this transaction
+    """
+    from app import db
+    from models import Book
+
+    now = now or datetime.utcnow()
+    book_ids = list(book_ids)
+    claim = update(Book).where(Book.available == True).values(
+        available=False, version_id=Book.version_id + 1, updated_at=now
+    ).execution_options(synchronize_session='fetch')
+
+    if db.session.get_bind().dialect.update_returning:
+        claimed = set(db.session.scalars(claim.where(Book.id.in_(book_ids)).returning(Book.id)))
+    else:
+        claimed = {book_id for book_id in book_ids
+                   if db.session.execute(claim.where(Book.id == book_id)).rowcount}
+
+    # The bulk update bypasses the mapper events that keep the counters
+    adjust_statistics(db.session, {'books.available': -len(claimed)})
+    return claimed
+
+
+def return_books(member_id, book_ids, now=None):
+    """
+    Take back several books from one member in a single transaction.
+
+    The open loans of the listed books are loaded with one query, and
+    their books with another. Fines are computed at the time of the
+    return. Books the member does not have on loan are reported and
+    skipped. The caller commits.
+
+    Args:
+        member_id (int): The returning member
+        book_ids (list): Ids of the books scanned at the desk
+        now (datetime): Return time, defaults to now
+
+    Returns:
+        tuple: The member, the per-item results in the order of
+        ``book_ids`` (successful items hold their ``loan``, ``book`` and
+        ``fine``) and the total fine
+
+    Raises:
+        CirculationError: If the member does not exist
+    """
+    from app import db
+    from models import Book, Loan, Member
+
+    member = db.session.get(Member, member_id)
+    if member is None:
+        raise CirculationError('Member not found', 404)
+
+    now = now or datetime.utcnow()
+    open_loans = {
+        loan.book_id: loan for loan in Loan.query.filter(
+            Loan.member_id == member.id,
+            Loan.book_id.in_(set(book_ids)),
+            Loan.returned == False
+        )
+    }
+    books = {book.id: book for book in Book.query.filter(Book.id.in_(open_loans))} if open_loans else {}
+
+    results, total_fine = [], 0
+    for book_id in book_ids:
+        loan = open_loans.pop(book_id, None)
+        if loan is None:
+            results.append({'book_id': book_id, 'success': False,
+                            'error': 'This member has no open loan for this book'})
+            continue
+
+        book = books[loan.book_id]
+        fine = return_loan(loan, book, now)
+
+        total_fine += fine
+        results.append({'book_id': book_id, 'success': True, 'loan': loan, 'book': book, 'fine': fine})
+
+    return member, results, total_fine
+
+
+def return_loan(loan, book=None, now=None):
+    """
+    Close a loan and make its book available again.
+
+    Loans and books carry a version column: if another request returns
+    the same loan concurrently, the commit of the later one fails with
+    ``StaleDataError`` instead of recording a second return. The caller
+    commits.
+
+    Args:
+        loan (Loan): The loan returned
+        book (Book): Its book, if already loaded
+        now (datetime): Return time, defaults to now
+
+    Returns:
+        float: The fine due for the late days, taken before the return
+
+    Raises:
+        CirculationError: If the loan is already returned
+    """
+    from app import db
+    from models import Book
+
+    if loan.returned:
+        raise CirculationError('This book has already been returned')
+
+    now = now or datetime.utcnow()
+    fine = loan.calculate_fine(now=now)
+    loan.returned = True
+    loan.return_date = now
+
+    book = book or db.session.get(Book, loan.book_id)
+    if book:
+        book.available = True
+    return fine
+
+
+def refresh_loans(loans):
+    """
+    Reload committed loans, with their books and members, in one query.
+
+    Commits expire every loaded object; this avoids reloading the items of
+    a batch one by one when they are serialized or notified afterwards.
+    """
+    from models import Loan
+    from sqlalchemy.orm import joinedload
+
+    if loans:
+        Loan.query.options(joinedload(Loan.book), joinedload(Loan.member)).filter(
+            Loan.id.in_([loan.id for loan in loans])
+        ).all()
+
+
+def _active_member(member_id):
+    """Load a member allowed to borrow, or refuse the batch."""
+    from app import db
+    from models import Member
+
+    member = db.session.get(Member, member_id)
+    if member is None:
+        raise CirculationError('Member not found', 404)
+    if not member.active:
+        raise CirculationError('This member is not active')
+    return member
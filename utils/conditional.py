@@ -0,0 +1,54 @@
+import hashlib
+import json
+from datetime import timezone
+
+from flask import Response, jsonify, request
+
+
+def make_etag(*parts):
+    """
+    Build a strong entity tag from the values a representation depends on.
+
+    Args:
+        *parts: JSON-serializable values (datetimes are converted to text)
+
+    Returns:
+        str: An opaque tag, equal for equal parts
+    """
+    raw = json.dumps(parts, default=str, separators=(',', ':'))
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def conditional_json(etag, build, last_modified=None):
+    """
+    Answer a GET with a JSON body, or with 304 Not Modified when the client copy is current.
+
+    ``If-None-Match`` is compared strongly and takes precedence over
+    ``If-Modified-Since``, as required by RFC 9110.
+
+    Args:
+        etag (str): Strong entity tag of the current representation
+        build (callable): Returns the data to serialize; only called when
+            the body is sent
+        last_modified (datetime): Naive UTC modification time, if known
+
+    Returns:
+        Response: The 200 or 304 response carrying the validators
+    """
+    if last_modified is not None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc, microsecond=0)
+
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    else:
+        fresh = (last_modified is not None and request.if_modified_since is not None
+                 and last_modified <= request.if_modified_since)
+
+    response = Response(status=304) if fresh else jsonify(build())
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Clients may keep the body but must revalidate before reusing it
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
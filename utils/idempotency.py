@@ -0,0 +1,206 @@
+import functools
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app, jsonify, make_response, request
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from utils.conditional import make_etag
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+# Stored outcomes are replayed for a day unless IDEMPOTENCY_KEY_TTL says otherwise
+DEFAULT_KEY_TTL = 24 * 3600
+
+# A first request still unfinished after this many seconds is considered abandoned
+IN_PROGRESS_TIMEOUT = 60
+
+# Conflicts ask the client to retry: like server errors, they are not stored
+RETRYABLE_STATUSES = (409, 429)
+
+PURGE_BATCH_SIZE = 1000
+
+
+def idempotent(view):
+    """
+    Make a mutating API view safe to retry with an ``Idempotency-Key`` header.
+
+    The first request with a key runs the view and stores its status and
+    body; retries with the same key and the same request get the stored
+    response back, marked ``Idempotent-Replayed: true``, without running
+    the view again. Server errors and conflicts (``RETRYABLE_STATUSES``)
+    are not stored, so they can be retried. Requests without the header
+    are not affected.
+
+    The response is stored in its own transaction, after the one of the
+    view: if the process dies between the two, the key is left in
+    progress and a retry made once ``IN_PROGRESS_TIMEOUT`` has passed runs
+    the view a second time.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return _error(f'{IDEMPOTENCY_HEADER} is limited to {MAX_KEY_LENGTH} characters', 400)
+
+        fingerprint = make_etag(request.method, request.path, request.get_data(as_text=True))
+        stored = _claim(key, fingerprint)
+        if stored is not None:
+            return stored
+
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            _release(key)
+            raise
+
+        if response.status_code >= 500 or response.status_code in RETRYABLE_STATUSES:
+            _release(key)
+        else:
+            _store(key, response)
+        return response
+    return wrapper
+
+
+def purge_expired_keys(now=None, batch_size=PURGE_BATCH_SIZE):
+    """
+    Delete the expired idempotency keys.
+
+    Keys are deleted in batches, each committed on its own, so that the
+    purge never holds long locks on the table.
+
+    Args:
+        now (datetime): Reference time, defaults to now
+        batch_size (int): Keys deleted per statement
+
+    Returns:
+        int: Number of keys deleted
+    """
+    from app import db
+    from models import IdempotencyKey
+
+    now = now or datetime.utcnow()
+    purged = 0
+    while True:
+        keys = db.session.scalars(
+            select(IdempotencyKey.key).where(IdempotencyKey.expires_at <= now)
+            .order_by(IdempotencyKey.expires_at).limit(batch_size)
+        ).all()
+        if keys:
+            db.session.execute(delete(IdempotencyKey).where(
+                IdempotencyKey.key.in_(keys), IdempotencyKey.expires_at <= now
+            ))
+            db.session.commit()
+            purged += len(keys)
+        if len(keys) < batch_size:
+            return purged
+
+
+def start_purge_thread(app, interval):
+    """
+    Purge the expired idempotency keys every ``interval`` seconds, in a daemon thread.
+
+    Every process runs its own thread; concurrent purges only delete
+    what the others left.
+    """
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                with app.app_context():
+                    purged = purge_expired_keys()
+                if purged:
+                    logging.info(f"Purged {purged} expired idempotency keys")
+            except Exception:
+                logging.exception("Purging the expired idempotency keys failed")
+
+    thread = threading.Thread(target=run, name='idempotency-purge', daemon=True)
+    thread.start()
+    return thread
+
+
+def _error(message, status):
+    return jsonify({
+        'success': False,
+        'error': message
+    }), status
+
+
+def _claim(key, fingerprint):
+    """
+    Reserve ``key`` for this request, or answer from what is stored under it.
+
+    Returns:
+        None if the view must run, otherwise the response to send
+    """
+    from app import db
+    from models import IdempotencyKey
+
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=current_app.config.get('IDEMPOTENCY_KEY_TTL', DEFAULT_KEY_TTL))
+
+    # A Core insert: an ORM instance would clash with a row of the key already in the identity map
+    try:
+        db.session.execute(insert(IdempotencyKey).values(
+            key=key, fingerprint=fingerprint, created_at=now, expires_at=expires_at
+        ))
+        db.session.commit()
+        return None
+    except IntegrityError:
+        db.session.rollback()
+
+    record = db.session.get(IdempotencyKey, key, populate_existing=True)
+    if record is not None and record.expires_at > now:
+        if record.fingerprint != fingerprint:
+            return _error(f'This {IDEMPOTENCY_HEADER} was already used for a different request', 422)
+        if record.status_code is not None:
+            response = current_app.response_class(record.body, status=record.status_code,
+                                                  mimetype='application/json')
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+        if record.created_at > now - timedelta(seconds=IN_PROGRESS_TIMEOUT):
+            response = make_response(_error(f'A request with this {IDEMPOTENCY_HEADER} is in progress', 409))
+            response.headers['Retry-After'] = '1'
+            return response
+
+    # The key expired or its first request was abandoned: take it over, unless another retry just did
+    if record is None:
+        return _claim(key, fingerprint)
+    taken = db.session.execute(
+        update(IdempotencyKey).where(
+            IdempotencyKey.key == key,
+            IdempotencyKey.created_at == record.created_at
+        ).values(fingerprint=fingerprint, status_code=None, body=None, created_at=now, expires_at=expires_at)
+    ).rowcount
+    db.session.commit()
+    if taken:
+        return None
+    return _error(f'A request with this {IDEMPOTENCY_HEADER} is in progress', 409)
+
+
+def _store(key, response):
+    """Record the response of the request holding ``key``."""
+    from app import db
+    from models import IdempotencyKey
+
+    db.session.rollback()
+    db.session.execute(update(IdempotencyKey).where(IdempotencyKey.key == key).values(
+        status_code=response.status_code, body=response.get_data(as_text=True)
+    ))
+    db.session.commit()
+
+
+def _release(key):
+    """Forget ``key``, so that the request can be retried."""
+    from app import db
+    from models import IdempotencyKey
+
+    db.session.rollback()
+    db.session.execute(delete(IdempotencyKey).where(IdempotencyKey.key == key))
+    db.session.commit()
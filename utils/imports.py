@@ -0,0 +1,335 @@
+import csv
+import io
+import json
+import re
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.exc import IntegrityError
+
+from utils.rollups import adjust_rollups
+from utils.statistics import adjust_statistics
+
+IMPORT_FORMATS = ('csv', 'ndjson')
+
+# Rows looked up and inserted per statement, and committed together
+IMPORT_CHUNK_SIZE = 1000
+
+# Errors listed in an import report; further errors are only counted
+MAX_REPORTED_ERRORS = 1000
+
+BOOK_FIELDS = ('title', 'author', 'isbn', 'category', 'publication_year', 'description')
+MEMBER_FIELDS = ('first_name', 'last_name', 'email', 'phone', 'address')
+
+# Deliberately loose: one @, no spaces, a dot in the domain
+EMAIL_PATTERN = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+
+def import_format(filename=None, content_type=None):
+    """
+    Guess the format of an import from its file name or content type.
+
+    Returns:
+        str: One of ``IMPORT_FORMATS``, or None when it cannot be told
+    """
+    if filename:
+        extension = filename.rsplit('.', 1)[-1].lower()
+        if extension in ('ndjson', 'jsonl'):
+            return 'ndjson'
+        if extension == 'csv':
+            return 'csv'
+    if content_type in ('application/x-ndjson', 'application/jsonl', 'application/json-seq'):
+        return 'ndjson'
+    if content_type in ('text/csv', 'application/csv'):
+        return 'csv'
+    return None
+
+
+def read_records(stream, fmt):
+    """
+    Read the records of a CSV or NDJSON text stream one at a time.
+
+    CSV headers are matched case-insensitively. A record that cannot be
+    parsed is reported without stopping the import, except for malformed
+    CSV, after which the rest of the file cannot be trusted.
+
+    Args:
+        stream (TextIO): The input, opened in text mode with ``newline=''``
+        fmt (str): One of ``IMPORT_FORMATS``
+
+    Yields:
+        tuple: ``(line, record, error)``; ``record`` is a dict and ``error``
+        None, or the other way round
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        if reader.fieldnames:
+            reader.fieldnames = [name.strip().lower() for name in reader.fieldnames]
+        try:
+            for record in reader:
+                yield reader.line_num, record, None
+        except csv.Error as e:
+            yield reader.line_num, None, f'Malformed CSV: {e}'
+        return
+
+    for line, text in enumerate(stream, 1):
+        if not text.strip():
+            continue
+        try:
+            record = json.loads(text)
+        except ValueError as e:
+            yield line, None, f'Invalid JSON: {e}'
+            continue
+        if isinstance(record, dict):
+            yield line, {str(key).lower(): value for key, value in record.items()}, None
+        else:
+            yield line, None, 'Expected a JSON object'
+
+
+def import_books(stream, fmt='csv', chunk_size=IMPORT_CHUNK_SIZE, dry_run=False):
+    """
+    Add the books of a CSV or NDJSON feed to the catalog.
+
+    Books whose ISBN is already known, in the catalog or earlier in the
+    feed, are skipped; books without an ISBN are always added. See
+    ``import_records`` for the chunking and the report.
+
+    Args:
+        stream (TextIO): The input, opened in text mode with ``newline=''``
+        fmt (str): One of ``IMPORT_FORMATS``
+        chunk_size (int): Number of rows per lookup, insert and commit
+        dry_run (bool): Only validate the feed, without adding anything
+
+    Returns:
+        dict: The import report
+    """
+    from models import Book
+
+    return import_records(stream, fmt, _book_values, Book, Book.isbn, lambda values: values['isbn'],
+                          _record_books, 'A book with this ISBN already exists', chunk_size, dry_run)
+
+
+def import_members(stream, fmt='csv', chunk_size=IMPORT_CHUNK_SIZE, dry_run=False):
+    """
+    Register the members of a CSV or NDJSON list.
+
+    Emails are compared case-insensitively: members whose email is
+    already registered, or appears earlier in the list, are skipped. See
+    ``import_records`` for the chunking and the report.
+
+    Args:
+        stream (TextIO): The input, opened in text mode with ``newline=''``
+        fmt (str): One of ``IMPORT_FORMATS``
+        chunk_size (int): Number of rows per lookup, insert and commit
+        dry_run (bool): Only validate the list, without registering anyone
+
+    Returns:
+        dict: The import report
+    """
+    from models import Member
+
+    return import_records(stream, fmt, _member_values, Member, func.lower(Member.email),
+                          lambda values: values['email'].lower(), _record_members,
+                          'A member with this email already exists', chunk_size, dry_run)
+
+
+def import_records(stream, fmt, validate, model, key_column, key_of, record_changes,
+                   duplicate_error, chunk_size=IMPORT_CHUNK_SIZE, dry_run=False):
+    """
+    Insert the valid, new records of a CSV or NDJSON stream.
+
+    The input is read as a stream. Rows are validated, then handled in
+    chunks: the keys of a chunk are checked against the table with one
+    ``IN`` query, and the new rows are inserted with one multi-row
+    statement. Each chunk is committed on its own, so a large feed never
+    holds a long transaction and an interrupted import can simply be run
+    again. A dry run performs the same validation and lookups but inserts
+    nothing.
+
+    Args:
+        stream (TextIO): The input, opened in text mode with ``newline=''``
+        fmt (str): One of ``IMPORT_FORMATS``
+        validate (callable): Turns a record into ``(values, error)``
+        model (Model): The model inserted
+        key_column (ColumnElement): Expression identifying duplicates
+        key_of (callable): Returns the key of validated values, or None
+        record_changes (callable): Called with the session and the inserted
+            rows, to keep the counters bypassed by bulk inserts
+        duplicate_error (str): Error reported for duplicate rows
+        chunk_size (int): Number of rows per lookup, insert and commit
+        dry_run (bool): Only validate, without inserting
+
+    Returns:
+        dict: Number of ``rows`` read, rows ``inserted`` (or that would be,
+        in a dry run) and ``duplicates`` skipped, the per-row ``errors`` of
+        the rejected rows (with their ``error_count``) and the ``skipped``
+        duplicate rows
+    """
+    report = {'rows': 0, 'inserted': 0, 'duplicates': 0, 'errors': [], 'error_count': 0,
+              'skipped': [], 'dry_run': dry_run}
+    # Nothing is committed in a dry run, so keys of earlier chunks are remembered instead
+    seen = set() if dry_run else None
+    chunk = []
+
+    def flush():
+        _insert_chunk(chunk, report, seen, model, key_column, key_of, record_changes, duplicate_error)
+        chunk.clear()
+
+    for line, record, error in read_records(stream, fmt):
+        report['rows'] += 1
+        values = None
+        if error is None:
+            values, error = validate(record)
+        if error:
+            _add_error(report, line, error)
+            continue
+
+        chunk.append((line, values))
+        if len(chunk) >= chunk_size:
+            flush()
+
+    if chunk:
+        flush()
+    report['errors'].sort(key=lambda error: error['line'])
+    report['skipped'].sort(key=lambda error: error['line'])
+    return report
+
+
+def error_report_csv(report):
+    """Render the lines of an import report that were not imported as CSV text, rejected or skipped."""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['line', 'error'])
+    for error in sorted(report['errors'] + report['skipped'], key=lambda error: error['line']):
+        writer.writerow([error['line'], error['error']])
+    return output.getvalue()
+
+
+def _add_error(report, line, error):
+    report['error_count'] += 1
+    if len(report['errors']) < MAX_REPORTED_ERRORS:
+        report['errors'].append({'line': line, 'error': error})
+
+
+def _add_skipped(report, line, error):
+    # Duplicates are expected when a feed is imported again: they are not errors
+    if len(report['skipped']) < MAX_REPORTED_ERRORS:
+        report['skipped'].append({'line': line, 'error': error})
+
+
+def _text(record, field, max_length=None):
+    """Read a text field, returning ``(value, error)``."""
+    value = record.get(field)
+    if value is None:
+        return None, None
+    value = str(value).strip()
+    if max_length and len(value) > max_length:
+        return None, f'{field} is longer than {max_length} characters'
+    return value or None, None
+
+
+def _text_values(record, model, fields, required):
+    """Read the text fields of a record, returning ``(values, error)``."""
+    columns = model.__table__.c
+    values = {}
+    for field in fields:
+        values[field], error = _text(record, field, getattr(columns[field].type, 'length', None))
+        if error:
+            return None, error
+
+    for field in required:
+        if not values[field]:
+            return None, f'Missing required field: {field}'
+    return values, None
+
+
+def _book_values(record):
+    """Validate a book record, returning ``(values, error)``."""
+    from models import Book
+
+    values, error = _text_values(record, Book, [field for field in BOOK_FIELDS if field != 'publication_year'],
+                                 ('title', 'author'))
+    if error:
+        return None, error
+
+    year = record.get('publication_year')
+    if year in (None, ''):
+        values['publication_year'] = None
+    else:
+        try:
+            values['publication_year'] = int(str(year).strip())
+        except ValueError:
+            return None, f'Invalid publication_year: {year}'
+
+    values['available'] = True
+    return values, None
+
+
+def _member_values(record):
+    """Validate a member record, returning ``(values, error)``."""
+    from models import Member
+
+    values, error = _text_values(record, Member, MEMBER_FIELDS, ('first_name', 'last_name', 'email'))
+    if error:
+        return None, error
+
+    if not EMAIL_PATTERN.match(values['email']):
+        return None, f"Invalid email: {values['email']}"
+
+    values['active'] = True
+    values['registration_date'] = datetime.utcnow()
+    return values, None
+
+
+def _record_books(session, rows):
+    adjust_statistics(session, {'books.total': len(rows), 'books.available': len(rows)})
+
+
+def _record_members(session, rows):
+    adjust_statistics(session, {'members.total': len(rows), 'members.active': len(rows)})
+    adjust_rollups(session, Counter(('registrations', row['registration_date'].date()) for row in rows))
+
+
+def _insert_chunk(chunk, report, seen, model, key_column, key_of, record_changes, duplicate_error):
+    """Insert a chunk of validated rows, skipping known keys, and commit it."""
+    from app import db
+
+    # A concurrent import may insert the same keys between the lookup and
+    # the insert; the chunk is then looked up again once.
+    for attempt in range(2):
+        keys = {key_of(values) for _, values in chunk} - {None}
+        known = set(db.session.scalars(select(key_column).where(key_column.in_(keys)))) if keys else set()
+        if seen is not None:
+            known |= seen
+
+        rows, duplicates = [], []
+        for line, values in chunk:
+            key = key_of(values)
+            if key in known:
+                duplicates.append(line)
+                continue
+            if key is not None:
+                known.add(key)
+            rows.append(values)
+
+        if seen is not None:
+            seen.update(key_of(values) for values in rows if key_of(values) is not None)
+            break
+
+        try:
+            if rows:
+                db.session.execute(insert(model), rows)
+                # Bulk inserts bypass the mapper events that keep the counters
+                record_changes(db.session, rows)
+            db.session.commit()
+            break
+        except IntegrityError:
+            db.session.rollback()
+            if attempt:
+                raise
+
+    report['inserted'] += len(rows)
+    report['duplicates'] += len(duplicates)
+    for line in duplicates:
+        _add_skipped(report, line, duplicate_error)
@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, select
+
+# Ledger entries are kept this many days, unless LEDGER_RETENTION_DAYS says otherwise
+DEFAULT_RETENTION_DAYS = 90
+
+PRUNE_BATCH_SIZE = 1000
+
+
+def claim_notices(kind, loans, day_of):
+    """
+    Keep the loans that have no notice of ``kind`` for their threshold day yet, and record them.
+
+    Entries are keyed by the day the notice is about (the day the loan
+    crossed the threshold of the notice), not by the day the job runs, so
+    a period processed again on a later day finds them too. The ledger
+    is checked with one ``IN`` query and the new entries are added with
+    one multi-row insert, in the transaction that queues the notices.
+    Two runs racing past the check cannot both commit: the primary key
+    of the ledger makes the second one fail. The caller commits.
+
+    Args:
+        kind (str): Type of notice, e.g. ``'overdue'``
+        loans (list): Loans about to be notified
+        day_of (callable): Gives the threshold day of a loan
+
+    Returns:
+        list: The loans still to notify, in their original order
+    """
+    from app import db
+    from models import NotificationLedger
+
+    if not loans:
+        return []
+
+    days = {loan.id: day_of(loan) for loan in loans}
+    sent = set(db.session.execute(select(NotificationLedger.loan_id, NotificationLedger.day).where(
+        NotificationLedger.kind == kind,
+        NotificationLedger.loan_id.in_(days)
+    )))
+    pending = [loan for loan in loans if (loan.id, days[loan.id]) not in sent]
+    if pending:
+        db.session.execute(insert(NotificationLedger), [
+            {'loan_id': loan_id, 'kind': kind, 'day': days[loan_id]} for loan_id in {loan.id for loan in pending}
+        ])
+    return pending
+
+
+def prune_ledger(today=None, retention_days=None, batch_size=PRUNE_BATCH_SIZE):
+    """
+    Delete the ledger entries older than the retention period.
+
+    Entries are deleted in batches, each committed on its own.
+
+    Args:
+        today (date): Reference day, defaults to today
+        retention_days (int): Days of entries kept, defaults to
+            ``LEDGER_RETENTION_DAYS``
+        batch_size (int): Entries deleted per statement
+
+    Returns:
+        int: Number of entries deleted
+    """
+    from flask import current_app
+    from app import db
+    from models import NotificationLedger
+
+    today = today or datetime.utcnow().date()
+    if retention_days is None:
+        retention_days = current_app.config.get('LEDGER_RETENTION_DAYS', DEFAULT_RETENTION_DAYS)
+    cutoff = today - timedelta(days=retention_days)
+
+    pruned = 0
+    while True:
+        keys = db.session.execute(
+            select(NotificationLedger.day, NotificationLedger.loan_id)
+            .where(NotificationLedger.day < cutoff).order_by(NotificationLedger.day).limit(batch_size)
+        ).all()
+        # Deleting by day and loan also removes the other kinds of notice of these loans that day
+        for day in {key.day for key in keys}:
+            pruned += db.session.execute(delete(NotificationLedger).where(
+                NotificationLedger.day == day,
+                NotificationLedger.loan_id.in_([key.loan_id for key in keys if key.day == day])
+            )).rowcount
+        if keys:
+            db.session.commit()
+        if len(keys) < batch_size:
+            return pruned
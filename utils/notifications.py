@@ -1,12 +1,16 @@
 import logging
 from datetime import datetime
 
+from utils.outbox import queue_notification
+
 def send_notification(recipient_email, subject, message):
     """
     Simulate sending a notification to a library member.
     
-    In a production environment, this would use an email service or SMS gateway.
-    For this implementation, we'll log the notifications to the console.
+    The notifications are logged to the console. This is the delivery of
+    the default ``log`` transport of the outbox workers (see
+    utils/outbox.py); routes queue their notifications with
+    ``queue_notification`` instead of calling this directly.
     
     Args:
         recipient_email (str): The email address of the recipient
@@ -26,112 +30,170 @@ def send_notification(recipient_email, subject, message):
     logging.info(f"Message: {message}")
     logging.info("-" * 50)
     
-    # In a real implementation, you would send the email here
-    # For example, using smtplib or an email service API
-    
     return True
 
-def send_overdue_notification(loan):
+def overdue_notice(loan, book, member, now=None):
     """
-    Send a notification for an overdue book.
+    Write the notice of a loan now overdue.
     
     Args:
-        loan (Loan): The loan object containing member and book information
+        loan (Loan): The overdue loan
+        book (Book): Its book
+        member (Member): Its borrower
+        now (datetime): Time the fine is computed at, defaults to now
         
     Returns:
-        bool: True if notification was sent successfully, False otherwise
+        tuple: ``(recipient_email, subject, message)``, for ``queue_notifications``
     """
-    from models import Book, Member
+    days_overdue = loan.days_overdue(now)
+    fine = loan.calculate_fine(now=now)
     
-    book = Book.query.get(loan.book_id)
-    member = Member.query.get(loan.member_id)
+    message = (
+        f'Dear {member.full_name()},\n\n'
+        f'The book "{book.title}" by {book.author} is overdue by {days_overdue} days.\n'
+        f'Current fine: ${fine:.2f}\n\n'
+        f'Please return the book as soon as possible to avoid additional fines.'
+    )
     
-    days_overdue = loan.days_overdue()
-    fine = loan.calculate_fine()
+    return member.email, 'Overdue Book Notice', message
+
+def due_reminder(loan, book, member, now=None):
+    """
+    Write the reminder of a loan due soon.
     
-    subject = f"OVERDUE: Your library book is {days_overdue} days late"
+    Args:
+        loan (Loan): The loan due soon
+        book (Book): Its book
+        member (Member): Its borrower
+        now (datetime): Time the remaining days are counted from, defaults to now
+        
+    Returns:
+        tuple: ``(recipient_email, subject, message)``, for ``queue_notifications``
+    """
+    days_remaining = (loan.due_date - (now or datetime.utcnow())).days
     
     message = (
-        f"Dear {member.full_name()},\n\n"
-        f"Our records show that you have not returned the following item:\n\n"
-        f"Title: {book.title}\n"
-        f"Author: {book.author}\n"
-        f"Due Date: {loan.due_date.strftime('%Y-%m-%d')}\n"
-        f"Days Overdue: {days_overdue}\n"
-        f"Current Fine: ${fine:.2f}\n\n"
-        f"Please return this item as soon as possible to avoid additional fines.\n\n"
-        f"Thank you,\n"
-        f"Library Management System"
+        f'Dear {member.full_name()},\n\n'
+        f'This is a reminder that the book "{book.title}" by {book.author} is due in {days_remaining} days.\n'
+        f'Due date: {loan.due_date.strftime("%Y-%m-%d")}\n\n'
+        f'Please return the book on time to avoid fines.'
     )
     
-    return send_notification(member.email, subject, message)
+    return member.email, 'Book Due Date Reminder', message
 
-def send_upcoming_due_reminder(loan):
+def overdue_digest(member, items, now=None):
     """
-    Send a reminder for a book that will be due soon.
+    Write one notice for all the loans of a member that became overdue.
     
     Args:
-        loan (Loan): The loan object containing member and book information
+        member (Member): The borrower
+        items (list): ``(loan, book)`` pairs of the overdue loans
+        now (datetime): Time the fines are computed at, defaults to now
         
     Returns:
-        bool: True if notification was sent successfully, False otherwise
+        tuple: ``(recipient_email, subject, message)``, for ``queue_notifications``
     """
-    from models import Book, Member
-    from datetime import datetime
+    if len(items) == 1:
+        loan, book = items[0]
+        return overdue_notice(loan, book, member, now)
+    
+    lines = "\n".join(
+        f'- "{book.title}" by {book.author}, due {loan.due_date.strftime("%Y-%m-%d")}, '
+        f'{loan.days_overdue(now)} days overdue (${loan.calculate_fine(now=now):.2f})'
+        for loan, book in items
+    )
+    fine = sum(loan.calculate_fine(now=now) for loan, _ in items)
     
-    book = Book.query.get(loan.book_id)
-    member = Member.query.get(loan.member_id)
+    message = (
+        f'Dear {member.full_name()},\n\n'
+        f'The following {len(items)} books are overdue:\n\n'
+        f'{lines}\n\n'
+        f'Current fine: ${fine:.2f}\n\n'
+        f'Please return these books as soon as possible to avoid additional fines.'
+    )
     
-    days_remaining = (loan.due_date - datetime.utcnow()).days
+    return member.email, f'Overdue Book Notice ({len(items)} books)', message
+
+def due_reminder_digest(member, items, now=None):
+    """
+    Write one reminder for all the loans of a member due soon.
     
-    subject = f"Reminder: Your library book is due in {days_remaining} days"
+    Args:
+        member (Member): The borrower
+        items (list): ``(loan, book)`` pairs of the loans due soon
+        now (datetime): Time the remaining days are counted from, defaults to now
+        
+    Returns:
+        tuple: ``(recipient_email, subject, message)``, for ``queue_notifications``
+    """
+    if len(items) == 1:
+        loan, book = items[0]
+        return due_reminder(loan, book, member, now)
+    
+    now = now or datetime.utcnow()
+    lines = "\n".join(
+        f'- "{book.title}" by {book.author}, due {loan.due_date.strftime("%Y-%m-%d")} '
+        f'(in {(loan.due_date - now).days} days)'
+        for loan, book in items
+    )
     
     message = (
-        f"Dear {member.full_name()},\n\n"
-        f"This is a friendly reminder that the following item is due soon:\n\n"
-        f"Title: {book.title}\n"
-        f"Author: {book.author}\n"
-        f"Due Date: {loan.due_date.strftime('%Y-%m-%d')}\n\n"
-        f"Please return this item on or before the due date to avoid late fees.\n\n"
-        f"Thank you,\n"
-        f"Library Management System"
+        f'Dear {member.full_name()},\n\n'
+        f'This is a reminder that the following {len(items)} books are due soon:\n\n'
+        f'{lines}\n\n'
+        f'Please return them on time to avoid fines.'
     )
     
-    return send_notification(member.email, subject, message)
+    return member.email, f'Book Due Date Reminder ({len(items)} books)', message
 
-def send_return_confirmation(loan):
+def queue_batch_loan_confirmation(member, items):
     """
-    Send a confirmation when a book is returned.
+    Queue one confirmation for all the books lent to a member at the desk.
     
     Args:
-        loan (Loan): The loan object containing member and book information
+        member (Member): The borrowing member
+        items (list): ``(loan, book)`` pairs of the new loans
         
     Returns:
-        bool: True if notification was sent successfully, False otherwise
+        OutboxMessage: The queued message; the caller commits
     """
-    from models import Book, Member
+    lines = "\n".join(
+        f'- "{book.title}" by {book.author}, due {loan.due_date.strftime("%Y-%m-%d")}'
+        for loan, book in items
+    )
     
-    book = Book.query.get(loan.book_id)
-    member = Member.query.get(loan.member_id)
+    message = (
+        f"Dear {member.full_name()},\n\n"
+        f"You have borrowed the following {len(items)} items:\n\n"
+        f"{lines}\n\n"
+        f"Thank you for using our library services."
+    )
     
-    subject = "Book Return Confirmation"
+    return queue_notification(member.email, 'Book Loan Confirmation', message)
+
+def queue_batch_return_confirmation(member, items, fine):
+    """
+    Queue one confirmation for all the books returned by a member at the desk.
     
-    fine = 0
-    fine_message = ""
-    if loan.is_overdue():
-        fine = loan.calculate_fine()
-        fine_message = f"\nThis return was {loan.days_overdue()} days late, resulting in a fine of ${fine:.2f}."
+    Args:
+        member (Member): The returning member
+        items (list): ``(loan, book)`` pairs of the returned loans
+        fine (float): Total fine of the late returns
+        
+    Returns:
+        OutboxMessage: The queued message; the caller commits
+    """
+    lines = "\n".join(f'- "{book.title}" by {book.author}' for loan, book in items)
+    fine_message = f"\nSome items were returned late, resulting in a fine of ${fine:.2f}.\n" if fine > 0 else ""
     
     message = (
         f"Dear {member.full_name()},\n\n"
-        f"We confirm that you have returned the following item:\n\n"
-        f"Title: {book.title}\n"
-        f"Author: {book.author}\n"
-        f"Return Date: {loan.return_date.strftime('%Y-%m-%d')}"
-        f"{fine_message}\n\n"
+        f"We confirm that you have returned the following {len(items)} items:\n\n"
+        f"{lines}\n"
+        f"{fine_message}\n"
         f"Thank you for using our library services.\n\n"
         f"Regards,\n"
         f"Library Management System"
     )
     
-    return send_notification(member.email, subject, message)
+    return queue_notification(member.email, 'Book Return Confirmation', message)
@@ -0,0 +1,364 @@
+import logging
+import random
+import smtplib
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, func, insert, select, update
+from sqlalchemy.orm import Session
+
+from utils.smtp_pool import MAX_MESSAGES_PER_CONNECTION, PooledSMTPTransport, SMTPPool, build_message
+
+# Messages claimed, sent over one connection and recorded per round
+OUTBOX_BATCH_SIZE = 100
+
+# A message is given up after this many failed deliveries
+MAX_ATTEMPTS = 8
+
+# Retries wait 30 s, 1 min, 2 min... up to an hour, with some jitter
+RETRY_BASE_DELAY = 30
+RETRY_MAX_DELAY = 3600
+
+# A claimed message whose worker died is delivered again after this many seconds
+CLAIM_TIMEOUT = 300
+
+# Set by the commits that queued messages, to wake the in-process workers up
+_queued = threading.Event()
+
+# SMTP connection pool shared by the outbox workers of the process, created with the first pooled transport
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# Registered once for the process; committing with queued messages wakes the workers
+@event.listens_for(Session, 'after_commit')
+def _wake_workers(session):
+    if session.info.pop('outbox_queued', None):
+        _queued.set()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_rolled_back(session, previous_transaction):
+    session.info.pop('outbox_queued', None)
+
+
+def queue_notification(recipient_email, subject, message):
+    """
+    Add a notification to the outbox.
+
+    The message is written in the current transaction, so it is sent if
+    and only if the change it reports is committed; delivery is left to
+    the outbox workers. The caller commits.
+
+    Args:
+        recipient_email (str): The email address of the recipient
+        subject (str): The subject of the notification
+        message (str): The body of the notification
+
+    Returns:
+        OutboxMessage: The queued message, added to the session
+    """
+    from app import db
+    from models import OutboxMessage
+
+    queued = OutboxMessage(recipient=recipient_email, subject=subject, body=message)
+    db.session.add(queued)
+    db.session.info['outbox_queued'] = True
+    return queued
+
+
+def queue_notifications(messages):
+    """
+    Add many notifications to the outbox with a single statement.
+
+    Like ``queue_notification``, the messages are written in the current
+    transaction. The caller commits.
+
+    Args:
+        messages (list): ``(recipient_email, subject, message)`` tuples
+
+    Returns:
+        int: Number of messages queued
+    """
+    from app import db
+    from models import OutboxMessage
+
+    if messages:
+        db.session.execute(insert(OutboxMessage), [
+            {'recipient': recipient, 'subject': subject, 'body': body} for recipient, subject, body in messages
+        ])
+        db.session.info['outbox_queued'] = True
+    return len(messages)
+
+
+def deliver_outbox(transport, batch_size=OUTBOX_BATCH_SIZE, now=None):
+    """
+    Deliver one batch of due outbox messages.
+
+    The due messages are claimed with one conditional UPDATE and
+    committed, so concurrent workers never send the same message twice;
+    they are then sent over a single connection of ``transport``. Sent
+    messages are marked in one statement; failed ones are retried later
+    with an exponential backoff, until ``MAX_ATTEMPTS``.
+
+    Args:
+        transport: An open-able transport, see ``LogTransport``
+        batch_size (int): Largest number of messages sent
+        now (datetime): Reference time, defaults to now
+
+    Returns:
+        dict: Number of messages ``sent``, ``retried`` later and ``failed``
+        for good
+    """
+    from app import db
+    from models import OutboxMessage
+
+    now = now or datetime.utcnow()
+    messages = _claim_messages(batch_size, now)
+    if not messages:
+        return {'sent': 0, 'retried': 0, 'failed': 0}
+
+    sent, errors = [], {}
+    try:
+        with transport:
+            for message in messages:
+                try:
+                    transport.send(message.recipient, message.subject, message.body)
+                    sent.append(message.id)
+                except Exception as e:
+                    errors[message.id] = e
+    except Exception as e:
+        # The connection itself failed: everything not sent yet is retried
+        errors.update({message.id: e for message in messages if message.id not in sent and message.id not in errors})
+
+    finished = datetime.utcnow()
+    if sent:
+        db.session.execute(update(OutboxMessage).where(OutboxMessage.id.in_(sent)).values(
+            status='sent', sent_at=finished, last_error=None
+        ).execution_options(synchronize_session=False))
+
+    retried = failed = 0
+    for message in messages:
+        error = errors.get(message.id)
+        if error is None:
+            continue
+        if message.attempts >= MAX_ATTEMPTS:
+            values = {'status': 'failed'}
+            failed += 1
+        else:
+            values = {'status': 'pending',
+                      'next_attempt_at': finished + timedelta(seconds=retry_delay(message.attempts))}
+            retried += 1
+        logging.warning(f"Delivering notification {message.id} to {message.recipient} failed: {error}")
+        db.session.execute(update(OutboxMessage).where(OutboxMessage.id == message.id).values(
+            last_error=str(error)[:255], **values
+        ).execution_options(synchronize_session=False))
+
+    db.session.commit()
+    return {'sent': len(sent), 'retried': retried, 'failed': failed}
+
+
+def retry_delay(attempts):
+    """Seconds to wait before the next delivery of a message that failed ``attempts`` times."""
+    delay = min(RETRY_BASE_DELAY * 2 ** (attempts - 1), RETRY_MAX_DELAY)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def start_outbox_workers(app, threads=1, interval=5):
+    """
+    Drain the outbox in ``threads`` daemon threads.
+
+    Each thread has its own transport, built from the configuration, and
+    delivers batches until the outbox is empty, then waits ``interval``
+    seconds or until a commit of this process queues a message. The
+    ``deliver-notifications`` command runs the same loop as a separate
+    process.
+
+    Returns:
+        list: The started threads
+    """
+    workers = []
+    for number in range(threads):
+        worker = threading.Thread(target=run_outbox_worker, args=(app, interval, _queued),
+                                  name=f'outbox-worker-{number}', daemon=True)
+        worker.start()
+        workers.append(worker)
+    return workers
+
+
+def run_outbox_worker(app, interval=5, wakeup=None, stop=None):
+    """
+    Deliver the outbox messages as they become due, until ``stop`` is set.
+
+    Args:
+        app (Flask): The application, for its context and configuration
+        interval (int): Seconds between polls of an empty outbox
+        wakeup (threading.Event): Set to poll before the interval ends
+        stop (threading.Event): Set to end the loop
+    """
+    transport = create_transport(app.config)
+    wakeup = wakeup or threading.Event()
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        try:
+            with app.app_context():
+                result = deliver_outbox(transport, app.config.get('OUTBOX_BATCH_SIZE', OUTBOX_BATCH_SIZE))
+            if sum(result.values()):
+                logging.info(f"Outbox: {result['sent']} sent, {result['retried']} retried, "
+                             f"{result['failed']} failed")
+                continue
+        except Exception:
+            logging.exception("Delivering the outbox failed")
+        wakeup.wait(interval)
+        wakeup.clear()
+
+
+class LogTransport:
+    """Write notifications to the log, with ``send_notification``."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def send(self, recipient, subject, body):
+        from utils.notifications import send_notification
+
+        send_notification(recipient, subject, body)
+
+
+class SMTPTransport:
+    """
+    Send notifications through an SMTP server, one connection per batch.
+
+    Use as a context manager around the messages of a batch; not safe to
+    share between threads.
+    """
+
+    def __init__(self, host, port=25, sender='library@localhost', username=None, password=None,
+                 starttls=False, timeout=10):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self._smtp = None
+
+    def __enter__(self):
+        self._smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                self._smtp.starttls()
+            if self.username:
+                self._smtp.login(self.username, self.password)
+        except Exception:
+            self._smtp.close()
+            self._smtp = None
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        smtp, self._smtp = self._smtp, None
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+        return False
+
+    def send(self, recipient, subject, body):
+        self._smtp.send_message(build_message(self.sender, recipient, subject, body))
+
+
+def create_transport(config):
+    """
+    Build the notification transport described by the application configuration.
+
+    ``NOTIFICATION_TRANSPORT`` is ``'log'`` (default), ``'smtp'`` or
+    ``'smtp-pool'``, with ``SMTP_HOST``, ``SMTP_PORT``, ``SMTP_SENDER`` and
+    optionally ``SMTP_USERNAME``, ``SMTP_PASSWORD`` and ``SMTP_STARTTLS``.
+    ``'smtp'`` opens a connection per batch; ``'smtp-pool'`` keeps up to
+    ``SMTP_POOL_SIZE`` connections open between batches, each sending up to
+    ``SMTP_MAX_MESSAGES_PER_CONNECTION`` messages, at most
+    ``SMTP_RATE_LIMIT`` messages per second in all (0 for no limit).
+    """
+    transport = config.get('NOTIFICATION_TRANSPORT', 'log')
+    if transport == 'smtp-pool':
+        return PooledSMTPTransport(smtp_pool(config))
+    if transport == 'smtp':
+        return SMTPTransport(config.get('SMTP_HOST', 'localhost'), config.get('SMTP_PORT', 25),
+                             config.get('SMTP_SENDER', 'library@localhost'), config.get('SMTP_USERNAME'),
+                             config.get('SMTP_PASSWORD'), config.get('SMTP_STARTTLS', False))
+    return LogTransport()
+
+
+def smtp_pool(config):
+    """Return the SMTP connection pool of the process, creating it from ``config`` on first use."""
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = SMTPPool(
+                config.get('SMTP_HOST', 'localhost'), config.get('SMTP_PORT', 25),
+                config.get('SMTP_SENDER', 'library@localhost'), config.get('SMTP_USERNAME'),
+                config.get('SMTP_PASSWORD'), config.get('SMTP_STARTTLS', False),
+                size=config.get('SMTP_POOL_SIZE', 4),
+                max_messages=config.get('SMTP_MAX_MESSAGES_PER_CONNECTION', MAX_MESSAGES_PER_CONNECTION),
+                rate_limit=config.get('SMTP_RATE_LIMIT', 0)
+            )
+        return _pool
+
+
+def delivery_stats():
+    """
+    Describe the state of the outbox and the deliveries of this process.
+
+    Returns:
+        dict: Number of outbox messages per ``status``, and the ``smtp``
+        statistics of the connection pool (None when it is not in use)
+    """
+    from app import db
+    from models import OutboxMessage
+
+    counts = dict(db.session.execute(
+        select(OutboxMessage.status, func.count()).group_by(OutboxMessage.status)
+    ).all())
+    return {
+        'outbox': {status: counts.get(status, 0) for status in ('pending', 'sending', 'sent', 'failed')},
+        'smtp': _pool.stats() if _pool is not None else None,
+    }
+
+
+def _claim_messages(batch_size, now):
+    """Claim the due messages for this worker, commit the claim and return them."""
+    from app import db
+    from models import OutboxMessage
+
+    due = (OutboxMessage.status.in_(('pending', 'sending')), OutboxMessage.next_attempt_at <= now)
+    ids = db.session.scalars(
+        select(OutboxMessage.id).where(*due)
+        .order_by(OutboxMessage.next_attempt_at, OutboxMessage.id).limit(batch_size)
+    ).all()
+    if not ids:
+        return []
+
+    # Messages claimed by a worker come back once the claim times out
+    claim = update(OutboxMessage).where(*due).values(
+        status='sending', attempts=OutboxMessage.attempts + 1,
+        next_attempt_at=now + timedelta(seconds=CLAIM_TIMEOUT)
+    ).execution_options(synchronize_session=False)
+
+    if db.session.get_bind().dialect.update_returning:
+        claimed = list(db.session.scalars(claim.where(OutboxMessage.id.in_(ids)).returning(OutboxMessage.id)))
+    else:
+        claimed = [id for id in ids if db.session.execute(claim.where(OutboxMessage.id == id)).rowcount]
+    db.session.commit()
+
+    if not claimed:
+        return []
+    return db.session.execute(
+        select(OutboxMessage.id, OutboxMessage.recipient, OutboxMessage.subject, OutboxMessage.body,
+               OutboxMessage.attempts).where(OutboxMessage.id.in_(claimed)).order_by(OutboxMessage.id)
+    ).all()
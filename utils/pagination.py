@@ -0,0 +1,160 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor cannot be decoded."""
+
+
+def encode_cursor(values):
+    """
+    Encode the sort key values of the last row of a page as an opaque string.
+
+    Args:
+        values (list): Sort key values, the unique id last
+
+    Returns:
+        str: A URL-safe cursor
+    """
+    payload = [{'dt': value.isoformat()} if isinstance(value, datetime) else value
+               for value in values]
+    raw = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor produced by ``encode_cursor``.
+
+    Args:
+        cursor (str): The opaque cursor sent by the client
+
+    Returns:
+        list: The sort key values
+
+    Raises:
+        InvalidCursor: If the cursor is malformed
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        payload = json.loads(raw)
+        if not isinstance(payload, list):
+            raise InvalidCursor('Invalid cursor')
+        return [datetime.fromisoformat(value['dt']) if isinstance(value, dict) else value
+                for value in payload]
+    except (binascii.Error, UnicodeDecodeError, ValueError, KeyError, TypeError) as e:
+        raise InvalidCursor('Invalid cursor') from e
+
+
+def page_size(limit):
+    """Clamp a requested page size to the allowed range."""
+    if not limit:
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def keyset_paginate(query, sort_keys, cursor=None, limit=None):
+    """
+    Fetch one page of a query using keyset (seek) pagination.
+
+    Rows are located relative to the last row of the previous page rather
+    than skipped with OFFSET, so the cost of a page does not grow with its
+    depth as long as an index covers the sort keys.
+
+    Args:
+        query (Query): The filtered query, without ordering
+        sort_keys (list): ``(expression, descending)`` pairs; the last one
+            must be unique (usually the primary key) to make the order stable
+        cursor (str): Cursor returned with the previous page, if any
+        limit (int): Requested page size
+
+    Returns:
+        tuple: The rows of the page and the cursor of the next page, or
+        None when this is the last page
+
+    Raises:
+        InvalidCursor: If the cursor is malformed
+    """
+    limit = page_size(limit)
+
+    if cursor:
+        values = decode_cursor(cursor)
+        if len(values) != len(sort_keys):
+            raise InvalidCursor('Invalid cursor')
+        query = query.filter(_after(sort_keys, values))
+
+    ordering = [expression.desc() if descending else expression.asc()
+                for expression, descending in sort_keys]
+    labelled = [expression.label(f'keyset_{i}') for i, (expression, _) in enumerate(sort_keys)]
+
+    # Fetch one extra row to know whether another page follows
+    rows = query.order_by(None).order_by(*ordering).add_columns(*labelled).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(list(rows[-1][1:]))
+
+    return [row[0] for row in rows], next_cursor
+
+
+def _after(sort_keys, values):
+    """Build the condition selecting rows that sort after the given key values."""
+    clauses = []
+    for i, (expression, descending) in enumerate(sort_keys):
+        ties = [sort_keys[j][0] == values[j] for j in range(i)]
+        beyond = expression < values[i] if descending else expression > values[i]
+        clauses.append(and_(*ties, beyond))
+    return or_(*clauses)
+
+
+# HTML index pages use classic numbered pages with a bounded page size
+INDEX_PAGE_SIZE = 25
+INDEX_MAX_PAGE_SIZE = 100
+
+
+def paginate_index(query, args, sortable, default_sort, default_direction='asc', tiebreaker=None):
+    """
+    Sort and paginate the query behind an HTML index page.
+
+    Args:
+        query (Query): The filtered query, without ordering
+        args (MultiDict): Request arguments (``page``, ``per_page``, ``sort``
+            and ``direction``)
+        sortable (dict): Allowed sort names mapped to a column or a tuple of
+            columns
+        default_sort (str): Sort name used when none or an unknown one is given
+        default_direction (str): ``'asc'`` or ``'desc'``
+        tiebreaker (Column): Unique column appended to keep the order stable
+
+    Returns:
+        tuple: The Pagination object, the sort name and the direction applied
+    """
+    sort = args.get('sort', default_sort)
+    if sort not in sortable:
+        sort = default_sort
+    direction = args.get('direction', default_direction)
+    if direction not in ('asc', 'desc'):
+        direction = default_direction
+
+    columns = sortable[sort]
+    if not isinstance(columns, tuple):
+        columns = (columns,)
+    if tiebreaker is not None:
+        columns += (tiebreaker,)
+    ordering = [column.desc() if direction == 'desc' else column.asc() for column in columns]
+
+    pagination = query.order_by(*ordering).paginate(
+        page=args.get('page', 1, type=int),
+        per_page=args.get('per_page', INDEX_PAGE_SIZE, type=int),
+        max_per_page=INDEX_MAX_PAGE_SIZE,
+        error_out=False
+    )
+    return pagination, sort, direction
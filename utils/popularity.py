@@ -0,0 +1,206 @@
+from collections import Counter
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import func, insert, select, update
+
+from utils.sql import day_of, upsert_add
+
+# Sliding windows, in days, over which loans are ranked
+POPULARITY_WINDOWS = (7, 30, 365)
+POPULARITY_KINDS = ('book', 'category', 'member')
+
+# Job state rows holding the first day still counted in each window
+WINDOW_JOB = 'popularity.{}'
+
+
+def window_start(window, today):
+    """Return the first day of a ``window``-day window ending on ``today``."""
+    return today - timedelta(days=window - 1)
+
+
+def adjust_popularity(session, deltas, today=None):
+    """
+    Add loan changes to the daily popularity counts and the sliding windows.
+
+    Called automatically after each ORM flush. Code that writes loans with
+    bulk or Core statements must call it itself, in the same transaction.
+
+    Args:
+        session (Session): The session of the transaction
+        deltas (dict): Changes keyed by ``(kind, key, day)``, the key being a
+            book id, a member id or a category name (``''`` when uncategorized)
+        today (date): Current day, defaults to today
+    """
+    from models import PopularityDaily, PopularityWindow
+
+    daily = Counter()
+    for (kind, key, day), delta in deltas.items():
+        daily[(kind, str(key), day)] += delta
+    daily = {bucket: delta for bucket, delta in daily.items() if delta}
+    if not daily:
+        return
+
+    upsert_add(session, PopularityDaily.__table__,
+               [{'kind': kind, 'key': key, 'day': day, 'loans': loans}
+                for (kind, key, day), loans in sorted(daily.items())],
+               ['kind', 'key', 'day'], 'loans')
+
+    # A day counts in a window until the expiry job moves the window past it
+    windows = Counter()
+    for window, start in _window_starts(session, today or datetime.utcnow().date()).items():
+        for (kind, key, day), delta in daily.items():
+            if day >= start:
+                windows[(window, kind, key)] += delta
+    upsert_add(session, PopularityWindow.__table__,
+               [{'window_days': window, 'kind': kind, 'key': key, 'loans': loans}
+                for (window, kind, key), loans in sorted(windows.items()) if loans],
+               ['window_days', 'kind', 'key'], 'loans')
+
+
+def expire_popularity(today=None):
+    """
+    Slide the popularity windows forward, removing the loans of days that left them.
+
+    Each window subtracts the daily counts of its expired days in one
+    grouped query. Daily counts older than the longest window are then
+    deleted. The caller commits.
+
+    Args:
+        today (date): Current day, defaults to today
+
+    Returns:
+        int: Number of windows moved
+    """
+    from app import db
+    from models import JobState, PopularityDaily, PopularityWindow
+
+    today = today or datetime.utcnow().date()
+    moved = 0
+    for window, start in _window_starts(db.session, today).items():
+        new_start = window_start(window, today)
+        if new_start <= start:
+            continue
+
+        claimed = db.session.execute(
+            update(JobState).where(
+                JobState.name == WINDOW_JOB.format(window),
+                JobState.watermark == datetime.combine(start, time.min)
+            ).values(watermark=datetime.combine(new_start, time.min), updated_at=datetime.utcnow())
+        )
+        if claimed.rowcount == 0:
+            # Another process moved this window in the meantime
+            continue
+
+        expired = db.session.query(
+            PopularityDaily.kind, PopularityDaily.key, func.sum(PopularityDaily.loans)
+        ).filter(
+            PopularityDaily.day >= start,
+            PopularityDaily.day < new_start
+        ).group_by(PopularityDaily.kind, PopularityDaily.key).all()
+
+        upsert_add(db.session, PopularityWindow.__table__,
+                   [{'window_days': window, 'kind': kind, 'key': key, 'loans': -loans}
+                    for kind, key, loans in expired if loans],
+                   ['window_days', 'kind', 'key'], 'loans')
+        db.session.query(PopularityWindow).filter(
+            PopularityWindow.window_days == window,
+            PopularityWindow.loans <= 0
+        ).delete(synchronize_session=False)
+        moved += 1
+
+    if moved:
+        oldest = window_start(max(POPULARITY_WINDOWS), today)
+        db.session.query(PopularityDaily).filter(
+            PopularityDaily.day < oldest
+        ).delete(synchronize_session=False)
+    return moved
+
+
+def rebuild_popularity(today=None):
+    """
+    Recompute the daily popularity counts and every window from the loan table.
+
+    The caller commits.
+
+    Args:
+        today (date): Current day, defaults to today
+
+    Returns:
+        int: Number of loans counted
+    """
+    from app import db
+    from models import Book, JobState, Loan, PopularityDaily, PopularityWindow
+
+    today = today or datetime.utcnow().date()
+    db.session.query(PopularityWindow).delete(synchronize_session=False)
+    db.session.query(PopularityDaily).delete(synchronize_session=False)
+    for window in POPULARITY_WINDOWS:
+        db.session.merge(JobState(name=WINDOW_JOB.format(window),
+                                  watermark=datetime.combine(window_start(window, today), time.min),
+                                  updated_at=datetime.utcnow()))
+    db.session.flush()
+
+    since = datetime.combine(window_start(max(POPULARITY_WINDOWS), today), time.min)
+    day = day_of(Loan.loan_date)
+    rows = db.session.query(Loan.book_id, Loan.member_id, Book.category, day, func.count(Loan.id)).join(
+        Book, Book.id == Loan.book_id
+    ).filter(
+        Loan.loan_date >= since
+    ).group_by(Loan.book_id, Loan.member_id, Book.category, day).all()
+
+    deltas = Counter()
+    for book_id, member_id, category, loan_day, count in rows:
+        deltas[('book', book_id, loan_day)] += count
+        deltas[('member', member_id, loan_day)] += count
+        deltas[('category', category or '', loan_day)] += count
+    adjust_popularity(db.session, deltas, today)
+    return sum(count for *_, count in rows)
+
+
+def top_popular(kind, window, limit=10):
+    """
+    Read the most borrowed books, categories or members of a window.
+
+    Served from the ``(window_days, kind, loans)`` index, so the cost only
+    depends on ``limit``.
+
+    Args:
+        kind (str): One of ``POPULARITY_KINDS``
+        window (int): One of ``POPULARITY_WINDOWS``
+        limit (int): Number of entries to return
+
+    Returns:
+        list: ``(key, loans)`` pairs, most loans first
+    """
+    from app import db
+    from models import PopularityWindow
+
+    return db.session.query(PopularityWindow.key, PopularityWindow.loans).filter(
+        PopularityWindow.window_days == window,
+        PopularityWindow.kind == kind,
+        PopularityWindow.loans > 0
+    ).order_by(PopularityWindow.loans.desc(), PopularityWindow.key).limit(limit).all()
+
+
+def _window_starts(session, today):
+    """Return the first counted day of every window, creating missing job states."""
+    from models import JobState
+
+    names = {WINDOW_JOB.format(window): window for window in POPULARITY_WINDOWS}
+    starts = {
+        names[name]: watermark.date()
+        for name, watermark in session.execute(
+            select(JobState.name, JobState.watermark).where(JobState.name.in_(names))
+        )
+    }
+    missing = [window for window in POPULARITY_WINDOWS if window not in starts]
+    if missing:
+        now = datetime.utcnow()
+        session.execute(insert(JobState.__table__), [
+            {'name': WINDOW_JOB.format(window),
+             'watermark': datetime.combine(window_start(window, today), time.min),
+             'updated_at': now}
+            for window in missing
+        ])
+        starts.update({window: window_start(window, today) for window in missing})
+    return starts
@@ -0,0 +1,199 @@
+from collections import Counter
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import func, or_, update
+
+from utils.sql import day_of, upsert_add
+
+# Daily and monthly activity figures kept in the rollup tables
+ROLLUP_METRICS = ('registrations', 'loans', 'returns', 'overdues')
+ROLLUP_BUCKETS = ('day', 'month')
+
+# Job state row holding the first day whose overdue loans are not rolled up yet
+OVERDUE_JOB = 'rollup.overdues'
+
+
+def month_start(day):
+    """Return the first day of the month of ``day``."""
+    return day.replace(day=1)
+
+
+def adjust_rollups(session, deltas):
+    """
+    Add changes to the daily and monthly rollups.
+
+    Called automatically after each ORM flush for registrations, loans and
+    returns. Code that writes rows with bulk or Core statements must call
+    it itself, in the same transaction.
+
+    Args:
+        session (Session): The session of the transaction
+        deltas (dict): Changes keyed by ``(metric, day)``
+    """
+    from models import DailyStat, MonthlyStat
+
+    daily = Counter()
+    monthly = Counter()
+    for (metric, day), delta in deltas.items():
+        daily[(metric, day)] += delta
+        monthly[(metric, month_start(day))] += delta
+
+    upsert_add(session, DailyStat.__table__,
+               [{'metric': metric, 'day': day, 'value': value}
+                for (metric, day), value in sorted(daily.items()) if value],
+               ['metric', 'day'], 'value')
+    upsert_add(session, MonthlyStat.__table__,
+               [{'metric': metric, 'month': month, 'value': value}
+                for (metric, month), value in sorted(monthly.items()) if value],
+               ['metric', 'month'], 'value')
+
+
+def refresh_overdue_rollup(today=None):
+    """
+    Roll up the loans that became overdue on each day not processed yet.
+
+    A loan becomes overdue on its due day if it is not returned by then.
+    Only whole past days are processed, each exactly once; the job state
+    is advanced with a conditional update so that concurrent callers do
+    not count a day twice. The caller commits.
+
+    Args:
+        today (date): First day not to process, defaults to today
+
+    Returns:
+        int: Number of days processed
+    """
+    from app import db
+    from models import JobState, Loan
+
+    today = today or datetime.utcnow().date()
+    state = db.session.get(JobState, OVERDUE_JOB)
+    if state is None:
+        first_due = db.session.query(func.min(Loan.due_date)).scalar()
+        start = first_due.date() if first_due else today
+        state = JobState(name=OVERDUE_JOB, watermark=datetime.combine(start, time.min))
+        db.session.add(state)
+        db.session.flush()
+
+    start = state.watermark.date()
+    if start >= today:
+        return 0
+
+    claimed = db.session.execute(
+        update(JobState).where(
+            JobState.name == OVERDUE_JOB,
+            JobState.watermark == state.watermark
+        ).values(watermark=datetime.combine(today, time.min), updated_at=datetime.utcnow())
+        .execution_options(synchronize_session='fetch')
+    )
+    if claimed.rowcount == 0:
+        # Another process rolled these days up in the meantime
+        return 0
+
+    adjust_rollups(db.session, {('overdues', day): count
+                                for day, count in _overdue_counts(start, today).items()})
+    return (today - start).days
+
+
+def rebuild_rollups(today=None):
+    """
+    Recompute every rollup from the source tables.
+
+    Used to fill the rollups of an existing database and to repair them
+    after writes that bypassed the mapper events. Overdues are recounted
+    for the loans still present. The caller commits.
+
+    Args:
+        today (date): First day whose overdues are not rolled up, defaults to today
+
+    Returns:
+        dict: Number of events rolled up per metric
+    """
+    from app import db
+    from models import DailyStat, MonthlyStat, JobState, Member, Loan
+
+    today = today or datetime.utcnow().date()
+    db.session.query(DailyStat).delete(synchronize_session=False)
+    db.session.query(MonthlyStat).delete(synchronize_session=False)
+
+    sources = {
+        'registrations': (Member.registration_date, Member.registration_date.isnot(None)),
+        'loans': (Loan.loan_date, Loan.loan_date.isnot(None)),
+        'returns': (Loan.return_date, (Loan.returned == True) & Loan.return_date.isnot(None)),
+    }
+    deltas = {}
+    for metric, (timestamp, condition) in sources.items():
+        day = day_of(timestamp)
+        for value, count in db.session.query(day, func.count()).filter(condition).group_by(day):
+            deltas[(metric, value)] = count
+    for day, count in _overdue_counts(None, today).items():
+        deltas[('overdues', day)] = count
+    adjust_rollups(db.session, deltas)
+
+    db.session.merge(JobState(name=OVERDUE_JOB, watermark=datetime.combine(today, time.min),
+                              updated_at=datetime.utcnow()))
+
+    totals = dict.fromkeys(ROLLUP_METRICS, 0)
+    for (metric, _), count in deltas.items():
+        totals[metric] += count
+    return totals
+
+
+def rollup_series(metric, start, end, bucket='day'):
+    """
+    Read a metric from the rollups, one point per day or month.
+
+    Args:
+        metric (str): One of ``ROLLUP_METRICS``
+        start (date): First day of the series
+        end (date): Last day of the series, included
+        bucket (str): ``'day'`` or ``'month'``; monthly series start on
+            the month of ``start``
+
+    Returns:
+        list: ``(date, value)`` pairs, with zeros for periods without activity
+    """
+    from app import db
+    from models import DailyStat, MonthlyStat
+
+    if bucket == 'month':
+        start = month_start(start)
+        period = MonthlyStat.month
+        values = dict(db.session.query(period, MonthlyStat.value).filter(
+            MonthlyStat.metric == metric, period >= start, period <= end
+        ))
+    else:
+        period = DailyStat.day
+        values = dict(db.session.query(period, DailyStat.value).filter(
+            DailyStat.metric == metric, period >= start, period <= end
+        ))
+
+    return [(point, values.get(point, 0)) for point in series_points(start, end, bucket)]
+
+
+def series_points(start, end, bucket='day'):
+    """List the days, or the first days of the months, from ``start`` to ``end``."""
+    points = []
+    point = month_start(start) if bucket == 'month' else start
+    while point <= end:
+        points.append(point)
+        if bucket == 'month':
+            point = (point + timedelta(days=32)).replace(day=1)
+        else:
+            point += timedelta(days=1)
+    return points
+
+
+def _overdue_counts(start, end):
+    """Count the loans due on each day of ``[start, end)`` that were not returned in time."""
+    from app import db
+    from models import Loan
+
+    day = day_of(Loan.due_date)
+    query = db.session.query(day, func.count(Loan.id)).filter(
+        Loan.due_date < datetime.combine(end, time.min),
+        or_(Loan.returned == False, Loan.return_date > Loan.due_date)
+    )
+    if start is not None:
+        query = query.filter(Loan.due_date >= datetime.combine(start, time.min))
+    return dict(query.group_by(day).all())
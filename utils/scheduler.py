@@ -0,0 +1,298 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from itertools import groupby
+
+from flask import current_app
+from sqlalchemy import and_, or_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+
+from utils.ledger import claim_notices, prune_ledger
+from utils.outbox import queue_notifications
+
+# Loans are reported overdue once a full day late, and reminded three days before they are due
+OVERDUE_DELAY = timedelta(days=1)
+REMINDER_LEAD = timedelta(days=3)
+
+# Seconds between two runs of a job, unless configured otherwise
+DEFAULT_JOB_INTERVAL = 3600
+
+# Period covered by each digest in digest mode, unless configured otherwise
+DEFAULT_DIGEST_WINDOW = 24 * 3600
+
+# Seconds between two checks of the scheduler for due jobs
+SCHEDULER_POLL = 60
+
+
+def overdue_notices(start, end):
+    """
+    Queue a notice for every loan that became overdue between ``start`` and ``end``.
+
+    In digest mode, each member gets one notice listing all their loans
+    that became overdue in the period.
+
+    Returns:
+        int: Number of notices queued
+    """
+    from utils.notifications import overdue_digest, overdue_notice
+
+    loans = claim_notices('overdue', _crossing(start - OVERDUE_DELAY, end - OVERDUE_DELAY),
+                          lambda loan: (loan.due_date + OVERDUE_DELAY).date())
+    if digest_mode():
+        return queue_notifications([overdue_digest(member, items, end) for member, items in _by_member(loans)])
+    return queue_notifications([overdue_notice(loan, loan.book, loan.member, end) for loan in loans])
+
+
+def due_reminders(start, end):
+    """
+    Queue a reminder for every loan that came within ``REMINDER_LEAD`` of its due date
+    between ``start`` and ``end``.
+
+    Loans lent for less than ``REMINDER_LEAD`` are within it from the
+    start: they are reminded in the period they were lent.
+
+    In digest mode, each member gets one reminder listing all their loans
+    that came due soon in the period.
+
+    Returns:
+        int: Number of reminders queued
+    """
+    from utils.notifications import due_reminder, due_reminder_digest
+
+    loans = claim_notices('reminder', _crossing(start + REMINDER_LEAD, end + REMINDER_LEAD, lent=(start, end)),
+                          lambda loan: loan.due_date.date())
+    if digest_mode():
+        return queue_notifications([due_reminder_digest(member, items, end) for member, items in _by_member(loans)])
+    return queue_notifications([due_reminder(loan, loan.book, loan.member, end) for loan in loans])
+
+
+def prune_notification_ledger(start, end):
+    """
+    Delete the ledger entries older than ``LEDGER_RETENTION_DAYS``.
+
+    Returns:
+        int: Number of entries deleted
+    """
+    return prune_ledger(end.date())
+
+
+def digest_mode():
+    """Tell whether notices are grouped into one digest per member (``NOTIFICATION_DIGEST``)."""
+    return bool(current_app.config.get('NOTIFICATION_DIGEST'))
+
+
+# Scheduled jobs, with the configuration key of their interval in seconds (see job_interval)
+JOBS = {
+    'overdue-notices': (overdue_notices, 'OVERDUE_CHECK_INTERVAL'),
+    'due-reminders': (due_reminders, 'DUE_REMINDER_INTERVAL'),
+    'prune-ledger': (prune_notification_ledger, 'LEDGER_PRUNE_INTERVAL'),
+}
+
+# Jobs whose notices are grouped per member in digest mode
+DIGEST_JOBS = ('overdue-notices', 'due-reminders')
+
+
+def run_job(name, now=None):
+    """
+    Run a scheduled job over the time elapsed since its previous run.
+
+    The job state holds the end of the period processed last. It is
+    advanced with a conditional update, so that concurrent runs (the
+    scheduler of another process, or a librarian running the job by hand)
+    never process the same period twice. The first run covers one
+    interval. The notifications queued, the new watermark and the
+    outcome of the run are committed together; on error nothing but the
+    error is recorded.
+
+    Args:
+        name (str): A key of ``JOBS``
+        now (datetime): End of the period processed, defaults to now
+
+    Returns:
+        int: The count returned by the job, or None if there was nothing to run
+    """
+    from app import db
+    from models import JobState
+
+    job, _ = JOBS[name]
+    now = now or datetime.utcnow()
+    state = db.session.get(JobState, name, populate_existing=True)
+    if state is None:
+        state = JobState(name=name, watermark=now - timedelta(seconds=job_interval(name)))
+        db.session.add(state)
+        try:
+            db.session.flush()
+        except IntegrityError:
+            # Another process ran the job for the first time in the meantime
+            db.session.rollback()
+            return None
+
+    start = state.watermark
+    if start >= now:
+        db.session.commit()
+        return None
+
+    claimed = db.session.execute(
+        update(JobState).where(JobState.name == name, JobState.watermark == start)
+        .values(watermark=now, updated_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    if claimed.rowcount == 0:
+        # Another process ran the job in the meantime
+        db.session.rollback()
+        return None
+
+    started = time.perf_counter()
+    try:
+        count = job(start, now)
+    except Exception as e:
+        db.session.rollback()
+        _record_run(name, now, time.perf_counter() - started, None, str(e)[:255])
+        db.session.commit()
+        raise
+
+    _record_run(name, now, time.perf_counter() - started, count)
+    db.session.commit()
+    logging.info(f"Job {name}: {count} processed from {start} to {now}")
+    return count
+
+
+def run_due_jobs(now=None):
+    """
+    Run the jobs whose interval has elapsed since their last run.
+
+    A failing job is logged without preventing the others from running.
+
+    Returns:
+        dict: Count of each job run
+    """
+    now = now or datetime.utcnow()
+    results = {}
+    for status in job_status():
+        if status['next_run_at'] is not None and status['next_run_at'] > now:
+            continue
+        try:
+            count = run_job(status['name'], now)
+        except Exception:
+            logging.exception(f"Job {status['name']} failed")
+            continue
+        if count is not None:
+            results[status['name']] = count
+    return results
+
+
+def job_status():
+    """
+    Describe the scheduled jobs for the status page, with one query.
+
+    Returns:
+        list: One dict per job of ``JOBS``, with the ``name``, the
+        ``watermark``, the ``last_run_at``, ``last_duration`` (in seconds),
+        ``last_count`` and ``last_error`` of its last run, its ``interval``
+        and ``next_run_at`` (None for a job never run)
+    """
+    from app import db
+    from models import JobState
+
+    states = {state.name: state for state in db.session.query(JobState).filter(JobState.name.in_(JOBS))}
+    status = []
+    for name in JOBS:
+        state = states.get(name)
+        interval = job_interval(name)
+        status.append({
+            'name': name,
+            'interval': interval,
+            'watermark': state.watermark if state else None,
+            'last_run_at': state.last_run_at if state else None,
+            'last_duration': state.last_duration if state else None,
+            'last_count': state.last_count if state else None,
+            'last_error': state.last_error if state else None,
+            'next_run_at': state.watermark + timedelta(seconds=interval) if state else None,
+        })
+    return status
+
+
+def job_interval(name):
+    """
+    Seconds between two runs of a job.
+
+    In digest mode the jobs run once per ``NOTIFICATION_DIGEST_WINDOW``,
+    so that a digest covers everything that happened in the window.
+    """
+    _, interval_key = JOBS[name]
+    if digest_mode() and name in DIGEST_JOBS:
+        return current_app.config.get('NOTIFICATION_DIGEST_WINDOW', DEFAULT_DIGEST_WINDOW)
+    return current_app.config.get(interval_key, DEFAULT_JOB_INTERVAL)
+
+
+def run_scheduler(app, poll=SCHEDULER_POLL, stop=None):
+    """
+    Run the due jobs every ``poll`` seconds, until ``stop`` is set.
+
+    Args:
+        app (Flask): The application, for its context and configuration
+        poll (int): Seconds between two checks for due jobs
+        stop (threading.Event): Set to end the loop
+    """
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        try:
+            with app.app_context():
+                run_due_jobs()
+        except Exception:
+            logging.exception("Running the scheduled jobs failed")
+        stop.wait(poll)
+
+
+def start_scheduler(app, poll=SCHEDULER_POLL):
+    """Run the scheduler in a daemon thread; the ``run-scheduler`` command runs it as a process."""
+    thread = threading.Thread(target=run_scheduler, args=(app, poll), name='scheduler', daemon=True)
+    thread.start()
+    return thread
+
+
+def _crossing(start, end, lent=None):
+    """
+    Load the open loans due after ``start`` and up to ``end``, with their books and members, in one query.
+
+    With ``lent``, a ``(start, end)`` period, the open loans lent in that
+    period, not yet due at its end and due up to ``end`` are loaded too.
+    """
+    from models import Loan
+
+    crossing = and_(Loan.due_date > start, Loan.due_date <= end)
+    if lent is not None:
+        lent_start, lent_end = lent
+        crossing = or_(crossing, and_(
+            Loan.loan_date > lent_start,
+            Loan.loan_date <= lent_end,
+            Loan.due_date > lent_end,
+            Loan.due_date <= end
+        ))
+    query = Loan.query.options(joinedload(Loan.book), joinedload(Loan.member)).filter(
+        Loan.returned == False,
+        crossing
+    )
+    # Digests are built from the loans of each member, read consecutively
+    if digest_mode():
+        query = query.order_by(Loan.member_id, Loan.due_date, Loan.id)
+    else:
+        query = query.order_by(Loan.due_date, Loan.id)
+    return query.all()
+
+
+def _by_member(loans):
+    """Group crossing loans by member, as ``(member, [(loan, book), ...])`` pairs."""
+    return [(member, [(loan, loan.book) for loan in member_loans])
+            for member, member_loans in groupby(loans, key=lambda loan: loan.member)]
+
+
+def _record_run(name, now, duration, count, error=None):
+    from app import db
+    from models import JobState
+
+    db.session.execute(update(JobState).where(JobState.name == name).values(
+        last_run_at=now, last_duration=duration, last_count=count, last_error=error
+    ).execution_options(synchronize_session=False))
@@ -0,0 +1,44 @@
+import logging
+
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn, CreateIndex
+
+from utils.search import install_search_index
+
+
+def upgrade_schema(engine, metadata):
+    """
+    Bring a database created by an earlier version up to date.
+
+    ``db.create_all()`` only creates missing tables, so columns and indexes
+    added to an existing table are created here. Every step is idempotent.
+
+    Args:
+        engine (Engine): The application database engine
+        metadata (MetaData): Metadata holding the model tables
+
+    Returns:
+        list: ``table.column`` names of the columns that were added
+    """
+    added = []
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        for table in metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    definition = CreateColumn(column).compile(dialect=connection.dialect)
+                    connection.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {definition}")
+                    added.append(f"{table.name}.{column.name}")
+
+            for index in table.indexes:
+                connection.execute(CreateIndex(index, if_not_exists=True))
+
+        install_search_index(connection)
+
+    for name in added:
+        logging.info(f"Added column {name}")
+    logging.debug("Database schema is up to date")
+    return added
@@ -0,0 +1,189 @@
+import re
+
+from sqlalchemy import Float, and_, cast, column, event, func, literal_column, or_, table, text
+
+# SQLite FTS5 table mirroring the searchable book columns
+FTS_TABLE = 'book_fts'
+_fts = table(FTS_TABLE, column('rowid'), column('rank'))
+
+# Words are matched by prefix so that partial input ("harr pot") still hits
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+_SQLITE_DDL = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        title, author, isbn,
+        content='book', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON book BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, title, author, isbn)
+        VALUES (new.id, new.title, new.author, new.isbn);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON book BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, author, isbn)
+        VALUES ('delete', old.id, old.title, old.author, old.isbn);
+    END""",
+    # Only re-index when a searchable column changes, not on availability flips
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF title, author, isbn ON book BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, author, isbn)
+        VALUES ('delete', old.id, old.title, old.author, old.isbn);
+        INSERT INTO {FTS_TABLE}(rowid, title, author, isbn)
+        VALUES (new.id, new.title, new.author, new.isbn);
+    END""",
+]
+
+# The query must use exactly the indexed expression for PostgreSQL to pick the GIN index
+_PG_DOCUMENT = (
+    "to_tsvector('simple', coalesce(book.title, '') || ' ' || "
+    "coalesce(book.author, '') || ' ' || coalesce(book.isbn, ''))"
+)
+_PG_INDEX = f"CREATE INDEX IF NOT EXISTS ix_book_search ON book USING GIN ({_PG_DOCUMENT})"
+
+
+def search_tokens(term):
+    """Split a free-text search term into indexable words."""
+    return _TOKEN_RE.findall(term or '')
+
+
+def install_search_index(connection):
+    """
+    Create the full-text index for the book table if it does not exist yet.
+
+    Safe to call on every startup. On SQLite a freshly created FTS table is
+    rebuilt from the existing rows.
+
+    Args:
+        connection (Connection): An open SQLAlchemy connection
+    """
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        exists = connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {'name': FTS_TABLE}
+        ).first()
+        for statement in _SQLITE_DDL:
+            connection.exec_driver_sql(statement)
+        if not exists:
+            connection.exec_driver_sql(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+    elif dialect == 'postgresql':
+        connection.exec_driver_sql(_PG_INDEX)
+
+
+def drop_search_index(connection):
+    """Drop the full-text index objects that are not owned by the book table."""
+    if connection.dialect.name == 'sqlite':
+        connection.exec_driver_sql(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+def register_search_index(book_table):
+    """Create and drop the full-text index together with the book table."""
+    event.listen(book_table, 'after_create',
+                 lambda target, connection, **kw: install_search_index(connection))
+    event.listen(book_table, 'after_drop',
+                 lambda target, connection, **kw: drop_search_index(connection))
+
+
+def search_books(query, term, ordered=True):
+    """
+    Restrict a Book query to rows matching a search term, best matches first.
+
+    Title, author and ISBN are searched. Every word of the term must match
+    the beginning of a word in one of these columns.
+
+    Args:
+        query (Query): A query over the Book model
+        term (str): Free-text search input
+        ordered (bool): Whether to order the results by relevance
+
+    Returns:
+        Query: The filtered query
+    """
+    from app import db
+    from models import Book
+
+    tokens = search_tokens(term)
+    if not tokens:
+        return query
+
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        match = ' '.join(f'"{token}"*' for token in tokens)
+        query = query.join(_fts, _fts.c.rowid == Book.id).filter(
+            literal_column(FTS_TABLE).op('MATCH')(match)
+        )
+    elif dialect == 'postgresql':
+        query = query.filter(literal_column(_PG_DOCUMENT).op('@@')(_pg_ts_query(tokens)))
+    else:
+        # Other databases fall back to substring matching
+        for token in tokens:
+            query = query.filter(
+                or_(
+                    Book.title.ilike(f'%{token}%'),
+                    Book.author.ilike(f'%{token}%'),
+                    Book.isbn.ilike(f'%{token}%')
+                )
+            )
+
+    if ordered:
+        query = query.order_by(search_relevance(term), Book.id)
+    return query
+
+
+def search_relevance(term):
+    """
+    Build the relevance expression of a search, best matches sorting first.
+
+    Only meaningful on a query already filtered by ``search_books``.
+
+    Args:
+        term (str): Free-text search input
+
+    Returns:
+        ColumnElement: An SQL expression to sort on in ascending order
+
+    Raises:
+        ValueError: If ``term`` has no words, as ``search_books`` then
+            leaves the query without the index the rank comes from
+    """
+    from app import db
+    from models import Book
+
+    tokens = search_tokens(term)
+    if not tokens:
+        raise ValueError('A search without words has no relevance')
+
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        return _fts.c.rank
+    if dialect == 'postgresql':
+        # ts_rank is a real: as a double, the rank in a cursor compares exactly with the one sorted on
+        return -cast(func.ts_rank(literal_column(_PG_DOCUMENT), _pg_ts_query(tokens)), Float(53))
+    return Book.title
+
+
+def _pg_ts_query(tokens):
+    return func.to_tsquery('simple', ' & '.join(f'{token}:*' for token in tokens))
+
+
+def prefix_filter(attribute, prefix):
+    """
+    Build a case-insensitive "starts with" condition on a column.
+
+    The range comparison lets the database use an index on ``lower(column)``;
+    the LIKE keeps the result exact whatever the collation.
+
+    Args:
+        attribute (Column): The column to match
+        prefix (str): The expected beginning of the value
+
+    Returns:
+        ColumnElement: A boolean SQL expression
+    """
+    prefix = prefix.lower()
+    lowered = func.lower(attribute)
+    upper_bound = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return and_(
+        lowered >= prefix,
+        lowered < upper_bound,
+        lowered.startswith(prefix, autoescape=True)
+    )
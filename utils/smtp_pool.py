@@ -0,0 +1,300 @@
+import re
+import smtplib
+import threading
+import time
+from collections import Counter
+from email.message import EmailMessage
+from email.policy import SMTP as SMTP_POLICY
+
+# Connections are replaced after this many messages, as many servers cap messages per session
+MAX_MESSAGES_PER_CONNECTION = 100
+
+# An idle connection is checked with NOOP before reuse once it has been idle this many seconds
+IDLE_CHECK_AFTER = 30
+
+# Dot-stuffing of the lines of a message body starting with a dot (RFC 5321, 4.5.2)
+_LEADING_DOT = re.compile(rb'^\.', re.MULTILINE)
+
+
+def build_message(sender, recipient, subject, body):
+    """Build the email of a notification."""
+    message = EmailMessage()
+    message['From'] = sender
+    message['To'] = recipient
+    message['Subject'] = subject
+    message.set_content(body)
+    return message
+
+
+class RateLimiter:
+    """
+    Token bucket allowing ``rate`` operations per second on average, shared between threads.
+
+    Bursts of up to ``burst`` operations (one second's worth by default)
+    go through without waiting.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait for a token; returns the seconds waited."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # The token is taken now, so that waiting threads queue up behind each other
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class _Connection:
+    """An open SMTP session of a pool, with the number of messages it sent."""
+
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.sent = 0
+        self.last_used = time.monotonic()
+        self.pipelining = smtp.has_extn('pipelining')
+
+
+class SMTPPool:
+    """
+    Persistent SMTP connections shared by the threads of a process.
+
+    At most ``size`` connections are open at once; a thread needing one
+    while they are all in use waits for one to be released. Each
+    connection sends up to ``max_messages`` messages before being
+    replaced. When the server supports PIPELINING, the envelope commands
+    of a message are sent in one write, saving two round trips per
+    message. An optional ``rate_limit`` (messages per second) applies to
+    all the connections together.
+    """
+
+    def __init__(self, host, port=25, sender='library@localhost', username=None, password=None,
+                 starttls=False, timeout=10, size=4, max_messages=MAX_MESSAGES_PER_CONNECTION, rate_limit=0):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.size = size
+        self.max_messages = max_messages
+        self.limiter = RateLimiter(rate_limit) if rate_limit else None
+        self._idle = []
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._metrics = Counter()
+        self._send_seconds = 0.0
+        self._rate_limited_seconds = 0.0
+        self._started = time.monotonic()
+
+    def acquire(self):
+        """Take an open connection from the pool, opening one if none is idle."""
+        self._slots.acquire()
+        try:
+            with self._lock:
+                connection = self._idle.pop() if self._idle else None
+            if connection and time.monotonic() - connection.last_used > IDLE_CHECK_AFTER:
+                connection = self._check(connection)
+            return connection or self.connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, connection, discard=False):
+        """Give a connection back to the pool, or close it when broken or used up."""
+        try:
+            if connection is None:
+                pass
+            elif discard or connection.sent >= self.max_messages:
+                self.discard(connection)
+            else:
+                connection.last_used = time.monotonic()
+                with self._lock:
+                    self._idle.append(connection)
+        finally:
+            self._slots.release()
+
+    def send(self, connection, recipient, subject, body):
+        """
+        Send one message over ``connection``.
+
+        Returns:
+            _Connection: The connection to use next, a new one if this one
+            had sent ``max_messages`` or been closed by the server
+        """
+        if self.limiter:
+            waited = self.limiter.acquire()
+            with self._lock:
+                self._rate_limited_seconds += waited
+
+        data = build_message(self.sender, recipient, subject, body).as_bytes(policy=SMTP_POLICY)
+        started = time.perf_counter()
+        try:
+            if connection.sent >= self.max_messages:
+                self.discard(connection)
+                connection = self.connect()
+            try:
+                self._transmit(connection, recipient, data)
+            except smtplib.SMTPServerDisconnected:
+                # The server dropped an idle connection: send again on a new one
+                self.discard(connection)
+                connection = self.connect()
+                self._count('reconnects')
+                self._transmit(connection, recipient, data)
+        except Exception:
+            self._count('failed')
+            raise
+        finally:
+            with self._lock:
+                self._send_seconds += time.perf_counter() - started
+
+        connection.sent += 1
+        connection.last_used = time.monotonic()
+        self._count('sent')
+        return connection
+
+    def close(self):
+        """Close the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            self.discard(connection)
+
+    def connect(self):
+        """Open a new connection, in place of one of the caller's."""
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            smtp.ehlo()
+            if self.starttls:
+                smtp.starttls()
+                smtp.ehlo()
+            if self.username:
+                smtp.login(self.username, self.password)
+        except Exception:
+            smtp.close()
+            raise
+        self._count('connections_opened')
+        return _Connection(smtp)
+
+    def discard(self, connection):
+        """Close a connection, whatever its state."""
+        try:
+            connection.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            connection.smtp.close()
+
+    def stats(self):
+        """
+        Describe the deliveries of this pool since it was created.
+
+        Returns:
+            dict: Messages ``sent`` and ``failed``, ``connections_opened``,
+            ``reconnects``, ``idle`` connections, ``messages_per_second``,
+            ``average_send_ms`` and the ``rate_limited_seconds`` spent waiting
+        """
+        with self._lock:
+            sent = self._metrics['sent']
+            elapsed = time.monotonic() - self._started
+            return {
+                'sent': sent,
+                'failed': self._metrics['failed'],
+                'connections_opened': self._metrics['connections_opened'],
+                'reconnects': self._metrics['reconnects'],
+                'idle': len(self._idle),
+                'size': self.size,
+                'messages_per_second': round(sent / elapsed, 2) if elapsed else 0,
+                'average_send_ms': round(self._send_seconds / sent * 1000, 2) if sent else None,
+                'rate_limited_seconds': round(self._rate_limited_seconds, 3),
+            }
+
+    def _count(self, metric):
+        with self._lock:
+            self._metrics[metric] += 1
+
+    def _check(self, connection):
+        """Return an idle connection if the server still answers, else None."""
+        try:
+            if connection.smtp.noop()[0] == 250:
+                return connection
+        except (smtplib.SMTPException, OSError):
+            pass
+        self.discard(connection)
+        return None
+
+    def _transmit(self, connection, recipient, data):
+        """Run the MAIL, RCPT and DATA exchange of one message."""
+        smtp = connection.smtp
+        if not connection.pipelining:
+            smtp.sendmail(self.sender, [recipient], data)
+            return
+
+        smtp.send(f'MAIL FROM:<{self.sender}>\r\nRCPT TO:<{recipient}>\r\nDATA\r\n'.encode('utf-8'))
+        mail, rcpt, data_reply = smtp.getreply(), smtp.getreply(), smtp.getreply()
+        if data_reply[0] == 354 and (mail[0] != 250 or rcpt[0] not in (250, 251)):
+            # Never expected from a compliant server: end the empty message to abort it
+            smtp.send(b'.\r\n')
+            smtp.getreply()
+        if mail[0] != 250:
+            smtp.rset()
+            raise smtplib.SMTPSenderRefused(mail[0], mail[1], self.sender)
+        if rcpt[0] not in (250, 251):
+            smtp.rset()
+            raise smtplib.SMTPRecipientsRefused({recipient: rcpt})
+        if data_reply[0] != 354:
+            smtp.rset()
+            raise smtplib.SMTPDataError(*data_reply)
+
+        data = _LEADING_DOT.sub(b'..', data)
+        if not data.endswith(b'\r\n'):
+            data += b'\r\n'
+        smtp.send(data + b'.\r\n')
+        code, reply = smtp.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, reply)
+
+
+class PooledSMTPTransport:
+    """
+    Send notifications over the connections of an ``SMTPPool``.
+
+    Each outbox worker uses its own transport; a connection is taken
+    from the pool for a batch and given back, still open, at its end.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._connection = None
+
+    def __enter__(self):
+        self._connection = self.pool.acquire()
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        connection, self._connection = self._connection, None
+        self.pool.release(connection, discard=exc_type is not None)
+        return False
+
+    def send(self, recipient, subject, body):
+        if self._connection is None:
+            self._connection = self.pool.connect()
+        try:
+            self._connection = self.pool.send(self._connection, recipient, subject, body)
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError):
+            # A refused message leaves the session usable
+            raise
+        except Exception:
+            # Anything else may leave the session in an unknown state: the next message reconnects
+            self.pool.discard(self._connection)
+            self._connection = None
+            raise
@@ -0,0 +1,120 @@
+"""
+A local SMTP server keeping the messages it receives, for tests and development.
+
+    with SMTPSink() as sink:
+        app.config.update(NOTIFICATION_TRANSPORT='smtp', SMTP_HOST=sink.host, SMTP_PORT=sink.port)
+        ...
+        assert sink.messages[0]['Subject'] == 'Book Loan Confirmation'
+
+It speaks just enough SMTP for ``smtplib`` and the pooled transport,
+PIPELINING included: no authentication, no TLS.
+Recipients listed in ``reject`` are refused, to exercise delivery errors.
+"""
+import socketserver
+import threading
+from email import message_from_bytes, policy
+
+
+class SMTPSink:
+    """SMTP server running in a background thread and collecting ``EmailMessage`` objects."""
+
+    def __init__(self, host='127.0.0.1', port=0, reject=()):
+        self.messages = []
+        self.reject = set(reject)
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), _Handler)
+        self._server.sink = self
+        self.host, self.port = self._server.server_address[:2]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='smtp-sink', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def _receive(self, sender, recipients, data):
+        message = message_from_bytes(data, policy=policy.default)
+        message.envelope = (sender, list(recipients))
+        with self._lock:
+            self.messages.append(message)
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    # Replies to pipelined commands are written one by one: without this, each waits for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        self._reply('220 smtp-sink ready')
+        sender, recipients = None, []
+        for line in self.rfile:
+            command = line.decode('utf-8', 'replace').rstrip('\r\n')
+            verb, _, argument = command.partition(' ')
+            verb = verb.upper()
+
+            if verb == 'EHLO':
+                self._reply('250-smtp-sink', '250-8BITMIME', '250-PIPELINING', '250 SMTPUTF8')
+            elif verb == 'HELO':
+                self._reply('250 smtp-sink')
+            elif verb == 'MAIL':
+                sender, recipients = _address(argument), []
+                self._reply('250 OK')
+            elif verb == 'RCPT':
+                recipient = _address(argument)
+                if recipient in self.server.sink.reject:
+                    self._reply('550 Mailbox unavailable')
+                else:
+                    recipients.append(recipient)
+                    self._reply('250 OK')
+            elif verb == 'DATA':
+                if not recipients:
+                    self._reply('503 No valid recipients')
+                    continue
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+                self.server.sink._receive(sender, recipients, self._read_data())
+                sender, recipients = None, []
+                self._reply('250 OK')
+            elif verb == 'RSET':
+                sender, recipients = None, []
+                self._reply('250 OK')
+            elif verb == 'NOOP':
+                self._reply('250 OK')
+            elif verb == 'QUIT':
+                self._reply('221 Bye')
+                return
+            else:
+                self._reply('502 Command not implemented')
+
+    def _read_data(self):
+        lines = []
+        for line in self.rfile:
+            if line in (b'.\r\n', b'.\n'):
+                break
+            # Undo the dot-stuffing of lines starting with a dot
+            lines.append(line[1:] if line.startswith(b'..') else line)
+        return b''.join(lines)
+
+    def _reply(self, *lines):
+        self.wfile.write(''.join(f'{line}\r\n' for line in lines).encode('utf-8'))
+
+
+def _address(argument):
+    """Extract the address of a ``FROM:<...>`` or ``TO:<...>`` argument."""
+    _, _, address = argument.partition(':')
+    return address.strip().split(' ')[0].strip('<>')
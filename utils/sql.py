@@ -0,0 +1,99 @@
+from sqlalchemy import Date, Integer, and_, func, insert, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+
+
+class days_between(FunctionElement):
+    """
+    Whole days elapsed from ``start`` to ``end``, like ``(end - start).days``.
+
+    Rendered with the date arithmetic of each supported database. Only
+    meaningful when ``end`` is not before ``start``.
+
+    Args:
+        start (ColumnElement | datetime): The earlier timestamp
+        end (ColumnElement | datetime): The later timestamp
+    """
+    type = Integer()
+    inherit_cache = True
+    name = 'days_between'
+
+
+@compiles(days_between, 'sqlite')
+def _days_between_sqlite(element, compiler, **kw):
+    start, end = list(element.clauses)
+    return (f"CAST(julianday({compiler.process(end, **kw)}) - "
+            f"julianday({compiler.process(start, **kw)}) AS INTEGER)")
+
+
+@compiles(days_between, 'postgresql')
+def _days_between_postgresql(element, compiler, **kw):
+    start, end = list(element.clauses)
+    return (f"CAST(floor(extract(epoch FROM {compiler.process(end, **kw)} - "
+            f"{compiler.process(start, **kw)}) / 86400) AS INTEGER)")
+
+
+@compiles(days_between, 'mysql')
+def _days_between_mysql(element, compiler, **kw):
+    start, end = list(element.clauses)
+    return f"TIMESTAMPDIFF(DAY, {compiler.process(start, **kw)}, {compiler.process(end, **kw)})"
+
+
+def day_of(timestamp):
+    """
+    Calendar day of a timestamp column, returned as a ``date`` on every backend.
+
+    Args:
+        timestamp (ColumnElement): A DateTime column or expression
+
+    Returns:
+        ColumnElement: A Date-typed SQL expression
+    """
+    return func.date(timestamp, type_=Date)
+
+
+def upsert_add(session, table, rows, keys, column):
+    """
+    Insert rows, or add their value to the rows that already exist.
+
+    Uses ``INSERT ... ON CONFLICT`` (SQLite, PostgreSQL) or ``ON DUPLICATE
+    KEY UPDATE`` (MySQL) so that concurrent writers never lose an increment,
+    and falls back to UPDATE-then-INSERT elsewhere.
+
+    Args:
+        session (Session): The session of the transaction
+        table (Table): Target table, with a unique constraint on ``keys``
+        rows (list): Dictionaries with the key columns and ``column``; each
+            key must appear only once
+        keys (list): Names of the columns identifying a row
+        column (str): Name of the numeric column to add to
+    """
+    if not rows:
+        return
+
+    dialect = session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        dialect_insert = sqlite_insert if dialect == 'sqlite' else postgresql_insert
+        statement = dialect_insert(table).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=keys,
+            set_={column: table.c[column] + statement.excluded[column]}
+        )
+        session.execute(statement)
+    elif dialect == 'mysql':
+        statement = mysql_insert(table).values(rows)
+        statement = statement.on_duplicate_key_update(
+            {column: table.c[column] + statement.inserted[column]}
+        )
+        session.execute(statement)
+    else:
+        for row in rows:
+            match = and_(*(table.c[key] == row[key] for key in keys))
+            result = session.execute(
+                update(table).where(match).values({column: table.c[column] + row[column]})
+            )
+            if result.rowcount == 0:
+                session.execute(insert(table).values(row))
@@ -0,0 +1,151 @@
+from datetime import datetime
+
+from sqlalchemy import case, func, select, update
+
+# Counters kept in the library_stats table, as '<table>.<figure>'
+STAT_COUNTERS = (
+    'books.total',
+    'books.available',
+    'members.total',
+    'members.active',
+    'loans.total',
+    'loans.active',
+)
+
+
+def library_statistics(now=None):
+    """
+    Return the library-wide counters shown on the dashboards and by the API.
+
+    Totals are read from the ``library_stats`` counters maintained on every
+    change. Only the overdue count depends on the current time; it is
+    counted from the ``(returned, due_date)`` index.
+
+    Args:
+        now (datetime): Reference time for overdue loans, defaults to now
+
+    Returns:
+        dict: Counters grouped by table, e.g. ``stats['loans']['overdue']``
+    """
+    from app import db
+    from models import LibraryStat, Loan
+
+    counters = dict.fromkeys(STAT_COUNTERS, 0)
+    counters.update(db.session.execute(select(LibraryStat.name, LibraryStat.value)).all())
+    overdue_loans = db.session.query(func.count(Loan.id)).filter(Loan.is_overdue(now)).scalar()
+    return _group(counters, overdue_loans)
+
+
+def count_statistics(now=None):
+    """
+    Count the library-wide figures from the tables themselves.
+
+    Each table is scanned once; the filtered counts are conditional
+    aggregates of that single query.
+
+    Args:
+        now (datetime): Reference time for overdue loans, defaults to now
+
+    Returns:
+        dict: Counters grouped by table, like ``library_statistics``
+    """
+    from app import db
+    from models import Book, Member, Loan
+
+    now = now or datetime.utcnow()
+
+    total_books, available_books = db.session.query(
+        func.count(Book.id),
+        func.count(case((Book.available == True, 1)))
+    ).one()
+
+    total_members, active_members = db.session.query(
+        func.count(Member.id),
+        func.count(case((Member.active == True, 1)))
+    ).one()
+
+    total_loans, active_loans, overdue_loans = db.session.query(
+        func.count(Loan.id),
+        func.count(case((Loan.returned == False, 1))),
+        func.count(case((Loan.is_overdue(now), 1)))
+    ).one()
+
+    counters = {
+        'books.total': total_books,
+        'books.available': available_books,
+        'members.total': total_members,
+        'members.active': active_members,
+        'loans.total': total_loans,
+        'loans.active': active_loans,
+    }
+    return _group(counters, overdue_loans)
+
+
+def adjust_statistics(session, deltas):
+    """
+    Add relative changes to the library counters.
+
+    Called automatically after each ORM flush. Code that writes rows with
+    bulk or Core statements bypasses the mapper events and must call it
+    itself, in the same transaction.
+
+    Args:
+        session (Session): The session (or connection) of the transaction
+        deltas (dict): Changes keyed by counter name, e.g. ``{'books.total': 3}``
+    """
+    from models import LibraryStat
+
+    stats = LibraryStat.__table__
+    # A fixed order keeps concurrent transactions from deadlocking on the rows
+    for name in sorted(deltas):
+        if deltas[name]:
+            session.execute(
+                update(stats).where(stats.c.name == name).values(value=stats.c.value + deltas[name])
+            )
+
+
+def reconcile_statistics():
+    """
+    Rebuild the library counters from the tables and report any drift.
+
+    The caller commits.
+
+    Returns:
+        dict: ``{name: (stored, actual)}`` for every counter that was wrong
+    """
+    from app import db
+    from models import LibraryStat
+
+    stored = dict(db.session.execute(select(LibraryStat.name, LibraryStat.value)).all())
+    actual = count_statistics()
+
+    drift = {}
+    for name in STAT_COUNTERS:
+        table, figure = name.split('.')
+        value = actual[table][figure]
+        if stored.get(name) != value:
+            drift[name] = (stored.get(name), value)
+            db.session.merge(LibraryStat(name=name, value=value))
+    return drift
+
+
+def _group(counters, overdue_loans):
+    """Shape flat counters into the per-table dictionary returned to callers."""
+    return {
+        'books': {
+            'total': counters['books.total'],
+            'available': counters['books.available'],
+            'on_loan': counters['books.total'] - counters['books.available']
+        },
+        'members': {
+            'total': counters['members.total'],
+            'active': counters['members.active'],
+            'inactive': counters['members.total'] - counters['members.active']
+        },
+        'loans': {
+            'total': counters['loans.total'],
+            'active': counters['loans.active'],
+            'overdue': overdue_loans,
+            'returned': counters['loans.total'] - counters['loans.active']
+        }
+    }